@@ -56,6 +56,26 @@ The ``save()`` method can take the following keyword arguments:
     A list of images to append as additional frames. Each of the images in the list
     can be a single or multiframe image.
 
+``reencode``
+    When a frame read from an ISO 19794 image is saved with the same compression and
+    its pixels have not been modified (only its header), the original image data are
+    copied without encoding the image again. If true, the image is always encoded,
+    as when an option of the encoders is given (see
+    :py:data:`iso19794.base.CODEC_OPTIONS`).
+
+``encoder_workers``
+    With ``save_all``, the number of threads used to encode the frames in parallel.
+    The frames are written in their original order.
+
+``encoder_executor``
+    With ``save_all``, a ``concurrent.futures`` executor (a process pool for instance)
+    used to encode the frames in parallel, instead of ``encoder_workers`` threads.
+
+``jpeg2000_profile``
+    With the ``JPEG2000`` image data type, the name of an encoding profile of
+    :py:data:`iso19794.base.JPEG2000_PROFILES`. The options of the Pillow JPEG 2000
+    encoder given explicitly override the profile. By default, a single 60:1 layer.
+
 ``version``
     The version of the format to use, one of ``010``, ``020`` or ``030``. If not provided
     and if the image was loaded from an ISO 19794 image, the same version will be used.
@@ -141,7 +161,9 @@ import types
 import functools
 from collections import namedtuple
 
-from PIL import Image, ImageFile
+from . import hooks
+from .base import ISO19794ImageFile, _write_record, _encode_frames, _reencode, _save_jpeg2k
+from .record import Enum, Layout, Header, LazyHeader, enum_field, bytes_field, flags_field, shared, LIST_FIELD, SHARED_FIELD
 
 #------------------------------------------------------------------------------
 #
@@ -188,15 +210,15 @@ FACQualityRecord = namedtuple('FACQualityRecord',[
     'algo_id'])
 
 #
-GENDER = {
+GENDER = Enum({
     'X': 0,
     'M': 1,
     'F': 2,
     'U': 255,
-}
+})
 
 #
-EYE_COLOUR = {
+EYE_COLOUR = Enum({
     'UNSPECIFIED': 0,
     'BLACK': 1,
     'BLUE': 2,
@@ -206,10 +228,10 @@ EYE_COLOUR = {
     'MULTI_COLOURED': 6,
     'PINK': 7,
     'UNKNOWN': 255,
-}
+})
 
 #
-HAIR_COLOUR = {
+HAIR_COLOUR = Enum({
     'UNSPECIFIED': 0,
     'BALD': 1,
     'BLACK': 2,
@@ -219,7 +241,7 @@ HAIR_COLOUR = {
     'WHITE': 6,
     'RED': 7,
     'UNKNOWN': 255,
-}
+})
 
 #
 PROPERTY_FLAGS = {
@@ -237,7 +259,7 @@ PROPERTY_FLAGS = {
 }
 
 #
-EXPRESSION = {
+EXPRESSION = Enum({
     'UNSPECIFIED':      b"\x00\x00",
     'NEUTRAL':          b"\x00\x01",
     'SMILE_CLOSED_JAW': b"\x00\x02",
@@ -246,23 +268,23 @@ EXPRESSION = {
     'EYES_LOOKING_AWAY': b"\x00\x05",
     'SQUINTING':        b"\x00\x06",
     'FROWNING':         b"\x00\x07",
-}
+})
 
 #
-FACE_IMAGE_TYPE = {
+FACE_IMAGE_TYPE = Enum({
     'BASIC': 0,
     'FULL_FRONTAL': 1,
     'TOKEN_FRONTAL': 2,
-}
+})
 
 #
-IMAGE_DATA_TYPE = {
+IMAGE_DATA_TYPE = Enum({
     'JPEG': 0,
     'JPEG2000': 1,
-}
+})
 
 #
-SOURCE_TYPE = {
+SOURCE_TYPE = Enum({
     'UNSPECIFIED': 0,
     'STATIC_UNKNOWN': 1,
     'STATIC_CAMERA': 2,
@@ -271,7 +293,7 @@ SOURCE_TYPE = {
     'FRAME_ANALOGUE_CAMERA': 5,
     'FRAME_DIGITAL_CAMERA': 6,
     'UNKNOWN': 7,
-}
+})
 
 COLOUR_SPACE = {
     0: (24, 'RGB'),
@@ -281,6 +303,132 @@ COLOUR_SPACE = {
     4: (24, 'RGB'),
 }
 
+# Compact representation header, with the fields added by scan()
+class FACHeader(Header):
+    _fields = dict(
+        landmark_points=LIST_FIELD,
+        gender=enum_field(GENDER),
+        eye_colour=enum_field(EYE_COLOUR),
+        hair_colour=enum_field(HAIR_COLOUR),
+        property_mask=flags_field(PROPERTY_FLAGS),
+        expression=enum_field(EXPRESSION),
+        pose_yaw=None,
+        pose_pitch=None,
+        pose_roll=None,
+        pose_uncertainty_yaw=None,
+        pose_uncertainty_pitch=None,
+        pose_uncertainty_roll=None,
+        face_image_type=enum_field(FACE_IMAGE_TYPE),
+        image_data_type=enum_field(IMAGE_DATA_TYPE),
+        source_type=enum_field(SOURCE_TYPE),
+        device_type=bytes_field(2),
+        quality=None,
+        bit_depth=None,
+        width=SHARED_FIELD,
+        height=SHARED_FIELD,
+        image_data_length=None,
+        )
+    __slots__ = tuple(_fields)
+
+# General header (§5.4)
+_FORMAT = Layout(
+    ('magic', '4s'),
+    ('version', '4s'),
+    )
+_GENERAL_HEADER = {
+    '010': Layout(
+        *_FORMAT.fields,
+        ('length', 'I'),
+        ('nb_facial_images', 'H'),
+        ),
+    '030': Layout(
+        *_FORMAT.fields,
+        ('length', 'I'),
+        ('nb_facial_images', 'H'),
+        ('certification_flag', '?'),
+        ('temporal_semantics', 'H'),
+        ),
+    }
+
+# Representation header, up to the number of quality records (version 030)
+_LENGTH = Layout(('length', 'I'))
+_CAPTURE = Layout(
+    ('year', 'H'),
+    ('month', 'B'),
+    ('day', 'B'),
+    ('hour', 'B'),
+    ('minute', 'B'),
+    ('second', 'B'),
+    ('millisecond', 'H'),
+    ('capture_device_technology_id', 's'),
+    ('capture_device_vendor_id', '2s'),
+    ('capture_device_type_id', '2s'),
+    ('nb_quality_records', 'B'),
+    )
+_REPRESENTATION = Layout(*_LENGTH.fields, *_CAPTURE.fields)
+_QUALITY_RECORD = Layout(
+    ('score', 'B'),
+    ('algo_vendor_id', '2s'),
+    ('algo_id', '2s'),
+    )
+
+# §5.5 Facial Information Block
+_FACIAL_INFORMATION = {
+    '010': Layout(
+        ('number_landmark_points', 'H'),
+        ('gender', 'B'),
+        ('eye_colour', 'B'),
+        ('hair_colour', 'B'),
+        ('property_mask', '3s'),
+        ('expression', '2s'),
+        ('pose_yaw', 'b'),
+        ('pose_pitch', 'b'),
+        ('pose_roll', 'b'),
+        ('pose_uncertainty_yaw', 'b'),
+        ('pose_uncertainty_pitch', 'b'),
+        ('pose_uncertainty_roll', 'b'),
+        ),
+    '030': Layout(
+        ('number_landmark_points', 'H'),
+        ('gender', 'B'),
+        ('eye_colour', 'B'),
+        ('hair_colour', 'B'),
+        ('subject_height', 'B'),
+        ('property_mask', '3s'),
+        ('expression', '2s'),
+        ('pose_yaw', 'b'),
+        ('pose_pitch', 'b'),
+        ('pose_roll', 'b'),
+        ('pose_uncertainty_yaw', 'b'),
+        ('pose_uncertainty_pitch', 'b'),
+        ('pose_uncertainty_roll', 'b'),
+        ),
+    }
+
+# first field of the facial information blocks
+_NUMBER_LANDMARK_POINTS = struct.Struct(">H")
+
+# §5.6 Landmark Point Block
+_LANDMARK_POINT = Layout(
+    ('point_type', 'B'),
+    ('point_code', 'B'),
+    ('x', 'H'),
+    ('y', 'H'),
+    ('z', 'H'),
+    )
+
+# §5.7 Image Information Block
+_IMAGE_INFORMATION = Layout(
+    ('face_image_type', 'B'),
+    ('image_data_type', 'B'),
+    ('width', 'H'),
+    ('height', 'H'),
+    ('colour_space', 'B'),
+    ('source_type', 'B'),
+    ('device_type', '2s'),
+    ('quality', 'H'),
+    )
+
 #------------------------------------------------------------------------------
 #
 # Type 4 Images (fingerprint and palmprint)
@@ -290,233 +438,231 @@ COLOUR_SPACE = {
 def _accept(prefix):
     return prefix[:4] == b"FAC\x00"
 
-class FACImageFile(ImageFile.ImageFile):
+class FACImageFile(ISO19794ImageFile):
 
     format = "FAC"
     format_description = "ISO19794-5 image (face image)"
-    _close_exclusive_fp_after_loading = False
 
     def _open(self):
-        # General header (§8.2)
-        header = self.fp.read(17)
-        if header[:4] != b"FAC\x00":
-            raise SyntaxError("not a ISO19794-5 file")
-
-        version = None
-        if header[4:8] == b"010\x00":
-            version = '010'
-        elif header[4:8] == b"020\x00":
-            version = '020'
-        elif header[4:8] == b"030\x00":
-            version = '030'
-        if version is None:
-            raise SyntaxError("Invalid version for a ISO19794-5 file")
-
-        self.info['version'] = version
-        if version=='010':
-            length,self.info['nb_facial_images'] = struct.unpack(">IH",header[8:14])
-            self.__first = self.__next = 14     # skip the general header
-        elif version=='030':
-            length,self.info['nb_facial_images'],self.info['certification_flag'],self.info['temporal_semantics'] = struct.unpack(">IH?H",header[8:14])
-            self.__first = self.__next = 17     # skip the general header
-
-        # setup frame pointers
-        self.__frame = -1
-        self.__fp = self.fp
-        self._frame_pos = []
-        self.n_frames = self.info['nb_facial_images']
-
-        self._rheaders = []
-
-        self._seek(0)
-
-    def load_end(self):
-        # allow closing if we're on the first frame, there's no next
-        if self.__frame == 0 and not self.__next:
-            self._close_exclusive_fp_after_loading = True
-
-    def seek(self, frame):
-        "Select a given frame as current image"
-        if not self._seek_check(frame):
+        if self._open_cached():
             return
-        self._seek(frame)
-        # Create a new core image object on second and
-        # subsequent frames in the image. Image may be
-        # different size/mode.
-        Image._decompression_bomb_check(self.size)
-        self.im = Image.core.new(self.mode, self.size)
-
-    def __del__(self):
-        if self.__fp and self._exclusive_fp:
-            self.__fp.close()
-            self.__fp = None
-        elif self.fp and self._exclusive_fp:
-            self.fp.close()
-            self.fp = None
-
-    def _seek_check(self, frame):
-        if (frame < self._min_frame or
-            frame >= self.n_frames+self._min_frame):
-            raise EOFError("attempt to seek outside sequence")
-
-        return self.tell() != frame
-
-    def _seek(self, frame):
-        # save rheader in case it has been modified
-        if self.__frame>=0 and hasattr(self,"header"):
-            self._rheaders[self.__frame] = self.header
-        self.fp = self.__fp
-        while len(self._frame_pos) <= frame:
-            if not self.__next:
-                raise EOFError("no more images in FAC file")
-            # reset python3 buffered io handle in case fp
-            # was passed to a libxxx, invalidating the buffer
-            self.fp.tell()
-            self.fp.seek(self.__next)
-            self._frame_pos.append(self.__next)
-            header,offset,ns = self.read_header()
-            self._rheaders.append(header)
-            self.__next = self._frame_pos[frame] + ns.length
-            self.__frame += 1
-        self.fp.seek(self._frame_pos[frame])
-        header,offset,ns = self.read_header()
-        self.header = self._rheaders[frame]
-        self.__next = self._frame_pos[frame] + ns.length
-        self.__frame = frame
-
-        self.mode = ns.mode
-        try:
-            self.size = (ns.width,ns.height)
-        except AttributeError:
-            # Support Pillow >= 5.3.0
-            self._size = (ns.width,ns.height)
+        # General header (§8.2)
+        start = hooks.start()
+        info,first = _read_general_header(self.fp)
+        self.info.update(info)
+        hooks.report(start, 'general_header', self.format, info['version'], None, None, first)
 
-        # data descriptor
-        # Select decoder
-        if header['image_data_type']=='JPEG':
-            self.tile = [
-                ('jpeg', (0, 0) + self.size, self._frame_pos[frame]+offset, (self.mode,self.mode,1,0))
-            ]
-        elif header['image_data_type']=='JPEG2000':
-            sig = self.fp.read(4)
-            codec = None
-            if sig == b"\xff\x4f\xff\x51":
-                codec = "j2k"
-            else:
-                sig = sig + self.fp.read(8)
+        self._open_frames(first, self.info['nb_facial_images'])     # skip the general header
+
+    def _codec(self, ns):
+        return IMAGE_DATA_TYPE.names[ns.image_data_type]
 
-                if sig == b"\x00\x00\x00\x0cjP  \x0d\x0a\x87\x0a":
-                    codec = "jp2"
-            if codec is None:
-                raise SyntaxError("not a JPEG 2000 image")
+    def _frame_tile(self, frame, header, offset, ns):
+        size = (ns.width,ns.height)
 
-            self.tile = [
-                ('jpeg2k', (0, 0) + self.size, self._frame_pos[frame]+offset, (codec,))
+        # data descriptor
+        # Select decoder (from the file, the header may have been modified)
+        image_data_type = self._codec(ns)
+        pos = self._frame_offset(frame)+offset
+        if image_data_type=='JPEG':
+            tile = [
+                ('jpeg', (0, 0) + size, pos, (ns.mode,ns.mode,1,0))
+            ]
+        elif image_data_type=='JPEG2000':
+            tile = [
+                ('jpeg2k', (0, 0) + size, pos, (self._jpeg2k_codec(pos),))
             ]
         else:
-            raise SyntaxError("Unknown image_data_type "+repr(header['image_data_type']))
-
-    def tell(self):
-        "Return the current frame number"
-        return self.__frame
+            raise SyntaxError("Unknown image_data_type "+repr(image_data_type))
+        return ns.mode, size, tile
 
-    def read_header(self):
+    def read_header(self, fp=None):
         # Reader representation header starting at current position
         # return a namedtuple
-        nb = 0
-        # Temporary namespace used during the analysis of the header
-        ns = types.SimpleNamespace()
-        if self.info['version']=="010":
-            ns.length, = struct.unpack(">I",self.fp.read(4))
-            # Init other
-            ns.capture_datetime = datetime.datetime.now()
-            ns.capture_device_technology_id = "\x00"
-            ns.capture_device_vendor_id = "\x00\x00"
-            ns.capture_device_type_id = "\x00\x00"
-            ns.quality_records = []
-            nb += 4
-        elif self.info['version']=="030":
-            ns.length,ns.capture_datetime,ns.capture_device_technology_id,ns.capture_device_vendor_id,ns.capture_device_type_id,q_length = \
-                struct.unpack(">I9ss2s2sB",self.fp.read(19))
-            # XXX micro or milli seconds?
-            ns.capture_datetime = datetime.datetime( *struct.unpack(">HBBBBBH",ns.capture_datetime) )
-            nb += 19
-            Q = []
-            for i in range(q_length):
-                Q.append( FACQualityRecord._make( struct.unpack(">B2s2s",self.fp.read(5)) ) )
-                nb += 5
-            ns.quality_records = Q
-
-        # §5.5 Facial Information Block
-        if self.info['version']=="010":
-            ns.number_landmark_points, ns.gender, ns.eye_colour, ns.hair_colour, property_mask, \
-            ns.expression, ns.pose_yaw, ns.pose_pitch, ns.pose_roll, \
-            ns.pose_uncertainty_yaw, ns.pose_uncertainty_pitch, ns.pose_uncertainty_roll = \
-                struct.unpack(">HBBB3s2sbbbbbb",self.fp.read(16))
-            ns.property_mask = struct.unpack(">I",b"\x00"+property_mask)[0]
-            nb += 16
-        elif self.info['version']=="030":
-            ns.number_landmark_points, ns.gender, ns.eye_colour, ns.hair_colour, ns.subject_height, ns.property_mask, \
-            ns.expression, ns.pose_yaw, ns.pose_pitch, ns.pose_roll, \
-            ns.pose_uncertainty_yaw, ns.pose_uncertainty_pitch, ns.pose_uncertainty_roll = \
-                struct.unpack(">HBBBB3s2sbbbbbb",self.fp.read(17))
-            nb += 17
-
-        # §5.6 Landmark Point Block
-        ns.landmark_points = []
-        for n in range(ns.number_landmark_points):
-            ns2 = types.SimpleNamespace()
-            ns2.point_type, ns2.point_code, ns2.x, ns2.y, ns2.z = \
-                struct.unpack(">BBHHH",self.fp.read(8))
-            nb += 8
-
-            ns.landmark_points.append(FACLandmarkPoint._make( (
-                ns2.point_type, ns2.point_code, ns2.x, ns2.y, ns2.z
-            )))
-
-        # §5.7 Image Information Block
-        if self.info['version']=="010":
-            ns.face_image_type,ns.image_data_type,ns.width,ns.height,ns.colour_space,ns.source_type,ns.device_type,ns.quality = \
-                struct.unpack(">BBHHBB2sH", self.fp.read(12))
-            nb += 12
-            ns.bit_depth,ns.mode = COLOUR_SPACE[ns.colour_space]
-        # Buid the namedtuple and convert part of it
-        d = dict(
-            # capture_datetime=ns.capture_datetime,
-            # capture_device_technology_id=ns.capture_device_technology_id,
-            # capture_device_vendor_id=ns.capture_device_vendor_id,
-            # capture_device_type_id=ns.capture_device_type_id,
-            # quality_records=ns.quality_records,
-            landmark_points=ns.landmark_points,
-            gender={v: k for k, v in GENDER.items()}[ns.gender],
-            eye_colour={v: k for k, v in EYE_COLOUR.items()}[ns.eye_colour],
-            hair_colour={v: k for k, v in HAIR_COLOUR.items()}[ns.hair_colour],
-            # subject_height=ns.subject_height,
-            property_mask=[k for k, v in PROPERTY_FLAGS.items() if ns.property_mask & v],
-            expression={v: k for k, v in EXPRESSION.items()}[ns.expression],
-            pose_yaw=ns.pose_yaw,
-            pose_pitch=ns.pose_pitch,
-            pose_roll=ns.pose_roll,
-            pose_uncertainty_yaw=ns.pose_uncertainty_yaw,
-            pose_uncertainty_pitch=ns.pose_uncertainty_pitch,
-            pose_uncertainty_roll=ns.pose_uncertainty_roll,
-            face_image_type={v: k for k, v in FACE_IMAGE_TYPE.items()}[ns.face_image_type],
-            image_data_type={v: k for k, v in IMAGE_DATA_TYPE.items()}[ns.image_data_type],
-            source_type={v: k for k, v in SOURCE_TYPE.items()}[ns.source_type],
-            device_type=ns.device_type,
-            quality=ns.quality,
+        return _read_header(fp or self.fp, self.info, self.compact_headers)
+
+def _read_general_header(fp):
+    # Read the general header (§8.2)
+    # return the info dictionary and the size of the general header
+    header = fp.read(_FORMAT.size)
+    magic,version = _FORMAT.unpack(header)
+    if magic != b"FAC\x00":
+        raise SyntaxError("not a ISO19794-5 file")
+
+    version = version[:3].decode('ascii','replace')
+    if version not in ('010','020','030'):
+        raise SyntaxError("Invalid version for a ISO19794-5 file")
+
+    info = {}
+    info['version'] = version
+    layout = _GENERAL_HEADER.get(version)
+    if layout is None:
+        return info, _FORMAT.size
+    values = layout.unpack(header + fp.read(layout.size - _FORMAT.size))
+    info.update(zip(layout.names[3:], values[3:]))
+    return info, layout.size
+
+def _read_values(fp, info):
+    # Read the representation header starting at the current position of fp
+    # return its size and the raw values
+    # Temporary namespace used during the analysis of the header
+    ns = types.SimpleNamespace()
+    version = info['version']
+    if version=="010":
+        nb = _LENGTH.read(fp, ns)
+        # Init other
+        ns.capture_datetime = datetime.datetime.now()
+        ns.capture_device_technology_id = "\x00"
+        ns.capture_device_vendor_id = "\x00\x00"
+        ns.capture_device_type_id = "\x00\x00"
+        ns.quality_records = []
+    elif version=="030":
+        nb = _REPRESENTATION.read(fp, ns)
+        # XXX micro or milli seconds?
+        ns.capture_datetime = datetime.datetime(ns.year,ns.month,ns.day,ns.hour,ns.minute,ns.second,ns.millisecond)
+        ns.quality_records = _QUALITY_RECORD.read_records(fp, ns.nb_quality_records, FACQualityRecord)
+        nb += ns.nb_quality_records * _QUALITY_RECORD.size
+
+    # §5.5 Facial Information Block
+    nb += _FACIAL_INFORMATION[version].read(fp, ns)
+    ns.property_mask = int.from_bytes(ns.property_mask, 'big')
+
+    # §5.6 Landmark Point Block
+    ns.landmark_points = _LANDMARK_POINT.read_records(fp, ns.number_landmark_points, FACLandmarkPoint)
+    nb += ns.number_landmark_points * _LANDMARK_POINT.size
+
+    # §5.7 Image Information Block
+    if version=="010":
+        nb += _IMAGE_INFORMATION.read(fp, ns)
+        ns.bit_depth,ns.mode = COLOUR_SPACE[ns.colour_space]
+    return nb,ns
+
+def _compact_codes(ns):
+    # Return the codes of the fields of a FACHeader
+    return dict(
+        landmark_points=tuple(ns.landmark_points),
+        gender=ns.gender,
+        eye_colour=ns.eye_colour,
+        hair_colour=ns.hair_colour,
+        property_mask=ns.property_mask,
+        # shared code object
+        expression=EXPRESSION[EXPRESSION.names[ns.expression]],
+        pose_yaw=ns.pose_yaw,
+        pose_pitch=ns.pose_pitch,
+        pose_roll=ns.pose_roll,
+        pose_uncertainty_yaw=ns.pose_uncertainty_yaw,
+        pose_uncertainty_pitch=ns.pose_uncertainty_pitch,
+        pose_uncertainty_roll=ns.pose_uncertainty_roll,
+        face_image_type=ns.face_image_type,
+        image_data_type=ns.image_data_type,
+        source_type=ns.source_type,
+        device_type=int.from_bytes(ns.device_type,'big'),
+        quality=ns.quality,
+        )
+
+def _read_header(fp, info, compact=False):
+    # Read the representation header starting at the current position of fp
+    # return the header (a FACHeader if compact), its size and the raw values
+    nb,ns = _read_values(fp, info)
+
+    if compact:
+        return FACHeader.from_codes(**_compact_codes(ns)),nb,ns
+
+    # Buid the namedtuple and convert part of it
+    d = dict(
+        # capture_datetime=ns.capture_datetime,
+        # capture_device_technology_id=ns.capture_device_technology_id,
+        # capture_device_vendor_id=ns.capture_device_vendor_id,
+        # capture_device_type_id=ns.capture_device_type_id,
+        # quality_records=ns.quality_records,
+        landmark_points=ns.landmark_points,
+        gender=GENDER.names[ns.gender],
+        eye_colour=EYE_COLOUR.names[ns.eye_colour],
+        hair_colour=HAIR_COLOUR.names[ns.hair_colour],
+        # subject_height=ns.subject_height,
+        property_mask=[k for k, v in PROPERTY_FLAGS.items() if ns.property_mask & v],
+        expression=EXPRESSION.names[ns.expression],
+        pose_yaw=ns.pose_yaw,
+        pose_pitch=ns.pose_pitch,
+        pose_roll=ns.pose_roll,
+        pose_uncertainty_yaw=ns.pose_uncertainty_yaw,
+        pose_uncertainty_pitch=ns.pose_uncertainty_pitch,
+        pose_uncertainty_roll=ns.pose_uncertainty_roll,
+        face_image_type=FACE_IMAGE_TYPE.names[ns.face_image_type],
+        image_data_type=IMAGE_DATA_TYPE.names[ns.image_data_type],
+        source_type=SOURCE_TYPE.names[ns.source_type],
+        device_type=ns.device_type,
+        quality=ns.quality,
+        )
+
+    # XXX do we need to skip a block after the image?
+    return d,nb,ns
+
+def _scanned_header(info, compact, data):
+    # Decode a representation header read by scan(): return the dictionary
+    # header, or the codes of the FACHeader if compact
+    if compact:
+        offset,ns = _read_values(io.BytesIO(data), info)
+        header = _compact_codes(ns)
+        header.update(
+            width=shared(ns.width),
+            height=shared(ns.height),
             )
-
-        # XXX do we need to skip a block after the image?
-        return d,nb,ns
+    else:
+        header,offset,ns = _read_header(io.BytesIO(data), info)
+        header.update(
+            width=ns.width,
+            height=ns.height,
+            )
+    header.update(
+        bit_depth=ns.bit_depth,
+        image_data_length=ns.length-offset,
+        )
+    return header
+
+def scan(fp, compact=False):
+    """Read the general header and all the representation headers of an image
+
+    The representations are walked using their length only, the image data is never
+    read nor decoded. Return the ``info`` dictionary and a list of representation
+    headers, with the ``bit_depth``, ``width``, ``height`` and ``image_data_length``
+    fields added. If ``compact`` is true, the headers are :py:class:`FACHeader`
+    objects instead of dictionaries. Only the bytes of the headers are read, they
+    are decoded when first accessed.
+    """
+    start = fp.tell()
+    info,pos = _read_general_header(fp)
+    pos += start
+    version = info['version']
+    facial = _FACIAL_INFORMATION[version]
+    decode = functools.partial(_scanned_header, info, compact)
+    lazy = FACHeader.lazy if compact else LazyHeader
+    headers = []
+    for i in range(info['nb_facial_images']):
+        fp.seek(pos)
+        # the header up to the number of landmark points, then the rest of it
+        if version == "030":
+            data = fp.read(_REPRESENTATION.size)
+            data += fp.read(_QUALITY_RECORD.size * data[-1] + facial.size)
+        else:
+            data = fp.read(_LENGTH.size + facial.size)
+        length, = _LENGTH.struct.unpack_from(data)
+        number_landmark_points, = _NUMBER_LANDMARK_POINTS.unpack_from(data, len(data) - facial.size)
+        size = len(data) + _LANDMARK_POINT.size * number_landmark_points
+        if version == "010":
+            size += _IMAGE_INFORMATION.size
+        data += fp.read(size - len(data))
+        if len(data) < size:
+            raise EOFError("truncated representation header")
+        headers.append(lazy(data, decode))
+        pos += length
+    return info, headers
 
 #
 # Save operations
 #
-import PIL.JpegImagePlugin
-import PIL.Jpeg2KImagePlugin
-def _save_frame(im,fp,version):
-    # Return bytes for one frame
+def _encode_image_data(im):
+    # Return the compressed image data of an image
     try:
         info = im.encoderinfo
     except:
@@ -525,35 +671,70 @@ def _save_frame(im,fp,version):
     image_data = io.BytesIO()
 
     ns = im.header
-    illegal_keys = set(ns.keys()) - {k for k,v in FACRepresentationHeaderInfo.items() if version in v}
-    if len(illegal_keys)>0:
-        raise SyntaxError("Unknown value in representation header "+str(illegal_keys))
-
     if ns.get('image_data_type',"JPEG")=="JPEG":
         info['quality'] = 'maximum'
         #info['dpi'] = (im.header.horizontal_image_sampling_rate,im.header.vertical_image_sampling_rate)
+        import PIL.JpegImagePlugin
         PIL.JpegImagePlugin._save(im, image_data, "")
     elif ns.get('image_data_type',"JPEG")=="JPEG2000":
         # Define a default for the compression ratio
-        info.setdefault("quality_mode", "rates")
-        info.setdefault("quality_layers", (60,))
-        PIL.Jpeg2KImagePlugin._save(im, image_data, "non.j2k")
+        _save_jpeg2k(im, image_data, dict(quality_mode="rates", quality_layers=(60,)))
     else:
         raise SyntaxError("Unknown compression algo "+ns.get('image_data_type',None))
-    image_data = image_data.getvalue()
+    return image_data.getvalue()
+
+def _encode_job(version, im, header, encoderinfo, frame):
+    # Encode an image in a worker of an executor, return the image data and
+    # the encode event
+    im.header = header
+    im.encoderinfo = encoderinfo
+    return _encode_frame(im, version, frame, True)
+
+def _encode_frame(im, version, frame, always=False):
+    # Encode an image, return the image data and the encode event (None if
+    # there is no observer and always is false)
+    start = hooks.start(always)
+    encoded = _encode_image_data(im)
+    return encoded, hooks.event(start, 'encode', 'FAC', version, frame, im.header.get('image_data_type',"JPEG"), len(encoded))
+
+def _original_image_data(im):
+    # Return the image data read from the file, if the frame can be saved
+    # without encoding it again, None otherwise
+    if not isinstance(im, FACImageFile) or _reencode(getattr(im, 'encoderinfo', {})):
+        return None
+    original = im._unmodified_image_data(im.header.get('image_data_type',"JPEG"))
+    if original is None:
+        return None
+    return original[0]
+
+def _save_frame(im,fp,version,frame=0,encoded=None):
+    # Write one frame and return its length
+    ns = im.header
+    illegal_keys = set(ns.keys()) - {k for k,v in FACRepresentationHeaderInfo.items() if version in v}
+    if len(illegal_keys)>0:
+        raise SyntaxError("Unknown value in representation header "+str(illegal_keys))
+
+    if encoded is None:
+        # Keep the image data if neither the pixels nor the compression changed
+        encoded = _original_image_data(im)
+        if encoded is None:
+            encoded, event = _encode_frame(im, version, frame)
+            hooks.emit(event)
+    image_data = encoded
 
+    start = hooks.start()
     rheader = b''
     if version=='030':
         dt = ns.get('capture_datetime',datetime.datetime.now())
         rheader += struct.pack(">HBBBBBH",dt.year,dt.month,dt.day,dt.hour,dt.minute,dt.second,int(dt.microsecond/1000))
 
     if version=="010":
-        rheader += struct.pack(">HBBB3s2sbbbbbb",
+        rheader += _FACIAL_INFORMATION[version].pack(
             len(ns.get('landmark_points',[])),
             GENDER[ns.get('gender','X')],
             EYE_COLOUR[ns.get('eye_colour','UNSPECIFIED')],
             HAIR_COLOUR[ns.get('hair_colour','UNSPECIFIED')],
-            struct.pack(">I", functools.reduce(lambda x,y: x|y, [v for k,v in PROPERTY_FLAGS.items() if k in ns.get('property_mask',[]) ],0))[1:] ,
+            functools.reduce(lambda x,y: x|y, [v for k,v in PROPERTY_FLAGS.items() if k in ns.get('property_mask',[]) ],0).to_bytes(3,'big'),
             EXPRESSION[ns.get('expression','UNSPECIFIED')],
             ns.get('pose_yaw',0),
             ns.get('pose_pitch',0),
@@ -564,17 +745,17 @@ def _save_frame(im,fp,version):
 
     if version=='030':
         for q in ns.get('quality_records',[]):
-            rheader += struct.pack(">B2s2s",q.score,q.algo_vendor_id,q.algo_id)
+            rheader += _QUALITY_RECORD.pack(q.score,q.algo_vendor_id,q.algo_id)
 
     # Landmark Point Block
     for pt in ns.get('landmark_points',[]):
-        rheader += struct.pack(">BBHHH",
+        rheader += _LANDMARK_POINT.pack(
             pt.point_type,
             pt.point_code,
             pt.x, pt.y, pt.z)
 
     # Image Information Block
-    rheader += struct.pack(">BBHHBB2sH",
+    rheader += _IMAGE_INFORMATION.pack(
         FACE_IMAGE_TYPE[ns.get('face_image_type','BASIC')],
         IMAGE_DATA_TYPE[ns.get('image_data_type','JPEG')],
         im.size[0], im.size[1],
@@ -582,28 +763,34 @@ def _save_frame(im,fp,version):
         SOURCE_TYPE[ns.get('source_type','UNSPECIFIED')],
         b"\x00\x00",
         0)
+    compression = ns.get('image_data_type','JPEG')
+    hooks.report(start, 'header', 'FAC', version, frame, compression, len(rheader))
 
     # Write the frame
-    fp.write(struct.pack(">I",4+len(rheader)+len(image_data)))
+    start = hooks.start()
+    length = 4+len(rheader)+len(image_data)
+    fp.write(_LENGTH.pack(length))
     fp.write(rheader)
     fp.write(image_data)
+    hooks.report(start, 'write', 'FAC', version, frame, compression, length)
+    return length
 
 
+def _write_general_header(fp, version, length, nb_frames):
+    if version=='010':
+        fp.write(_GENERAL_HEADER['010'].pack(b"FAC\x00", b"010\x00",length,nb_frames))
+    elif version=='030':
+        fp.write(_GENERAL_HEADER['030'].pack(b"FAC\x00", b"030\x00",length,nb_frames,0,0))
+    else:
+        fp.write(b"FAC\x00")
+
 def _save(im, fp, filename):
     encoderinfo = im.encoderinfo.copy()
     version = encoderinfo.get("version", im.info.get('version','030'))
 
-    fr = io.BytesIO()
-    _save_frame(im,fr,version)
-    fr_data = fr.getvalue()
-
-    # Write the general header
-    fp.write(b"FAC\x00")
-    if version=='010':
-        fp.write(struct.pack(">4sIH", b"010\x00",14+len(fr_data),1))
-
-    # Write the frame
-    fp.write(fr_data)
+    _write_record(fp, _GENERAL_HEADER[version].size if version in _GENERAL_HEADER else 4,
+        lambda fp, length: _write_general_header(fp,version,length,1),
+        lambda fp: _save_frame(im,fp,version))
 
 def _save_all(im, fp, filename):
     encoderinfo = im.encoderinfo.copy()
@@ -623,24 +810,18 @@ def _save_all(im, fp, filename):
                     image.seek(idx)
                     yield image
 
-    # Generate the frames
-    frames_buffers = []
-    length = 0
-    for frame in frames(images):
-        fr = io.BytesIO()
-        _save_frame(frame,fr,version)
-        frames_buffers.append( fr.getvalue() )
-        length += len(frames_buffers[-1])
-
-    # Write the general header
-    fp.write(b"FAC\x00")
-    if version=='010':
-        fp.write(struct.pack(">4sIH", b"010\x00",14+length,len(frames_buffers)))
-    elif version=='030':
-        fp.write(struct.pack(">4sIH?H", b"030\x00",17+length,len(frames_buffers),0,1 if len(positions)>1 else 0))
+    nb_frames = sum(getattr(image,'n_frames',1) for image in images)
+
+    # Generate the frames, written as soon as encoded
+    def write_frames(fp):
+        length = 0
+        for index,(frame,encoded) in enumerate(_encode_frames(frames(images),encoderinfo,_original_image_data,functools.partial(_encode_job,version))):
+            length += _save_frame(frame,fp,version,index,encoded)
+        return length
 
-    for buf in frames_buffers:
-        fp.write(buf)
+    _write_record(fp, _GENERAL_HEADER[version].size if version in _GENERAL_HEADER else 4,
+        lambda fp, length: _write_general_header(fp,version,length,nb_frames),
+        write_frames)
 
 def _debug(image):
     print('Info'+str(image.info))
@@ -648,15 +829,6 @@ def _debug(image):
         image.seek(i)
         print("Frame #%d: mode: %s size=%dx%d" % (i,image.mode, image.size[0], image.size[1]))
         print("\tHeader: ",image.header)
-#
-# Registration
-#
-Image.register_open(FACImageFile.format, FACImageFile, _accept)
-Image.register_save(FACImageFile.format, _save)
-Image.register_save_all(FACImageFile.format, _save_all)
-
-Image.register_extension(FACImageFile.format, ".fac")
-Image.register_mime(FACImageFile.format, "image/fac")
 
 
 if __name__ == "__main__":
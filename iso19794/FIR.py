@@ -57,6 +57,45 @@ The ``save()`` method can take the following keyword arguments:
     A list of images to append as additional frames. Each of the images in the list
     can be a single or multiframe image.
 
+``reencode``
+    When a frame read from an ISO 19794 image is saved with the same compression and
+    its pixels have not been modified (only its header), the original image data are
+    copied without encoding the image again. If true, the image is always encoded,
+    as when an option of the encoders is given (see
+    :py:data:`iso19794.base.CODEC_OPTIONS`).
+
+``bit_depth``
+    With the ``RAW_PACKED`` compression, the number of bits per pixel (1 to 8, by
+    default 1 for a ``1`` image and 8 otherwise). The pixels are reduced to their most
+    significant bits and packed without line padding. When read, they are scaled back
+    to 8 bits (``L`` image).
+
+``wsq_bitrate``
+    With the ``WSQ`` compression, the target bit rate in bits per pixel (0.75 by
+    default, about 15:1). The WSQ encoder requires NumPy.
+
+``png_preset``
+    With the ``PNG`` compression, the name of a preset of :py:data:`PNG_PRESETS`:
+    ``fast`` (lowest zlib level), ``default`` (the default) or ``compact`` (highest
+    zlib level, searching the best filter parameters, several times slower). The
+    ``optimize`` and ``compress_level`` options given explicitly override the preset.
+
+``jpeg2000_profile``
+    With the ``JPEG2000_LOSSY`` and ``JPEG2000_LOSSLESS`` compressions, the name of an
+    encoding profile of :py:data:`iso19794.base.JPEG2000_PROFILES` (tile size, number of
+    resolutions, progression order, code-block size and quality layers), which must
+    be lossy or lossless as the compression. The options of the Pillow JPEG 2000
+    encoder (``num_resolutions``, ``quality_layers``...) given explicitly override
+    the profile. By default, a single 15:1 layer or a lossless layer.
+
+``encoder_workers``
+    With ``save_all``, the number of threads used to encode the frames in parallel.
+    The frames are written in their original order.
+
+``encoder_executor``
+    With ``save_all``, a ``concurrent.futures`` executor (a process pool for instance)
+    used to encode the frames in parallel, instead of ``encoder_workers`` threads.
+
 Usage
 '''''
 
@@ -122,6 +161,11 @@ To read an image, just use the standard open function:
 1
 >>> nsample.seek(1)
 
+Frames can be selected from the content of their representation header:
+
+>>> nsample.find_frames(position='LEFT_INDEX_FINGER')
+[0, 1]
+
 To specify the compression algorithm:
 
 >>> nsample = Image.open(buffer_multi)
@@ -144,19 +188,29 @@ or ``JPEG2000_LOSSLESS``
 >>> sample.header['image_compression_algo'] ='JPEG2000_LOSSLESS'
 >>> sample.save(buffer,"FIR")
 
+``PNG`` is a lossless compression cheaper to encode than ``JPEG2000_LOSSLESS``,
+``png_preset`` selects the speed/size trade-off:
+
+>>> buffer = io.BytesIO()
+>>> sample.header['image_compression_algo'] ='PNG'
+>>> sample.save(buffer,"FIR",png_preset='fast')
+
 """
 
-# XXX All compressions (missing: PNG)
 # XXX Add table 4 (capture device techno)
 # XXX Add Table 5 (certification schemes)
 
 import io
 import datetime
-import struct
 import types
+import functools
 from collections import namedtuple
 
-from PIL import Image, ImageFile
+from PIL import ImageFile
+
+from . import hooks
+from .base import ISO19794ImageFile, _write_record, _encode_frames, _reencode, _decode_frame, _save_jpeg2k
+from .record import Enum, Layout, Header, LazyHeader, enum_field, bytes_field, shared, LIST_FIELD, SHARED_FIELD
 
 #------------------------------------------------------------------------------
 #
@@ -197,7 +251,7 @@ FIRCertificationRecord = namedtuple('FIRCertificationRecord',[
     'scheme_id'])
 
 # Conversion of position (Table 6, 7 and 8)
-POSITION = {
+POSITION = Enum({
     # Table 6
     'UNKNOWN': 0,
     'RIGHT_THUMB': 1,
@@ -243,10 +297,10 @@ POSITION = {
     'LEFT_INTERDIGITAL': 34,
     'LEFT_THENAR': 35,
     'LEFT_HYPOTHENAR': 36,
-}
+})
 
 # Conversion of compression (Table 9)
-COMPRESSION = {
+COMPRESSION = Enum({
     'RAW': 0,
     'RAW_PACKED': 1,
     'WSQ': 2,
@@ -254,10 +308,10 @@ COMPRESSION = {
     'JPEG2000_LOSSY': 4,
     'JPEG2000_LOSSLESS': 5,
     'PNG': 6,
-}
+})
 
 # Conversion of impression type (Table 10)
-IMPRESSION = {
+IMPRESSION = Enum({
     'LIVESCAN_PLAIN': 0,
     'LIVESCAN_ROLLED': 1,
     'NONLIVESCAN_PLAIN': 2,
@@ -277,14 +331,203 @@ IMPRESSION = {
     'LIVESCAN_OPTICAL_CONTACTLESS_PLAIN': 24,
     'OTHER': 28,
     'UNKNOWN': 29,
-}
+})
 
 # Conversion of units (Table 2)
-UNIT = {
+UNIT = Enum({
     'PPI': 1,
     'PPCM': 2,
+})
+
+# Compact representation header, with the fields added by scan()
+class FIRHeader(Header):
+    _fields = dict(
+        capture_datetime=None,
+        capture_device_technology_id=None,
+        capture_device_vendor_id=bytes_field(2),
+        capture_device_type_id=bytes_field(2),
+        quality_records=LIST_FIELD,
+        certification_records=LIST_FIELD,
+        position=enum_field(POSITION),
+        number=None,
+        scale_units=enum_field(UNIT),
+        horizontal_scan_sampling_rate=SHARED_FIELD,
+        vertical_scan_sampling_rate=SHARED_FIELD,
+        horizontal_image_sampling_rate=SHARED_FIELD,
+        vertical_image_sampling_rate=SHARED_FIELD,
+        image_compression_algo=enum_field(COMPRESSION),
+        impression_type=enum_field(IMPRESSION),
+        bit_depth=None,
+        horizontal_line_length=SHARED_FIELD,
+        vertical_line_length=SHARED_FIELD,
+        image_data_length=None,
+        )
+    __slots__ = tuple(_fields)
+
+# General header (§8.2)
+_GENERAL_HEADER = Layout(
+    ('magic', '4s'),
+    ('version', '4s'),
+    ('length', 'I'),
+    ('nb_representation', 'H'),
+    ('certification_flag', '?'),
+    ('nb_position', 'B'),
+    )
+
+# Table 2: representation header, up to the number of quality records
+_CAPTURE = Layout(
+    ('year', 'H'),
+    ('month', 'B'),
+    ('day', 'B'),
+    ('hour', 'B'),
+    ('minute', 'B'),
+    ('second', 'B'),
+    ('millisecond', 'H'),
+    ('capture_device_technology_id', 's'),
+    ('capture_device_vendor_id', '2s'),
+    ('capture_device_type_id', '2s'),
+    ('nb_quality_records', 'B'),
+    )
+_LENGTH = Layout(('length', 'I'))
+_REPRESENTATION = Layout(*_LENGTH.fields, *_CAPTURE.fields)
+_QUALITY_RECORD = Layout(
+    ('score', 'B'),
+    ('algo_vendor_id', '2s'),
+    ('algo_id', '2s'),
+    )
+_NB_CERTIFICATION_RECORDS = Layout(('nb_certification_records', 'B'))
+_CERTIFICATION_RECORD = Layout(
+    ('authority_id', '2s'),
+    ('scheme_id', 's'),
+    )
+# Table 2: representation header, after the certification records
+_IMAGE = Layout(
+    ('position', 'B'),
+    ('number', 'B'),
+    ('scale_units', 'B'),
+    ('horizontal_scan_sampling_rate', 'H'),
+    ('vertical_scan_sampling_rate', 'H'),
+    ('horizontal_image_sampling_rate', 'H'),
+    ('vertical_image_sampling_rate', 'H'),
+    ('bit_depth', 'B'),
+    ('image_compression_algo', 'B'),
+    ('impression_type', 'B'),
+    ('horizontal_line_length', 'H'),
+    ('vertical_line_length', 'H'),
+    ('image_data_length', 'I'),
+    )
+
+#------------------------------------------------------------------------------
+#
+# Bit packed image data (RAW_PACKED)
+#
+#------------------------------------------------------------------------------
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("RAW_PACKED image data requires NumPy") from None
+    return numpy
+
+def _unpack_bits(data, bit_depth, width):
+    # Unpack the lines of bit packed pixels (a 2D array of bytes, most significant
+    # bit first) to a 2D array of pixel values. Each group of bit_depth bytes holds
+    # 8 pixels, each pixel is extracted from a 16 bits window on its group
+    numpy = _numpy()
+    lines, size = data.shape
+    groups = -(-size // bit_depth)
+    packed = numpy.zeros((lines, groups, bit_depth + 1), numpy.uint16)
+    padded = numpy.zeros((lines, groups * bit_depth), numpy.uint8)
+    padded[:, :size] = data
+    packed[..., :bit_depth] = padded.reshape(lines, groups, bit_depth)
+    pixels = numpy.empty((lines, groups, 8), numpy.uint8)
+    mask = (1 << bit_depth) - 1
+    for i in range(8):
+        byte, shift = divmod(i * bit_depth, 8)
+        window = (packed[..., byte] << 8) | packed[..., byte + 1]
+        pixels[..., i] = (window >> (16 - bit_depth - shift)) & mask
+    return pixels.reshape(lines, groups * 8)[:, :width]
+
+def _pack_bits(pixels, bit_depth):
+    # Reverse of _unpack_bits, return a 2D array of bytes
+    numpy = _numpy()
+    lines, width = pixels.shape
+    groups = -(-width // 8)
+    values = numpy.zeros((lines, groups * 8), numpy.uint16)
+    values[:, :width] = pixels
+    values = values.reshape(lines, groups, 8)
+    packed = numpy.zeros((lines, groups, bit_depth + 1), numpy.uint16)
+    for i in range(8):
+        byte, shift = divmod(i * bit_depth, 8)
+        window = values[..., i] << (16 - bit_depth - shift)
+        packed[..., byte] |= window >> 8
+        packed[..., byte + 1] |= window & 0xff
+    data = packed[..., :bit_depth].astype(numpy.uint8).reshape(lines, groups * bit_depth)
+    return data[:, :-(-width * bit_depth // 8)]
+
+def _unpack(data, bit_depth, width, height):
+    # Return the 8 bits pixels (scaled to 0-255) of bit packed image data, as bytes.
+    # The pixels are packed either without padding or with each line starting on a
+    # byte boundary (found from the length of the data)
+    numpy = _numpy()
+    data = numpy.frombuffer(data, numpy.uint8)
+    count = width * height
+    line = -(-width * bit_depth // 8)
+    if len(data) < line * height:
+        size = -(-count * bit_depth // 8)
+        if len(data) < size:
+            raise OSError("image file is truncated")
+        pixels = _unpack_bits(data[:size].reshape(1, size), bit_depth, count)
+    else:
+        pixels = _unpack_bits(data[:line * height].reshape(height, line), bit_depth, width)
+    scale = (numpy.arange(1 << bit_depth) * 255 // ((1 << bit_depth) - 1)).astype(numpy.uint8)
+    return scale[pixels].tobytes()
+
+def _pack(im, bit_depth):
+    # Return the bit packed image data (without line padding) of an image
+    numpy = _numpy()
+    pixels = numpy.asarray(im.convert("L")).reshape(1, -1) >> (8 - bit_depth)
+    return _pack_bits(pixels, bit_depth).tobytes()
+
+class _PackedDecoder(ImageFile.PyDecoder):
+    """Decoder of the RAW_PACKED image data, arguments: bit depth and data length"""
+
+    _pulls_fd = True
+
+    def decode(self, buffer):
+        bit_depth, length = self.args
+        data = self.fd.read(length)
+        self.set_as_raw(_unpack(data, bit_depth, self.state.xsize, self.state.ysize), "L")
+        return -1, 0
+
+#------------------------------------------------------------------------------
+#
+# PNG image data
+#
+#------------------------------------------------------------------------------
+
+#: Options of the Pillow PNG encoder of the ``png_preset`` save option
+PNG_PRESETS = {
+    'fast': dict(optimize=False, compress_level=1),
+    'default': dict(optimize=False, compress_level=6),
+    'compact': dict(optimize=True, compress_level=9),
 }
 
+class _PngDecoder(ImageFile.PyDecoder):
+    """Decoder of the PNG image data, argument: data length"""
+
+    _pulls_fd = True
+
+    def decode(self, buffer):
+        import PIL.PngImagePlugin
+        (length,) = self.args
+        with PIL.PngImagePlugin.PngImageFile(io.BytesIO(self.fd.read(length))) as im:
+            if im.size != (self.state.xsize, self.state.ysize):
+                raise OSError("PNG image size %dx%d does not match the header" % im.size)
+            self.set_as_raw(im.convert(self.mode).tobytes())
+        return -1, 0
+
 #------------------------------------------------------------------------------
 #
 # Type 4 Images (fingerprint and palmprint)
@@ -294,195 +537,240 @@ UNIT = {
 def _accept(prefix):
     return prefix[:4] == b"FIR\x00"
 
-class FIRImageFile(ImageFile.ImageFile):
+class FIRImageFile(ISO19794ImageFile):
 
     format = "FIR"
     format_description = "ISO19794-4 image (fingerprint image)"
-    _close_exclusive_fp_after_loading = False
 
     def _open(self):
+        if self._open_cached():
+            return
         # General header (§8.2)
-        header = self.fp.read(16)
-        if header[:4] != b"FIR\x00":
-            raise SyntaxError("not a ISO19794-4 file")
-
-        if header[4:8] != b"020\x00":
-            raise SyntaxError("Invalid version for a ISO19794-4 file")
-
-        # Big Endian (§6.1)
-        self.info['version'],length,self.info['nb_representation'],self.info['certification_flag'],self.info['nb_position'] = \
-            struct.unpack(">4sIH?B",header[4:])
-
-        # setup frame pointers
-        self.__first = self.__next = 16     # skip the general header
-        self.__frame = -1
-        self.__fp = self.fp
-        self._frame_pos = []
-        self.n_frames = self.info['nb_representation']
+        start = hooks.start()
+        self.info.update(_read_general_header(self.fp))
+        hooks.report(start, 'general_header', self.format, '020', None, None, _GENERAL_HEADER.size)
 
-        self._rheaders = []
+        self._open_frames(16, self.info['nb_representation'])     # skip the general header
 
-        self._seek(0)
+    def _codec(self, ns):
+        return COMPRESSION.names[ns.image_compression_algo]
 
-    def load_end(self):
-        # allow closing if we're on the first frame, there's no next
-        if self.__frame == 0 and not self.__next:
-            self._close_exclusive_fp_after_loading = True
-
-    def seek(self, frame):
-        "Select a given frame as current image"
-        if not self._seek_check(frame):
-            return
-        self._seek(frame)
-        # Create a new core image object on second and
-        # subsequent frames in the image. Image may be
-        # different size/mode.
-        Image._decompression_bomb_check(self.size)
-        self.im = Image.core.new(self.mode, self.size)
-
-    def __del__(self):
-        if self.__fp and self._exclusive_fp:
-            self.__fp.close()
-            self.__fp = None
-        elif self.fp and self._exclusive_fp:
-            self.fp.close()
-            self.fp = None
-
-    def _seek_check(self, frame):
-        if (frame < self._min_frame or
-            frame >= self.n_frames+self._min_frame):
-            raise EOFError("attempt to seek outside sequence")
-
-        return self.tell() != frame
-
-    def _seek(self, frame):
-        # save rheader in case it has been modified
-        if self.__frame>=0 and hasattr(self,"header"):
-            self._rheaders[self.__frame] = self.header
-        self.fp = self.__fp
-        while len(self._frame_pos) <= frame:
-            if not self.__next:
-                raise EOFError("no more images in FIR file")
-            # reset python3 buffered io handle in case fp
-            # was passed to a libxxx, invalidating the buffer
-            self.fp.tell()
-            self.fp.seek(self.__next)
-            self._frame_pos.append(self.__next)
-            rheader,offset,ns = self.read_header()
-            self._rheaders.append(rheader)
-            self.__next = self._frame_pos[frame] + ns.length
-            self.__frame += 1
-        self.fp.seek(self._frame_pos[frame])
-        rheader,offset,ns = self.read_header()
-        self.header = self._rheaders[frame]
-        self.__next = self._frame_pos[frame] + ns.length
-        self.__frame = frame
-
-        if ns.bit_depth==8:
-            self.mode = "L"
-        try:
-            self.size = (ns.horizontal_line_length,ns.vertical_line_length)
-        except AttributeError:
-            # Support Pillow >= 5.3.0
-            self._size = (ns.horizontal_line_length,ns.vertical_line_length)
+    def _frame_tile(self, frame, header, offset, ns):
+        mode = "L" if ns.bit_depth==8 else self.mode
+        size = (ns.horizontal_line_length,ns.vertical_line_length)
 
         # data descriptor
         # Select decoder: RAW, RAW_PACKED, WSQ, JPEG, JPEG2000_LOSSY, JPEG2000_LOSSLESS, PNG
-        if rheader['image_compression_algo']=="RAW" or rheader['image_compression_algo']=="RAW_PACKED":
-            self.tile = [
-                ('raw', (0, 0) + self.size, self._frame_pos[frame]+offset, (self.mode, 0, 1))
+        # (from the file, the header may have been modified)
+        compression = self._codec(ns)
+        pos = self._frame_offset(frame)+offset
+        if compression=="RAW_PACKED" and ns.bit_depth<8:
+            mode = "L"
+            tile = [
+                ('fir_packed', (0, 0) + size, pos, (ns.bit_depth, ns.length-offset))
             ]
-        elif rheader['image_compression_algo']=="WSQ":
-            self.tile = [
-                ('wsq', (0, 0) + self.size, self._frame_pos[frame]+offset, (12,))
+        elif compression=="RAW" or compression=="RAW_PACKED":
+            tile = [
+                ('raw', (0, 0) + size, pos, (mode, 0, 1))
             ]
-        elif rheader['image_compression_algo']=="JPEG":
-            self.tile = [
-                ('jpeg', (0, 0) + self.size, self._frame_pos[frame]+offset, (self.mode,self.mode,1,0))
+        elif compression=="WSQ":
+            mode = "L"
+            tile = [
+                ('wsq', (0, 0) + size, pos, (ns.length-offset,))
             ]
-        elif rheader['image_compression_algo']=="JPEG2000_LOSSY" or rheader['image_compression_algo']=="JPEG2000_LOSSLESS":
-            sig = self.fp.read(4)
-            codec = None
-            if sig == b"\xff\x4f\xff\x51":
-                codec = "j2k"
-            else:
-                sig = sig + self.fp.read(8)
-
-                if sig == b"\x00\x00\x00\x0cjP  \x0d\x0a\x87\x0a":
-                    codec = "jp2"
-            if codec is None:
-                raise SyntaxError("not a JPEG 2000 image")
-            self.tile = [
-                ('jpeg2k', (0, 0) + self.size, self._frame_pos[frame]+offset, (codec,))
+        elif compression=="PNG":
+            tile = [
+                ('fir_png', (0, 0) + size, pos, (ns.length-offset,))
+            ]
+        elif compression=="JPEG":
+            tile = [
+                ('jpeg', (0, 0) + size, pos, (mode,mode,1,0))
+            ]
+        elif compression=="JPEG2000_LOSSY" or compression=="JPEG2000_LOSSLESS":
+            tile = [
+                ('jpeg2k', (0, 0) + size, pos, (self._jpeg2k_codec(pos),))
             ]
         else:
-            raise SyntaxError("Unknown compression algo "+rheader.image_compression_algo)
-
+            raise SyntaxError("Unknown compression algo "+compression)
+        return mode, size, tile
 
-    def tell(self):
-        "Return the current frame number"
-        return self.__frame
-
-    def read_header(self):
+    def read_header(self, fp=None):
         # Reader representation header starting at current position
         # return a namedtuple
-        nb = 0
-        # Temporary namespace used during the analysis of the header
-        ns = types.SimpleNamespace()
-
-        ns.length,ns.capture_datetime,ns.capture_device_technology_id,ns.capture_device_vendor_id,ns.capture_device_type_id,q_length = \
-            struct.unpack(">I9ss2s2sB",self.fp.read(19))
-        # XXX micro or milli seconds?
-        ns.capture_datetime = datetime.datetime( *struct.unpack(">HBBBBBH",ns.capture_datetime) )
-        nb += 19
-        Q = []
-        for i in range(q_length):
-            Q.append( FIRQualityRecord._make( struct.unpack(">B2s2s",self.fp.read(5)) ) )
-            nb += 5
-        ns.quality_records = Q
-
-        C = []
-        if self.info['certification_flag']:
-            (c_length,) = struct.unpack(">B",self.fp.read(1))
-            nb += 1
-            for i in range(c_length):
-                C.append( FIRCertificationRecord._make( struct.unpack(">2s1s",self.fp.read(3)) ) )
-                nb += 3
-        ns.certification_records = C
-
-        ns.position,ns.number,ns.scale_units,ns.horizontal_scan_sampling_rate,ns.vertical_scan_sampling_rate, \
-        ns.horizontal_image_sampling_rate,ns.vertical_image_sampling_rate,ns.bit_depth,ns.image_compression_algo, \
-        ns.impression_type,ns.horizontal_line_length,ns.vertical_line_length,ns.image_data_length = \
-            struct.unpack(">BBBHHHHBBBHHI",self.fp.read(22))
-        nb += 22
-
-        # Buid the namedtuple and convert part of it
-        nt = dict (
-            capture_datetime=ns.capture_datetime,
-            capture_device_technology_id=ns.capture_device_technology_id,
-            capture_device_vendor_id=ns.capture_device_vendor_id,
-            capture_device_type_id=ns.capture_device_type_id,
-            quality_records=ns.quality_records,
-            certification_records=ns.certification_records,
-            position={v: k for k, v in POSITION.items()}[ns.position],
-            number=ns.number,
-            scale_units={v: k for k, v in UNIT.items()}[ns.scale_units],
-            horizontal_scan_sampling_rate=ns.horizontal_scan_sampling_rate,
-            vertical_scan_sampling_rate=ns.vertical_scan_sampling_rate,
-            horizontal_image_sampling_rate=ns.horizontal_image_sampling_rate,
-            vertical_image_sampling_rate=ns.vertical_image_sampling_rate,
-            image_compression_algo={v: k for k, v in COMPRESSION.items()}[ns.image_compression_algo],
-            impression_type={v: k for k, v in IMPRESSION.items()}[ns.impression_type],
+        return _read_header(fp or self.fp, self.info, self.compact_headers)
+
+    def frame_array(self, frame=None):
+        """Return the pixels of a frame (by default the current frame) as a NumPy array
+
+        The shape of the array is ``(vertical_line_length, horizontal_line_length)``.
+        The 8 bits ``RAW`` frames are not decoded: the array is a read-only view
+        on the image data, on the mapped file when ``use_mmap`` is set (without
+        any copy). The other frames are decoded. The current frame is not changed.
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError("frame_array() requires NumPy") from None
+        if frame is None:
+            frame = self.tell()
+        header,offset,ns = self._frame_header(frame)
+        width, height = ns.horizontal_line_length, ns.vertical_line_length
+        if self._codec(ns) == "RAW" and ns.bit_depth == 8:
+            data = self.image_data(frame)
+            if len(data) < width * height:
+                raise OSError("image file is truncated")
+            return numpy.frombuffer(data, numpy.uint8, width * height).reshape(height, width)
+        header, args = self._frame_job(frame)
+        return numpy.asarray(_decode_frame(*args))
+
+def _read_general_header(fp):
+    # Read the general header (§8.2) and return the info dictionary
+    magic,version,length,nb_representation,certification_flag,nb_position = \
+        _GENERAL_HEADER.unpack(fp.read(_GENERAL_HEADER.size))
+    if magic != b"FIR\x00":
+        raise SyntaxError("not a ISO19794-4 file")
+
+    if version != b"020\x00":
+        raise SyntaxError("Invalid version for a ISO19794-4 file")
+
+    # Big Endian (§6.1)
+    return dict(
+        version=version,
+        nb_representation=nb_representation,
+        certification_flag=certification_flag,
+        nb_position=nb_position,
+        )
+
+def _read_values(fp, info):
+    # Read the representation header starting at the current position of fp
+    # return its size and the raw values
+    # Temporary namespace used during the analysis of the header
+    ns = types.SimpleNamespace()
+
+    nb = _REPRESENTATION.read(fp, ns)
+    # XXX micro or milli seconds?
+    ns.capture_datetime = datetime.datetime(ns.year,ns.month,ns.day,ns.hour,ns.minute,ns.second,ns.millisecond)
+    ns.quality_records = _QUALITY_RECORD.read_records(fp, ns.nb_quality_records, FIRQualityRecord)
+    nb += ns.nb_quality_records * _QUALITY_RECORD.size
+
+    ns.certification_records = []
+    if info['certification_flag']:
+        nb += _NB_CERTIFICATION_RECORDS.read(fp, ns)
+        ns.certification_records = _CERTIFICATION_RECORD.read_records(fp, ns.nb_certification_records, FIRCertificationRecord)
+        nb += ns.nb_certification_records * _CERTIFICATION_RECORD.size
+
+    nb += _IMAGE.read(fp, ns)
+    return nb,ns
+
+def _compact_codes(ns):
+    # Return the codes of the fields of a FIRHeader
+    return dict(
+        capture_datetime=ns.capture_datetime,
+        capture_device_technology_id=ns.capture_device_technology_id,
+        capture_device_vendor_id=int.from_bytes(ns.capture_device_vendor_id,'big'),
+        capture_device_type_id=int.from_bytes(ns.capture_device_type_id,'big'),
+        quality_records=tuple(ns.quality_records),
+        certification_records=tuple(ns.certification_records),
+        position=ns.position,
+        number=ns.number,
+        scale_units=ns.scale_units,
+        horizontal_scan_sampling_rate=shared(ns.horizontal_scan_sampling_rate),
+        vertical_scan_sampling_rate=shared(ns.vertical_scan_sampling_rate),
+        horizontal_image_sampling_rate=shared(ns.horizontal_image_sampling_rate),
+        vertical_image_sampling_rate=shared(ns.vertical_image_sampling_rate),
+        image_compression_algo=ns.image_compression_algo,
+        impression_type=ns.impression_type,
+        )
+
+def _read_header(fp, info, compact=False):
+    # Read the representation header starting at the current position of fp
+    # return the header (a FIRHeader if compact), its size and the raw values
+    nb,ns = _read_values(fp, info)
+
+    if compact:
+        return FIRHeader.from_codes(**_compact_codes(ns)),nb,ns
+
+    # Buid the namedtuple and convert part of it
+    nt = dict (
+        capture_datetime=ns.capture_datetime,
+        capture_device_technology_id=ns.capture_device_technology_id,
+        capture_device_vendor_id=ns.capture_device_vendor_id,
+        capture_device_type_id=ns.capture_device_type_id,
+        quality_records=ns.quality_records,
+        certification_records=ns.certification_records,
+        position=POSITION.names[ns.position],
+        number=ns.number,
+        scale_units=UNIT.names[ns.scale_units],
+        horizontal_scan_sampling_rate=ns.horizontal_scan_sampling_rate,
+        vertical_scan_sampling_rate=ns.vertical_scan_sampling_rate,
+        horizontal_image_sampling_rate=ns.horizontal_image_sampling_rate,
+        vertical_image_sampling_rate=ns.vertical_image_sampling_rate,
+        image_compression_algo=COMPRESSION.names[ns.image_compression_algo],
+        impression_type=IMPRESSION.names[ns.impression_type],
+        )
+    return nt,nb,ns
+
+def _scanned_header(info, compact, data):
+    # Decode a representation header read by scan(): return the dictionary
+    # header, or the codes of the FIRHeader if compact
+    if compact:
+        nb,ns = _read_values(io.BytesIO(data), info)
+        header = _compact_codes(ns)
+        header.update(
+            horizontal_line_length=shared(ns.horizontal_line_length),
+            vertical_line_length=shared(ns.vertical_line_length),
+            )
+    else:
+        header,nb,ns = _read_header(io.BytesIO(data), info)
+        header.update(
+            horizontal_line_length=ns.horizontal_line_length,
+            vertical_line_length=ns.vertical_line_length,
             )
-        return nt,nb,ns
+    header.update(
+        bit_depth=ns.bit_depth,
+        image_data_length=ns.image_data_length,
+        )
+    return header
+
+def scan(fp, compact=False):
+    """Read the general header and all the representation headers of an image
+
+    The representations are walked using their length only, the image data is never
+    read nor decoded. Return the ``info`` dictionary and a list of representation
+    headers, with the ``bit_depth``, ``horizontal_line_length``,
+    ``vertical_line_length`` and ``image_data_length`` fields added. If ``compact``
+    is true, the headers are :py:class:`FIRHeader` objects instead of dictionaries.
+    Only the bytes of the headers are read, they are decoded when first accessed.
+    """
+    start = fp.tell()
+    info = _read_general_header(fp)
+    decode = functools.partial(_scanned_header, info, compact)
+    lazy = FIRHeader.lazy if compact else LazyHeader
+    certification = info['certification_flag']
+    headers = []
+    pos = start + 16    # skip the general header
+    for i in range(info['nb_representation']):
+        fp.seek(pos)
+        # length and number of quality records, then the rest of the header
+        data = fp.read(_REPRESENTATION.size)
+        length, = _LENGTH.struct.unpack_from(data)
+        size = len(data) + _QUALITY_RECORD.size * data[-1]
+        if certification:
+            data += fp.read(size + 1 - len(data))
+            size = len(data) + _CERTIFICATION_RECORD.size * data[-1]
+        size += _IMAGE.size
+        data += fp.read(size - len(data))
+        if len(data) < size:
+            raise EOFError("truncated representation header")
+        headers.append(lazy(data, decode))
+        pos += length
+    return info, headers
 
 #
 # Save operations
 #
-import PIL.JpegImagePlugin
-import PIL.Jpeg2KImagePlugin
-def _save_frame(im,fp,cert_flag):
-    # Return bytes for one frame
+def _encode_image_data(im):
+    # Return the compressed image data and the bit depth of an image
     try:
         info = im.encoderinfo
     except:
@@ -502,49 +790,95 @@ def _save_frame(im,fp,cert_flag):
         bit_depth = 8
         ImageFile._save(im, image_data, [encoder])
     elif ns['image_compression_algo']=="RAW_PACKED":
-        im.encoderconfig  ()
-        encoder = ('raw', (0, 0) + im.size, 0, (im.mode, 0, 1))
-        bit_depth = 8
-        ImageFile._save(im, image_data, [encoder])
+        bit_depth = info.get('bit_depth', 1 if im.mode == '1' else 8)
+        if not 1 <= bit_depth <= 8:
+            raise ValueError("Invalid bit depth for RAW_PACKED: %r" % bit_depth)
+        if bit_depth == 8:
+            im.encoderconfig = ()
+            ImageFile._save(im, image_data, [('raw', (0, 0) + im.size, 0, ('L', 0, 1))])
+        else:
+            image_data.write(_pack(im, bit_depth))
     elif ns['image_compression_algo']=="WSQ":
-        im.encoderconfig  ()
-        encoder = ('wsq', (0, 0) + im.size, 0, (12,))
+        from . import wsq
+        image_data.write(wsq.encode(im.convert("L"), info.get('wsq_bitrate', 0.75)))
         bit_depth = 8
-        ImageFile._save(im, image_data, [encoder])
     elif ns['image_compression_algo']=="JPEG":
         info['quality'] = 'maximum'
         info['dpi'] = (im.header.get('horizontal_image_sampling_rate',500),im.header.get('vertical_image_sampling_rate',500))
+        import PIL.JpegImagePlugin
         PIL.JpegImagePlugin._save(im, image_data, "")
     elif ns['image_compression_algo']=="JPEG2000_LOSSY":
-        info['quality_mode'] = "rates"
-        info['quality_layers'] = (15,)
-        # XXX parameters needed? (up to 15 compression max according to the specs)
-        PIL.Jpeg2KImagePlugin._save(im, image_data, "non.j2k")
+        # up to 15:1 according to the specs
+        _save_jpeg2k(im, image_data, dict(quality_mode="rates", quality_layers=(15,)), lossless=False)
     elif ns['image_compression_algo']=="JPEG2000_LOSSLESS":
-        info['quality_mode'] = "rates"
-        info['quality_layers'] = (0,)
-        # XXX parameters needed? (up to 15 compression max according to the specs)
-        PIL.Jpeg2KImagePlugin._save(im, image_data, "non.j2k")
+        _save_jpeg2k(im, image_data, dict(quality_mode="rates", quality_layers=(0,)), lossless=True)
+    elif ns['image_compression_algo']=="PNG":
+        preset = info.get('png_preset', 'default')
+        if preset not in PNG_PRESETS:
+            raise ValueError("Unknown PNG preset: %r" % preset)
+        # the options given explicitly override the preset
+        for key, value in PNG_PRESETS[preset].items():
+            info.setdefault(key, value)
+        import PIL.PngImagePlugin
+        PIL.PngImagePlugin._save(im, image_data, "")
     else:
         raise SyntaxError("Unknown compression algo "+ns['image_compression_algo'])
-    image_data = image_data.getvalue()
-
+    return image_data.getvalue(), bit_depth
+
+def _encode_job(im, header, encoderinfo, frame):
+    # Encode an image in a worker of an executor, return the image data and
+    # the encode event
+    im.header = header
+    im.encoderinfo = encoderinfo
+    return _encode_frame(im, frame, True)
+
+def _encode_frame(im, frame, always=False):
+    # Encode an image, return the image data and the encode event (None if
+    # there is no observer and always is false)
+    start = hooks.start(always)
+    encoded = _encode_image_data(im)
+    return encoded, hooks.event(start, 'encode', 'FIR', '020', frame, im.header.get('image_compression_algo','RAW'), len(encoded[0]))
+
+def _original_image_data(im):
+    # Return the image data and the bit depth read from the file, if the frame
+    # can be saved without encoding it again, None otherwise
+    if not isinstance(im, FIRImageFile) or _reencode(getattr(im, 'encoderinfo', {})):
+        return None
+    original = im._unmodified_image_data(im.header['image_compression_algo'])
+    if original is None:
+        return None
+    image_data,ns = original
+    return image_data,ns.bit_depth
+
+def _save_frame(im,fp,cert_flag,frame=0,encoded=None):
+    # Write one frame and return its length
+    ns = im.header
+    if encoded is None:
+        # Keep the image data if neither the pixels nor the compression changed
+        encoded = _original_image_data(im)
+        if encoded is None:
+            encoded, event = _encode_frame(im, frame)
+            hooks.emit(event)
+    image_data,bit_depth = encoded
+
+    start = hooks.start()
     dt = ns.get('capture_datetime',datetime.datetime.now())
-    rheader = b''
-    rheader += struct.pack(">HBBBBBH",dt.year,dt.month,dt.day,dt.hour,dt.minute,dt.second,int(dt.microsecond/1000))
-    rheader += struct.pack(">s2s2sB",
+    quality_records = ns.get('quality_records',[])
+    rheader = _CAPTURE.pack(
+        dt.year,dt.month,dt.day,dt.hour,dt.minute,dt.second,int(dt.microsecond/1000),
         ns.get('capture_device_technology_id',b'\x00'),
         ns.get('capture_device_vendor_id',b'\x00\x00'),
         ns.get('capture_device_type_id',b'\x00\x00'),
-        len(ns.get('quality_records',[])) )
-    for q in ns.get('quality_records',[]):
-        rheader += struct.pack(">B2s2s",q.score,q.algo_vendor_id,q.algo_id)
+        len(quality_records) )
+    for q in quality_records:
+        rheader += _QUALITY_RECORD.pack(q.score,q.algo_vendor_id,q.algo_id)
     if cert_flag:
-        rheader += struct.pack(">B",len(ns.get('certification_records',[])))
-        for c in ns.get('certification_records',[]):
-            rheader += struct.pack(">2s1s",c.authority_id,c.scheme_id)
+        certification_records = ns.get('certification_records',[])
+        rheader += _NB_CERTIFICATION_RECORDS.pack(len(certification_records))
+        for c in certification_records:
+            rheader += _CERTIFICATION_RECORD.pack(c.authority_id,c.scheme_id)
 
-    rheader += struct.pack(">BBBHHHHBBBHHI",
+    rheader += _IMAGE.pack(
         POSITION[ns.get('position','UNKNOWN')],
         ns['number'],
         UNIT[ns.get('scale_units','PPI')],
@@ -559,26 +893,26 @@ def _save_frame(im,fp,cert_flag):
         im.size[1],
         len(image_data)
     )
+    compression = ns.get('image_compression_algo','RAW')
+    hooks.report(start, 'header', 'FIR', '020', frame, compression, len(rheader))
 
     # Write the frame
-    fp.write(struct.pack(">I",4+len(rheader)+len(image_data)))
+    start = hooks.start()
+    length = 4+len(rheader)+len(image_data)
+    fp.write(_LENGTH.pack(length))
     fp.write(rheader)
     fp.write(image_data)
+    hooks.report(start, 'write', 'FIR', '020', frame, compression, length)
+    return length
 
 
 def _save(im, fp, filename):
-
-    fr = io.BytesIO()
     im.header.setdefault('number',0)
-    _save_frame(im,fr,len(im.header.get('certification_records',[]))>0)
-    fr_data = fr.getvalue()
+    cert_flag = len(im.header.get('certification_records',[]))>0
 
-    # Write the general header
-    fp.write(b"FIR\x00")
-    fp.write(struct.pack(">4sIH?B", b"020\x00",16+len(fr_data),1,len(im.header.get('certification_records',[]))>0,1))
-
-    # Write the frame
-    fp.write(fr_data)
+    _write_record(fp, _GENERAL_HEADER.size,
+        lambda fp, length: fp.write(_GENERAL_HEADER.pack(b"FIR\x00", b"020\x00",length,1,cert_flag,1)),
+        lambda fp: _save_frame(im,fp,cert_flag))
 
 def _save_all(im, fp, filename):
     encoderinfo = im.encoderinfo.copy()
@@ -601,29 +935,30 @@ def _save_all(im, fp, filename):
     cert_flag = False
     # Count number of position
     positions = set()
+    nb_frames = 0
     for frame in frames(images):
         if len(frame.header.get('certification_records',[]))>0:
             cert_flag = True
         positions.add(frame.header.get('position','UNKNOWN'))
-
-    # Generate the frames
-    frames_buffers = []
-    length = 0
-    frame_number = 0
-    for frame in frames(images):
-        fr = io.BytesIO()
-        frame.header.setdefault('number',frame_number)
-        frame_number += 1
-        _save_frame(frame,fr,cert_flag)
-        frames_buffers.append( fr.getvalue() )
-        length += len(frames_buffers[-1])
-
-    # Write the general header
-    fp.write(b"FIR\x00")
-    fp.write(struct.pack(">4sIH?B", b"020\x00",16+length,len(frames_buffers),cert_flag,len(positions)))
-
-    for buf in frames_buffers:
-        fp.write(buf)
+        nb_frames += 1
+
+    def numbered_frames():
+        frame_number = 0
+        for frame in frames(images):
+            frame.header.setdefault('number',frame_number)
+            frame_number += 1
+            yield frame
+
+    # Generate the frames, written as soon as encoded
+    def write_frames(fp):
+        length = 0
+        for index,(frame,encoded) in enumerate(_encode_frames(numbered_frames(),encoderinfo,_original_image_data,_encode_job)):
+            length += _save_frame(frame,fp,cert_flag,index,encoded)
+        return length
+
+    _write_record(fp, _GENERAL_HEADER.size,
+        lambda fp, length: fp.write(_GENERAL_HEADER.pack(b"FIR\x00", b"020\x00",length,nb_frames,cert_flag,len(positions))),
+        write_frames)
 
 def _debug(image):
     print('Info'+str(image.info))
@@ -631,15 +966,6 @@ def _debug(image):
         image.seek(i)
         print("Frame #%d: mode: %s size=%dx%d" % (i,image.mode, image.size[0], image.size[1]))
         print("\tHeader: ",image.header)
-#
-# Registration
-#
-Image.register_open(FIRImageFile.format, FIRImageFile, _accept)
-Image.register_save(FIRImageFile.format, _save)
-Image.register_save_all(FIRImageFile.format, _save_all)
-
-Image.register_extension(FIRImageFile.format, ".fir")
-Image.register_mime(FIRImageFile.format, "image/fir")
 
 
 if __name__ == "__main__":
@@ -1,8 +1,92 @@
-
 __version__ = '0.2.0'
 __author__ = "Olivier Heurtier"
 __copyright__ = "IDEMIA"
 __license__ = "CeCILL-C"
 
-from . import FIR
-from . import FAC
+import io
+import os
+import sys
+import importlib
+from collections import namedtuple
+
+from PIL import Image
+
+# Format modules, imported the first time a file of the format is opened or saved
+_MODULES = {
+    'FIR': b"FIR\x00",
+    'FAC': b"FAC\x00",
+}
+
+def _module(format):
+    module = sys.modules.get(__name__ + '.' + format)
+    if module is None:
+        module = importlib.import_module('.' + format, __name__)
+    return module
+
+def __getattr__(name):
+    # Give access to iso19794.FIR and iso19794.FAC without importing them first
+    if name in _MODULES:
+        return _module(name)
+    if name == 'headers_to_numpy':
+        return _module('arrays').headers_to_numpy
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+#
+# Registration
+#
+def _register(format, extension, mime):
+    magic = _MODULES[format]
+
+    def accept(prefix):
+        return prefix[:4] == magic
+
+    def open(fp, filename=None):
+        return getattr(_module(format), format + 'ImageFile')(fp, filename)
+
+    def save(im, fp, filename):
+        return _module(format)._save(im, fp, filename)
+
+    def save_all(im, fp, filename):
+        return _module(format)._save_all(im, fp, filename)
+
+    Image.register_open(format, open, accept)
+    Image.register_save(format, save)
+    Image.register_save_all(format, save_all)
+
+    Image.register_extension(format, extension)
+    Image.register_mime(format, mime)
+
+_register('FIR', ".fir", "image/fir")
+_register('FAC', ".fac", "image/fac")
+
+# Result of a scan: the format ('FIR' or 'FAC'), the general header and the
+# list of representation headers
+ScanResult = namedtuple('ScanResult',[
+    'format',
+    'info',
+    'headers'])
+
+def scan(fp, compact=False):
+    """Read the headers of an ISO 19794 file without decoding any image
+
+    ``fp`` is a filename, a file object or a bytes-like object. The general
+    header and all the representation headers are read, the image data are
+    skipped using the representation lengths. No Pillow image is created.
+    The representation headers are mappings decoded when first accessed. If
+    ``compact`` is true, they are compact objects (``FIRHeader`` or ``FACHeader``)
+    instead of dictionaries.
+    """
+    if isinstance(fp, (bytes, bytearray, memoryview)):
+        fp = io.BytesIO(fp)
+    elif isinstance(fp, (str, os.PathLike)):
+        with open(fp, "rb") as f:
+            return scan(f, compact)
+
+    start = fp.tell()
+    prefix = fp.read(4)
+    fp.seek(start)
+    for format, magic in _MODULES.items():
+        if prefix == magic:
+            info, headers = _module(format).scan(fp, compact)
+            return ScanResult(format, info, headers)
+    raise SyntaxError("not a ISO19794 file")
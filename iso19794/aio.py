@@ -0,0 +1,118 @@
+"""
+Asyncio interface.
+
+The coroutines of this module read ISO 19794 records without blocking the event
+loop. A source is a bytes-like object, a filename or an ``asyncio.StreamReader``:
+
+- a record read from a stream is received asynchronously, its general header
+  giving its length, then its headers are parsed in memory (without decoding any
+  image)
+- a file is read in an executor (the default executor of the loop if
+  ``executor`` is None), as asyncio has no asynchronous file access
+
+Decoding is CPU bound, :py:func:`load` and :py:func:`decode_all` decode in an
+executor. :py:func:`bounded_map` processes many records with a limited number of
+records in progress:
+
+.. code-block:: python
+
+    async def positions(filenames):
+        results = await aio.bounded_map(aio.scan, filenames, limit=100)
+        return [[h['position'] for h in result.headers] for result in results]
+"""
+
+import io
+import os
+import asyncio
+import functools
+
+from PIL import Image
+
+from . import scan as _scan, _MODULES
+from .record import Layout
+
+# Start of the general header of all the formats and versions
+_RECORD_START = Layout(
+    ('magic', '4s'),
+    ('version', '4s'),
+    ('length', 'I'),
+    )
+
+def _is_stream(source):
+    return hasattr(source, 'readexactly')
+
+async def _run(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+async def read_record(reader):
+    """Read a record from a ``StreamReader`` and return it as bytes
+
+    ``asyncio.IncompleteReadError`` is raised if the stream ends before the end
+    of the record.
+    """
+    start = await reader.readexactly(_RECORD_START.size)
+    magic, version, length = _RECORD_START.unpack(start)
+    if magic not in _MODULES.values() or length < _RECORD_START.size:
+        raise SyntaxError("not a ISO19794 file")
+    return start + await reader.readexactly(length - _RECORD_START.size)
+
+async def iter_records(reader):
+    "Asynchronous iterator on the records of a stream, up to the end of the stream"
+    while True:
+        try:
+            record = await read_record(reader)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return
+            raise
+        yield record
+
+async def scan(source, executor=None, compact=False):
+    "Asynchronous version of :py:func:`iso19794.scan`"
+    if _is_stream(source):
+        source = await read_record(source)
+    if isinstance(source, (str, os.PathLike)):
+        return await _run(executor, _scan, source, compact)
+    return _scan(source, compact)
+
+async def open(source, executor=None):
+    """Open an image (without decoding it) and return it
+
+    The general header and the representation header of the first frame are read.
+    """
+    if _is_stream(source):
+        source = await read_record(source)
+    if isinstance(source, (str, os.PathLike)):
+        return await _run(executor, Image.open, source)
+    return Image.open(io.BytesIO(source))
+
+async def load(im, executor=None):
+    "Decode the current frame of an image in an executor"
+    return await _run(executor, im.load)
+
+async def decode_all(im, executor=None):
+    "Decode all the frames of an image in an executor, see ``decode_all()``"
+    return await _run(executor, im.decode_all)
+
+async def bounded_map(func, items, limit=64):
+    """Await ``func(item)`` for each item, with at most ``limit`` calls in progress
+
+    Return the list of the results, in the order of the items. The items are
+    consumed as the calls progress. If a call raises an exception, the calls in
+    progress are cancelled and the exception is raised.
+    """
+    results = {}
+    items = enumerate(items)
+
+    async def worker():
+        for index, item in items:
+            results[index] = await func(item)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(limit)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for w in workers:
+            w.cancel()
+        raise
+    return [results[index] for index in range(len(results))]
@@ -0,0 +1,114 @@
+"""
+NumPy tables of the representation headers.
+
+:py:func:`headers_to_numpy` reads the headers of many files (without decoding
+any image) into a NumPy structured array, one row per representation, so that a
+corpus can be filtered and aggregated with vectorized operations::
+
+    table = iso19794.headers_to_numpy(filenames)
+    thumbs = table[(table['format'] == b'FIR') & (table['position'] == FIR.POSITION['RIGHT_THUMB'])]
+    files = [filenames[i] for i in numpy.unique(thumbs['file'])]
+
+The enumerated fields are given as their code, the ``Enum`` tables of the
+:py:mod:`iso19794.FIR` and :py:mod:`iso19794.FAC` modules give their names.
+NumPy is an optional dependency, only needed by this module.
+"""
+
+import struct
+
+from . import scan
+from .base import _version
+
+#: Fields of the rows. The FIR fields are 0 in the FAC rows and the FAC fields
+#: are 0 in the FIR rows, except ``compression`` (the ``image_data_type`` of a
+#: FAC representation) and the image size, common to both formats.
+FIELDS = [
+    ('file', 'u4'),
+    ('frame', 'u2'),
+    ('format', 'S3'),
+    ('version', 'S3'),
+    ('compression', 'u1'),
+    ('width', 'u2'),
+    ('height', 'u2'),
+    ('bit_depth', 'u1'),
+    ('image_data_length', 'u4'),
+    # FIR
+    ('position', 'u1'),
+    ('impression', 'u1'),
+    ('scale_units', 'u1'),
+    ('horizontal_scan_sampling_rate', 'u2'),
+    ('vertical_scan_sampling_rate', 'u2'),
+    ('horizontal_image_sampling_rate', 'u2'),
+    ('vertical_image_sampling_rate', 'u2'),
+    # FAC
+    ('gender', 'u1'),
+    ('eye_colour', 'u1'),
+    ('hair_colour', 'u1'),
+    ('property_mask', 'u4'),
+    ('expression', 'u2'),
+    ('pose_yaw', 'i1'),
+    ('pose_pitch', 'i1'),
+    ('pose_roll', 'i1'),
+    ('face_image_type', 'u1'),
+    ('source_type', 'u1'),
+    ('landmark_count', 'u2'),
+    ]
+
+# Number of rows converted to an array at once
+_CHUNK = 65536
+
+def _fir_row(file, frame, version, h):
+    return (file, frame, b'FIR', version, h.image_compression_algo,
+        h.horizontal_line_length, h.vertical_line_length, h.bit_depth, h.image_data_length,
+        h.position, h.impression_type, h.scale_units,
+        h.horizontal_scan_sampling_rate, h.vertical_scan_sampling_rate,
+        h.horizontal_image_sampling_rate, h.vertical_image_sampling_rate,
+        0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+def _fac_row(file, frame, version, h):
+    return (file, frame, b'FAC', version, h.image_data_type,
+        h.width, h.height, h.bit_depth, h.image_data_length,
+        0, 0, 0, 0, 0, 0, 0,
+        h.gender, h.eye_colour, h.hair_colour, h.property_mask,
+        int.from_bytes(h.expression, 'big'), h.pose_yaw, h.pose_pitch, h.pose_roll,
+        h.face_image_type, h.source_type, len(h.landmark_points))
+
+_ROWS = {
+    'FIR': _fir_row,
+    'FAC': _fac_row,
+    }
+
+def headers_to_numpy(sources, errors='strict'):
+    """Read the representation headers of files into a NumPy structured array
+
+    ``sources`` is an iterable of filenames, file objects or bytes-like objects,
+    read with :py:func:`iso19794.scan`. The array has one row per representation,
+    with the fields of :py:data:`FIELDS`: ``file`` is the index of the source in
+    ``sources`` and ``frame`` the index of the representation in the file. If
+    ``errors`` is ``'ignore'``, the sources which cannot be read are skipped
+    instead of raising an exception.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("headers_to_numpy() requires NumPy") from None
+    dtype = numpy.dtype(FIELDS)
+
+    chunks = []
+    rows = []
+    for file, source in enumerate(sources):
+        try:
+            result = scan(source, compact=True)
+            row = _ROWS[result.format]
+            version = _version(result.info).encode('ascii')
+            # the headers are decoded here
+            rows.extend([row(file, frame, version, header) for frame, header in enumerate(result.headers)])
+        except (SyntaxError, OSError, EOFError, ValueError, KeyError, struct.error):
+            if errors == 'ignore':
+                continue
+            raise
+        if len(rows) >= _CHUNK:
+            chunks.append(numpy.array(rows, dtype))
+            rows = []
+    chunks.append(numpy.array(rows, dtype))
+    return numpy.concatenate(chunks)
@@ -0,0 +1,732 @@
+"""
+Frame management shared by the ISO 19794 image plugins.
+
+A record is made of a general header followed by representations (frames),
+each one starting with its length. The offsets of the frames are found by
+reading these lengths only, and the representation header of a frame is
+parsed the first time the frame is visited and kept for later use.
+
+When ``use_mmap`` is set, a file on disk is memory mapped: the headers are parsed
+and the image data are returned directly from the mapped memory, without read
+system calls nor copies.
+"""
+
+import io
+import os
+import mmap
+import types
+import importlib
+import shutil
+import tempfile
+import collections
+import concurrent.futures
+
+from PIL import Image, ImageFile
+
+from . import hooks
+from .record import Layout
+
+_LENGTH = Layout(('length', 'I'))
+
+# JPEG 2000 file format box and codestream marker segment headers
+_BOX = Layout(('length', 'I'), ('type', '4s'))
+_SEGMENT = Layout(('marker', 'H'), ('length', 'H'))
+
+#: Maximum size kept in memory when writing to a non seekable file
+SPOOL_SIZE = 16 * 1024 * 1024
+
+#: Named JPEG 2000 encoding profiles (``jpeg2000_profile`` save option), as
+#: options of the Pillow JPEG 2000 encoder. ``quality_layers`` are compression
+#: ratios, 0 being lossless.
+JPEG2000_PROFILES = {
+    # lossless, 3 resolutions: the cheapest to encode
+    'fast-lossless': dict(quality_mode='rates', quality_layers=(0,), num_resolutions=3,
+        codeblock_size=(64, 64), progression='LRCP'),
+    # lossless with 60:1 and 15:1 quality layers, 6 resolutions first, 1024x1024 tiles
+    'archival': dict(quality_mode='rates', quality_layers=(60, 15, 0), num_resolutions=6,
+        codeblock_size=(64, 64), progression='RPCL', tile_size=(1024, 1024)),
+    # 15:1 irreversible wavelet, 6 resolutions first
+    'transmission-15:1': dict(quality_mode='rates', quality_layers=(15,), irreversible=True,
+        num_resolutions=6, codeblock_size=(64, 64), progression='RPCL'),
+}
+
+#: Save options changing the encoded image data: the options of this package and
+#: of the Pillow JPEG, JPEG 2000 and PNG encoders. When one of them is given, the
+#: frames are always encoded again, their original image data are not copied.
+CODEC_OPTIONS = frozenset([
+    'bit_depth', 'wsq_bitrate', 'png_preset', 'jpeg2000_profile',
+    # JPEG
+    'quality', 'subsampling', 'qtables', 'progressive', 'progression', 'smooth',
+    'streamtype', 'restart_marker_blocks', 'restart_marker_rows',
+    # JPEG 2000
+    'offset', 'tile_offset', 'tile_size', 'quality_mode', 'quality_layers',
+    'num_resolutions', 'codeblock_size', 'precinct_size', 'irreversible',
+    'cinema_mode', 'mct', 'plt',
+    # PNG
+    'optimize', 'compress_level', 'compress_type', 'dictionary', 'bits',
+    ])
+
+def _reencode(encoderinfo):
+    # Whether the save options require to encode the frames again
+    return bool(encoderinfo.get('reencode')) or not CODEC_OPTIONS.isdisjoint(encoderinfo)
+
+class _MappedFile:
+    """Read-only file object on a memory mapped file"""
+
+    def __init__(self, map, fp, close_fp):
+        self.map = map
+        self.view = memoryview(map)
+        self.fp = fp
+        self.close_fp = close_fp
+        self.pos = 0
+
+    @classmethod
+    def open(cls, fp, close_fp):
+        # Map the file, return None if fp is not a file on disk
+        try:
+            map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            return None
+        return cls(map, fp, close_fp)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.view) - self.pos
+        data = self.view[self.pos:self.pos+size].tobytes()
+        self.pos += len(data)
+        return data
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += len(self.view)
+        self.pos = pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # slices of the map are still in use, it is closed when released
+            pass
+        if self.close_fp:
+            self.fp.close()
+
+class _PixelAccess:
+    """Pixel access of an unmodified frame, copying its read-only pixels on the first change"""
+
+    def __init__(self, image, access):
+        self.image = image
+        self.access = access
+
+    def __getitem__(self, xy):
+        return self.access[xy]
+
+    def __setitem__(self, xy, value):
+        if self.image.readonly:
+            self.image._copy()
+            self.access = self.image.im.pixel_access(False)
+        self.access[xy] = value
+
+    getpixel = __getitem__
+    putpixel = __setitem__
+
+class _ViewReader:
+    """Sequential reader returning zero copy slices of a memoryview"""
+
+    def __init__(self, view, pos):
+        self.view = view
+        self.pos = pos
+
+    def read(self, size):
+        data = self.view[self.pos:self.pos+size]
+        self.pos += size
+        return data
+
+class ISO19794ImageFile(ImageFile.ImageFile):
+    """Base class of the FIR and FAC images
+
+    Subclasses read the general header in ``_open`` then call ``_open_frames``,
+    and implement ``read_header``, ``_codec`` and ``_frame_tile``.
+    """
+
+    _close_exclusive_fp_after_loading = False
+
+    #: Memory map the file when opened from a file on disk
+    use_mmap = False
+
+    #: :py:class:`iso19794.cache.HeaderCache` of the headers of the files opened from a filename
+    header_cache = None
+
+    #: Use compact header objects (``FIRHeader``, ``FACHeader``) instead of dictionaries
+    compact_headers = False
+
+    _cache_key = None
+
+    # frame unmodified when save() was called
+    _saved = None
+
+    # the current frame is decoded at a reduced size (see draft())
+    _drafted = False
+
+    def _open_cached(self):
+        # Open the image from the header cache, return False if it is not cached
+        if self.header_cache is None or not self.filename:
+            return False
+        self._cache_key = self.header_cache.key(self.filename, self.fp, self.compact_headers)
+        entry = self.header_cache.get(self._cache_key)
+        if entry is None:
+            return False
+        self.info.update(entry.info)
+        self._open_frames(entry.positions[0], len(entry.headers), entry)
+        return True
+
+    def _open_frames(self, first, n_frames, entry=None):
+        # setup frame pointers
+        self.__frame = -1
+        self.__fp = self.fp
+        if self.use_mmap:
+            self.__fp = _MappedFile.open(self.fp, self._exclusive_fp) or self.fp
+        self.n_frames = n_frames
+        # offsets of the frames found so far, from the length of the previous frames
+        self._frame_pos = [first]
+        # parsed (header, offset of the image data, raw values) of the visited frames
+        self._frame_headers = [None] * n_frames
+        # (frame, core image) of the last decoded pixels
+        self._decoded = None
+        if entry is not None:
+            self._frame_pos = list(entry.positions)
+            self._frame_headers = list(entry.headers)
+
+        self._seek(0)
+
+        if entry is None and self._cache_key is not None:
+            # parse all the headers to cache them
+            try:
+                for frame in range(n_frames):
+                    self._frame_header(frame)
+            except EOFError:
+                # truncated file, reported when seeking to the missing frames
+                return
+            self.header_cache.put(self._cache_key,
+                (dict(self.info), self._frame_pos[:n_frames], self._frame_headers))
+
+    def seek(self, frame):
+        "Select a given frame as current image"
+        if not self._seek_check(frame):
+            return
+        self._seek(frame)
+        # Create a new core image object on second and
+        # subsequent frames in the image. Image may be
+        # different size/mode.
+        Image._decompression_bomb_check(self.size)
+        self.im = Image.core.new(self.mode, self.size)
+
+    def load(self):
+        start = hooks.start() if self.tile else None
+        pixels = super().load()
+        self._report(start, 'decode', self.__frame)
+        if pixels is not None and self._unmodified():
+            return _PixelAccess(self, pixels)
+        return pixels
+
+    def load_end(self):
+        # The decoded pixels are read-only: Pillow copies them before any change,
+        # replacing the core image, which tells that the frame was modified.
+        # The pixels decoded at a reduced size are not those of the image data.
+        if self._drafted:
+            self._decoded = None
+        else:
+            self._decoded = (self.__frame, self.im)
+            self.readonly = 1
+
+    def _unmodified(self):
+        # Whether the pixels of the current frame are those of its image data
+        return self.tile != [] and not self._drafted or self._decoded == (self.__frame, self.im)
+
+    def save(self, fp, format=None, **params):
+        # The pixels of an unmodified frame are still unmodified in the copy made
+        # by Image.save(), which is kept by the image once saved. When saving onto
+        # the source file, the source is read in memory before being overwritten.
+        if self.filename and isinstance(fp, (str, bytes, os.PathLike)) and \
+                os.path.exists(fp) and os.path.samefile(fp, self.filename):
+            self.__fp.seek(0)
+            source = io.BytesIO(self.__fp.read())
+            if self._exclusive_fp:
+                self.__fp.close()
+            self.__fp = self.fp = source
+            self._exclusive_fp = False
+        self._saved = self.__frame if self._unmodified() else None
+        self.load()
+        frame, im = self.__frame, self.im
+        try:
+            super().save(fp, format, **params)
+        finally:
+            if self._saved is not None and self.__frame == frame:
+                self.im = im
+                self.readonly = 1
+            self._saved = None
+
+    def draft(self, mode, size):
+        """Configure the current frame to be decoded at a reduced size, not smaller than ``size``
+
+        JPEG frames are scaled by 1/2, 1/4 or 1/8 by the JPEG decoder, JPEG 2000
+        frames are decoded at a lower resolution level and 8 bits RAW frames are
+        subsampled (one pixel every n pixels in both directions). The mode and the
+        other frames are not changed. As the ``draft()`` method of Pillow, it must
+        be called before the frame is loaded, and returns the mode and the box of
+        the original image in the reduced image, or None if the size is not
+        reduced. Seeking to another frame cancels the draft.
+        """
+        if len(self.tile) != 1 or not size or self._drafted:
+            return None
+        decoder, extents, offset, args = self.tile[0]
+        # a dimension of 0 or less asks for the smallest reduction
+        scale = int(min(self.size[0] // max(1, size[0]), self.size[1] // max(1, size[1])))
+        if scale <= 1:
+            return None
+        if decoder == 'jpeg':
+            scale = next(s for s in (8, 4, 2) if s <= scale)
+            args = args[:2] + (scale,) + args[3:]
+        elif decoder == 'jpeg2k':
+            reduce = min(scale.bit_length() - 1, self._jpeg2k_levels(offset, args[0]))
+            if reduce == 0:
+                return None
+            scale = 1 << reduce
+            args = (args[0], reduce)
+        elif decoder == 'raw' and args[0] in ('L', 'RGB'):
+            decoder = 'iso19794_subsample'
+            args = (scale, self.size[0])
+        else:
+            return None
+        original = self.size
+        self._size = (-(-original[0] // scale), -(-original[1] // scale))
+        self.tile = [(decoder, (0, 0) + self.size, offset, args)]
+        self._drafted = True
+        return self.mode, (0, 0, original[0] / scale, original[1] / scale)
+
+    def _unmodified_image_data(self, codec):
+        # Return the image data and the raw header values of the current frame if
+        # its pixels have not been modified since read and if it is stored with the
+        # given compression, otherwise return None
+        header,offset,ns = self._frame_header(self.__frame)
+        if self._codec(ns) != codec:
+            return None
+        if not self._unmodified() and self._saved != self.__frame:
+            return None
+        return self.image_data(), ns
+
+    def __del__(self):
+        if self.__fp and self._exclusive_fp:
+            self.__fp.close()
+            self.__fp = None
+        elif self.fp and self._exclusive_fp:
+            self.fp.close()
+            self.fp = None
+
+    def _seek_check(self, frame):
+        if (frame < self._min_frame or
+            frame >= self.n_frames+self._min_frame):
+            raise EOFError("attempt to seek outside sequence")
+
+        return self.tell() != frame
+
+    def _seek(self, frame):
+        # save rheader in case it has been replaced
+        if self.__frame>=0 and hasattr(self,"header"):
+            header,offset,ns = self._frame_headers[self.__frame]
+            self._frame_headers[self.__frame] = (self.header,offset,ns)
+        header,offset,ns = self._frame_header(frame)
+        self.fp = self.__fp
+        self.header = header
+        self.__frame = frame
+        self._drafted = False
+        # changing the pixels first copies them (see load_end)
+        self.readonly = 1
+        start = hooks.start()
+        self.mode, size, self.tile = self._frame_tile(frame, header, offset, ns)
+        self._report(start, 'tile', frame)
+        try:
+            self.size = size
+        except AttributeError:
+            # Support Pillow >= 5.3.0
+            self._size = size
+
+    def tell(self):
+        "Return the current frame number"
+        return self.__frame
+
+    def _frame_offset(self, frame):
+        # Return the offset of a frame, walking the length of the frames not seen yet
+        if isinstance(self.__fp, _MappedFile):
+            view = self.__fp.view
+            while len(self._frame_pos) <= frame:
+                pos = self._frame_pos[-1]
+                if pos + _LENGTH.size > len(view):
+                    raise EOFError("no more images in %s file" % self.format)
+                (length,) = _LENGTH.struct.unpack_from(view, pos)
+                self._frame_pos.append(pos + length)
+        while len(self._frame_pos) <= frame:
+            # reset python3 buffered io handle in case fp
+            # was passed to a libxxx, invalidating the buffer
+            self.__fp.tell()
+            self.__fp.seek(self._frame_pos[-1])
+            data = self.__fp.read(_LENGTH.size)
+            if len(data) < _LENGTH.size:
+                raise EOFError("no more images in %s file" % self.format)
+            (length,) = _LENGTH.unpack(data)
+            self._frame_pos.append(self._frame_pos[-1] + length)
+        return self._frame_pos[frame]
+
+    def _frame_header(self, frame):
+        # Return the (header, offset, ns) of a frame, parsing its header if not done yet
+        if self._frame_headers[frame] is None:
+            pos = self._frame_offset(frame)
+            start = hooks.start()
+            if isinstance(self.__fp, _MappedFile):
+                self._frame_headers[frame] = self.read_header(_ViewReader(self.__fp.view, pos))
+            else:
+                self.__fp.seek(pos)
+                self._frame_headers[frame] = self.read_header(self.__fp)
+            self._report(start, 'read_header', frame)
+        return self._frame_headers[frame]
+
+    def _report(self, start, phase, frame):
+        # Report a reading phase of a frame to the observers, the size is the size
+        # of the representation header when parsing it, of the image data otherwise
+        if start is None:
+            return
+        header,offset,ns = self._frame_headers[frame]
+        hooks.report(start, phase, self.format, _version(self.info), frame, self._codec(ns),
+            offset if phase == 'read_header' else ns.length-offset)
+
+    def _read_at(self, pos, size):
+        # Read bytes at a given position of the file (a zero copy memoryview if mapped)
+        if isinstance(self.__fp, _MappedFile):
+            return self.__fp.view[pos:pos+size]
+        self.__fp.seek(pos)
+        return self.__fp.read(size)
+
+    def image_data(self, frame=None):
+        """Return the image data (compressed) of a frame, by default the current frame
+
+        When the file is memory mapped, this is a memoryview on the mapped file.
+        """
+        if frame is None:
+            frame = self.tell()
+        header,offset,ns = self._frame_header(frame)
+        return self._read_at(self._frame_offset(frame)+offset, ns.length-offset)
+
+    def iter_payloads(self):
+        """Iterate on the frames without decoding them
+
+        Yield a tuple ``(header, codec, data)`` for each frame, where ``codec`` is the
+        compression of the image data as stored in the file and ``data`` the image
+        data (a memoryview when the file is memory mapped). The current frame is not
+        changed.
+        """
+        for frame in range(self.n_frames):
+            header,offset,ns = self._frame_header(frame)
+            if frame == self.__frame:
+                header = self.header
+            yield header, self._codec(ns), self.image_data(frame)
+
+    def find_frames(self, **criteria):
+        """Return the list of the frames whose representation header matches all the criteria
+
+        For example ``find_frames(position='LEFT_INDEX_FINGER')``. Only the headers
+        of the frames not visited yet are parsed.
+        """
+        frames = []
+        for frame in range(self.n_frames):
+            if frame == self.__frame:
+                header = self.header
+            else:
+                header = self._frame_header(frame)[0]
+            if all(header.get(k) == v for k, v in criteria.items()):
+                frames.append(frame)
+        return frames
+
+    def decode_all(self, workers=None, executor=None):
+        """Decode all the frames and return the list of ``(image, header)``
+
+        The frames are decoded concurrently by ``executor`` (a
+        ``concurrent.futures`` executor, a process pool for instance) or by a pool
+        of ``workers`` threads, otherwise one after the other. Each frame is decoded
+        from its own file handle, or from a copy of its image data when the image
+        has not been opened from a filename. The current frame is not changed.
+        """
+        jobs = [self._frame_job(frame) for frame in range(self.n_frames)]
+
+        own_executor = None
+        if executor is None and workers:
+            executor = own_executor = concurrent.futures.ThreadPoolExecutor(workers)
+        try:
+            if executor is None:
+                images = [_decode_frame(*args) for header, args in jobs]
+            else:
+                images = list(executor.map(_decode_frame, *zip(*(args for header, args in jobs))))
+        finally:
+            if own_executor is not None:
+                own_executor.shutdown()
+
+        frames = []
+        for im, (header, args) in zip(images, jobs):
+            im.header = header
+            frames.append((im, header))
+        return frames
+
+    def _frame_job(self, frame):
+        # Return the header of a frame and the arguments of _decode_frame to decode it
+        header,offset,ns = self._frame_header(frame)
+        if frame == self.__frame:
+            header = self.header
+        mode, size, tile = self._frame_tile(frame, header, offset, ns)
+        Image._decompression_bomb_check(size)
+        if self.filename:
+            source = self.filename
+        else:
+            # the tile offset is relative to the image data of the frame
+            source = bytes(self.image_data(frame))
+            pos = self._frame_offset(frame)+offset
+            tile = [(d, box, o-pos, a) for d, box, o, a in tile]
+        return header, (source, mode, size, tile)
+
+    def _codec(self, ns):
+        # Return the compression of a frame, from its raw header values
+        raise NotImplementedError
+
+    def _frame_tile(self, frame, header, offset, ns):
+        # Return the mode, the size and the tile of a frame
+        raise NotImplementedError
+
+    def _jpeg2k_codec(self, pos):
+        # Return the codec of JPEG 2000 image data
+        sig = self._read_at(pos, 12)
+        if sig[:4] == b"\xff\x4f\xff\x51":
+            return "j2k"
+        if sig == b"\x00\x00\x00\x0cjP  \x0d\x0a\x87\x0a":
+            return "jp2"
+        raise SyntaxError("not a JPEG 2000 image")
+
+    def _jpeg2k_levels(self, pos, codec):
+        # Return the number of decomposition levels of JPEG 2000 image data, from
+        # the coding style (COD) of the main header of the codestream
+        if codec == "jp2":
+            # contiguous codestream box
+            while True:
+                length, box = _BOX.unpack(self._read_at(pos, _BOX.size))
+                if box == b"jp2c":
+                    pos += _BOX.size if length != 1 else _BOX.size + 8
+                    break
+                if length == 1:
+                    length = int.from_bytes(self._read_at(pos + _BOX.size, 8), 'big')
+                if length < _BOX.size:
+                    raise SyntaxError("JPEG 2000 codestream not found")
+                pos += length
+        pos += 2    # SOC
+        while True:
+            marker, length = _SEGMENT.unpack(self._read_at(pos, _SEGMENT.size))
+            if marker == 0xFF52:
+                # Lcod, Scod, progression order, layers, multiple component transform
+                return self._read_at(pos + 9, 1)[0]
+            if marker == 0xFF90 or length < 2:
+                raise SyntaxError("JPEG 2000 coding style not found")
+            pos += 2 + length
+
+class _SubsampledDecoder(ImageFile.PyDecoder):
+    """Decoder of 8 bits raw pixels keeping one pixel every ``scale`` pixels in
+    both directions, arguments: scale and width of the image data"""
+
+    _pulls_fd = True
+
+    def decode(self, buffer):
+        scale, width = self.args
+        bands = Image.getmodebands(self.mode)
+        line = width * bands
+        rows = []
+        for y in range(self.state.ysize):
+            if y:
+                self.fd.seek(line * (scale - 1), io.SEEK_CUR)
+            row = self.fd.read(line)
+            if len(row) < line:
+                raise OSError("image file is truncated")
+            if bands == 1:
+                rows.append(row[::scale])
+                continue
+            pixels = bytearray(self.state.xsize * bands)
+            for band in range(bands):
+                pixels[band::bands] = row[band::scale * bands]
+            rows.append(pixels)
+        self.set_as_raw(b"".join(rows))
+        return -1, 0
+
+Image.register_decoder('iso19794_subsample', _SubsampledDecoder)
+
+def _lazy_decoder(module, name):
+    # Return a decoder factory importing the decoder on first use
+    def decoder(mode, *args):
+        return getattr(importlib.import_module(module, __package__), name)(mode, *args)
+    return decoder
+
+# The decoders of the plugins are registered here, not by the plugins: the
+# processes decoding frames for decode_all() may not have imported the plugins
+Image.register_decoder('fir_packed', _lazy_decoder('.FIR', '_PackedDecoder'))
+Image.register_decoder('fir_png', _lazy_decoder('.FIR', '_PngDecoder'))
+Image.register_decoder('wsq', _lazy_decoder('.wsq', 'WsqDecoder'))
+
+class _Frame(ImageFile.ImageFile):
+    """A single frame, decoded independently of the image it belongs to"""
+
+    format = None
+
+    def __init__(self, fp, mode, size, tile):
+        self._frame_tile = (mode, size, tile)
+        super().__init__(fp)
+
+    def _open(self):
+        self.mode, size, self.tile = self._frame_tile
+        try:
+            self.size = size
+        except AttributeError:
+            # Support Pillow >= 5.3.0
+            self._size = size
+
+def _decode_frame(source, mode, size, tile):
+    # Decode a frame from a filename or from its image data (worker of decode_all)
+    if isinstance(source, bytes):
+        frame = _Frame(io.BytesIO(source), mode, size, tile)
+        frame.load()
+    else:
+        with open(source, "rb") as fp:
+            frame = _Frame(fp, mode, size, tile)
+            frame.load()
+    return frame._new(frame.im)
+
+def _version(info):
+    # Return the version of the format as a text
+    version = info.get('version')
+    if isinstance(version, bytes):
+        version = version[:3].decode('ascii', 'replace')
+    return version
+
+#
+# Save operations
+#
+def _seekable(fp):
+    try:
+        return fp.seekable()
+    except (AttributeError, OSError, ValueError):
+        return False
+
+def _write_record(fp, header_size, write_header, write_frames):
+    # Write a record: the general header followed by the frames.
+    # write_frames(fp) writes the frames one after the other and returns their
+    # total size, write_header(fp, length) writes the general header.
+    if _seekable(fp):
+        # Write a placeholder for the general header, updated once the length is known
+        start = fp.tell()
+        fp.write(b"\x00" * header_size)
+        length = header_size + write_frames(fp)
+        end = fp.tell()
+        fp.seek(start)
+        write_header(fp, length)
+        fp.seek(end)
+    else:
+        # Bounded memory: the frames are spooled to a temporary file if too large
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as tmp:
+            length = header_size + write_frames(tmp)
+            write_header(fp, length)
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, fp)
+
+def _encode_frames(frames, encoderinfo, original, encode):
+    # Yield (frame, encoded) for each frame, in order.
+    # original(frame) returns what to write for a frame that does not need to be
+    # encoded (or None) and encode(im, header, encoderinfo, index) encodes an image
+    # and returns the result and its encode event, reported here.
+    # The options of the first image (encoderinfo) apply to all the frames.
+    # Without encoder_executor nor encoder_workers, the frames are yielded with
+    # encoded=None and are encoded when written. Otherwise, the frames are copied
+    # and encoded in parallel, a limited number of frames being in progress.
+    executor = encoderinfo.get('encoder_executor')
+    workers = encoderinfo.get('encoder_workers')
+    options = {k: v for k, v in encoderinfo.items()
+        if k not in ('append_images', 'encoder_executor', 'encoder_workers')}
+    def with_options(frames):
+        for frame in frames:
+            # a copy, the encoders may add options
+            frame.encoderinfo = dict(options)
+            yield frame
+    frames = with_options(frames)
+    if executor is None and not workers:
+        for frame in frames:
+            yield frame, None
+        return
+
+    own_executor = None
+    if executor is None:
+        executor = own_executor = concurrent.futures.ThreadPoolExecutor(workers)
+    window = 2 * (workers or os.cpu_count() or 1)
+    pending = collections.deque()
+    try:
+        for index, frame in enumerate(frames):
+            encoded = original(frame)
+            if encoded is not None:
+                snapshot = types.SimpleNamespace(header=frame.header, size=frame.size, mode=frame.mode)
+            else:
+                snapshot = frame.copy()
+                snapshot.header = frame.header
+                encoded = executor.submit(encode, snapshot, frame.header, frame.encoderinfo, index)
+            pending.append((snapshot, encoded))
+            while len(pending) > window or (pending and _done(pending[0][1])):
+                yield _result(pending.popleft())
+        while pending:
+            yield _result(pending.popleft())
+    finally:
+        for snapshot, encoded in pending:
+            if isinstance(encoded, concurrent.futures.Future):
+                encoded.cancel()
+        if own_executor is not None:
+            own_executor.shutdown()
+
+def _done(encoded):
+    return not isinstance(encoded, concurrent.futures.Future) or encoded.done()
+
+def _result(item):
+    snapshot, encoded = item
+    if isinstance(encoded, concurrent.futures.Future):
+        encoded, event = encoded.result()
+        hooks.emit(event)
+    return snapshot, encoded
+
+def _save_jpeg2k(im, fp, defaults, lossless=None):
+    # Encode an image to a JPEG 2000 codestream. The options of the image are the
+    # defaults, updated by the profile of the jpeg2000_profile option (which must
+    # be lossless or not if lossless is given) and by the options given explicitly.
+    info = im.encoderinfo
+    options = dict(defaults)
+    name = info.get('jpeg2000_profile')
+    if name is not None:
+        if name not in JPEG2000_PROFILES:
+            raise ValueError("Unknown JPEG 2000 profile: %r" % name)
+        profile = JPEG2000_PROFILES[name]
+        if lossless is not None and (profile['quality_layers'][-1] == 0) != lossless:
+            raise ValueError("JPEG 2000 profile %r is not %s" % (name, "lossless" if lossless else "lossy"))
+        options.update(profile)
+    options.update(info)
+    # a resolution level halves the size of the tiles, which must not be empty
+    size = min(im.size + tuple(options.get('tile_size') or ()))
+    if options.get('num_resolutions'):
+        options['num_resolutions'] = max(1, min(options['num_resolutions'], size.bit_length()))
+    import PIL.Jpeg2KImagePlugin
+    im.encoderinfo = options
+    try:
+        PIL.Jpeg2KImagePlugin._save(im, fp, "non.j2k")
+    finally:
+        im.encoderinfo = info
@@ -0,0 +1,115 @@
+"""
+Cache of the headers of the ISO 19794 files.
+
+A :py:class:`HeaderCache` keeps the general header, the offsets of the frames and
+the representation headers of the files opened from a filename, keyed by the
+path, the kind of headers (dictionaries or compact objects), the size and the
+modification time of the file. When a file is found in
+the cache, opening it and seeking to its frames does not read nor parse any
+header. The cache is enabled per format, or for both formats on their base
+class::
+
+    from iso19794.base import ISO19794ImageFile
+    from iso19794.cache import HeaderCache
+
+    ISO19794ImageFile.header_cache = HeaderCache(size=100000, path="headers.db")
+
+The entries are kept in memory in a LRU of ``size`` entries and, if ``path`` is
+given, in a SQLite database so that they survive a restart. The entries are
+stored pickled: the database must not be writable by untrusted users.
+"""
+
+import io
+import os
+import pickle
+import sqlite3
+import threading
+import collections
+
+# General header (info dictionary), offsets of the frames and list of the
+# (header, offset of the image data, raw values) of the frames of a file
+CacheEntry = collections.namedtuple('CacheEntry', [
+    'info',
+    'positions',
+    'headers'])
+
+class HeaderCache:
+    """LRU cache of the headers, optionally backed by a SQLite database"""
+
+    def __init__(self, size=1024, path=None):
+        self.size = size
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(headers)")]
+            if columns and 'compact' not in columns:
+                # database of a previous version, keyed by the path only
+                self._db.execute("DROP TABLE headers")
+            self._db.execute("CREATE TABLE IF NOT EXISTS headers ("
+                "path TEXT, compact INTEGER, size INTEGER, mtime INTEGER, entry BLOB, "
+                "PRIMARY KEY (path, compact))")
+            self._db.commit()
+
+    @staticmethod
+    def key(filename, fp=None, compact=False):
+        """Return the key of a file: its absolute path, whether the headers are compact,
+        its size and its modification time"""
+        try:
+            st = os.fstat(fp.fileno())
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            st = os.stat(filename)
+        return (os.path.abspath(os.fsdecode(filename)), int(bool(compact)), st.st_size, st.st_mtime_ns)
+
+    def get(self, key):
+        "Return a new copy of the :py:class:`CacheEntry` of a key, or None"
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            elif self._db is not None:
+                row = self._db.execute("SELECT entry FROM headers WHERE path=? AND compact=? AND size=? AND mtime=?",
+                    key).fetchone()
+                if row is not None:
+                    data = row[0]
+                    self._add(key, data)
+        if data is None:
+            return None
+        return CacheEntry._make(pickle.loads(data))
+
+    def put(self, key, entry):
+        "Store the :py:class:`CacheEntry` of a key (a copy of it)"
+        data = pickle.dumps(tuple(entry), pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._add(key, data)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO headers VALUES (?,?,?,?,?)", key + (data,))
+                self._db.commit()
+
+    def _add(self, key, data):
+        self._entries[key] = data
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        "Remove all the entries, from the memory and from the database"
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM headers")
+                self._db.commit()
+
+    def close(self):
+        "Close the database"
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,220 @@
+"""
+Bulk conversion of ISO 19794 files.
+
+The ``convert`` command converts the ``.fir`` and ``.fac`` files of directories
+to another compression, or exports their frames to PNG or TIFF files::
+
+    python -m iso19794 convert --compression JPEG2000_LOSSLESS fingers/ converted/
+    python -m iso19794 convert --fir-compression WSQ --fac-compression JPEG2000 records/ converted/
+    python -m iso19794 convert --format png faces/ png/
+
+``--compression`` applies to both formats; the files of a format which does not
+support it are skipped unless that format has its own option.
+
+The tree of the source directories is reproduced in the destination directory.
+The files are converted by a pool of processes (``--workers``), a limited number
+of files being in progress at any time. Each output file is written under a
+temporary name and renamed once complete, so that an interrupted conversion can
+be restarted with ``--resume`` to skip the files already converted.
+"""
+
+import os
+import sys
+import time
+import argparse
+import collections
+import concurrent.futures
+
+from PIL import Image
+
+from . import _module
+
+EXTENSIONS = ('.fir', '.fac')
+
+# Header field and enumeration of the compression of a frame, per format
+_COMPRESSION_FIELD = {
+    'FIR': 'image_compression_algo',
+    'FAC': 'image_data_type',
+}
+_COMPRESSION_ENUM = {
+    'FIR': 'COMPRESSION',
+    'FAC': 'IMAGE_DATA_TYPE',
+}
+
+def _compressions(format):
+    # Return the names of the compressions of a format, importing its module
+    return getattr(_module(format), _COMPRESSION_ENUM[format])
+
+def iter_sources(sources):
+    """Yield ``(path, relative path)`` for the ISO 19794 files of the sources
+
+    A source is a file or a directory, walked recursively in a stable order.
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                        path = os.path.join(root, name)
+                        yield path, os.path.relpath(path, source)
+        else:
+            yield source, os.path.basename(source)
+
+def _write(path, save):
+    # Write a file under a temporary name, renamed once complete
+    tmp = path + ".part"
+    try:
+        save(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def convert_file(src, dst, compression=None, format=None, resume=False):
+    """Convert a file and return the number of bytes read, or None if skipped
+
+    Without ``format``, the file is saved to ``dst`` in its own format, with all
+    the frames using ``compression`` if given: a compression name, or a dictionary
+    of the compression per format (``'FIR'``, ``'FAC'``), the files of the formats
+    missing from it being saved unchanged. A file whose format does not support
+    the compression is skipped. With ``format='PNG'``, each frame
+    is saved to ``<dst without extension>.<frame>.png``, with ``format='TIFF'``
+    all the frames are saved to ``<dst without extension>.tiff``. If ``resume``
+    is true and the output files exist, nothing is done.
+    """
+    base = os.path.splitext(dst)[0]
+    if format is None:
+        outputs = [dst]
+    elif format == 'TIFF':
+        outputs = [base + '.tiff']
+    else:
+        outputs = None
+    if resume and outputs and all(os.path.exists(output) for output in outputs):
+        return None
+
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    with Image.open(src) as im:
+        if format == 'PNG':
+            outputs = ['%s.%d.png' % (base, frame) for frame in range(im.n_frames)]
+            if resume and all(os.path.exists(output) for output in outputs):
+                return None
+            for frame, output in enumerate(outputs):
+                im.seek(frame)
+                _write(output, lambda path: im.save(path, 'PNG'))
+        elif format == 'TIFF':
+            _write(outputs[0], lambda path: im.save(path, 'TIFF', save_all=True))
+        else:
+            if isinstance(compression, dict):
+                compression = compression.get(im.format)
+            if compression and compression not in _compressions(im.format):
+                return None
+            if compression:
+                field = _COMPRESSION_FIELD[im.format]
+                for frame in range(im.n_frames):
+                    im.seek(frame)
+                    im.header[field] = compression
+                im.seek(0)
+            _write(dst, lambda path: im.save(path, im.format, save_all=True))
+    return os.path.getsize(src)
+
+def convert_all(jobs, workers=None, **options):
+    """Convert the files and yield ``(src, size, error)`` as they are done
+
+    ``jobs`` is an iterable of ``(src, dst)``, consumed as the conversions
+    progress. ``size`` is the value returned by :py:func:`convert_file` and
+    ``error`` the exception raised, if any. The files are converted by a pool of
+    ``workers`` processes (by default one per CPU) or in the current process if
+    ``workers`` is 1.
+    """
+    if workers == 1:
+        for src, dst in jobs:
+            try:
+                yield src, convert_file(src, dst, **options), None
+            except Exception as e:
+                yield src, None, e
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        window = 2 * (workers or os.cpu_count() or 1)
+        pending = collections.OrderedDict()
+        jobs = iter(jobs)
+        while True:
+            for src, dst in jobs:
+                pending[executor.submit(convert_file, src, dst, **options)] = src
+                if len(pending) >= window:
+                    break
+            if not pending:
+                return
+            done, not_done = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                src = pending.pop(future)
+                try:
+                    yield src, future.result(), None
+                except Exception as e:
+                    yield src, None, e
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m iso19794',
+        description='Tools for ISO 19794 files')
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+
+    convert = commands.add_parser('convert',
+        help='convert ISO 19794 files to another compression or export their frames',
+        description='Convert the .fir and .fac files of the sources to another '
+            'compression, or export their frames to PNG or TIFF files.')
+    convert.add_argument('sources', nargs='+', metavar='SOURCE',
+        help='a .fir/.fac file or a directory')
+    convert.add_argument('destination', metavar='DESTINATION',
+        help='the output directory')
+    convert.add_argument('-c', '--compression',
+        choices=sorted(set(_compressions('FIR')) | set(_compressions('FAC'))),
+        help='compression of the frames of both formats, the files of a format '
+            'not supporting it are skipped (default: unchanged)')
+    convert.add_argument('--fir-compression', choices=list(_compressions('FIR')),
+        help='compression of the frames of the .fir files (default: --compression)')
+    convert.add_argument('--fac-compression', choices=list(_compressions('FAC')),
+        help='compression of the frames of the .fac files (default: --compression)')
+    convert.add_argument('-f', '--format', choices=['png', 'tiff'],
+        help='export the frames to PNG (one file per frame) or TIFF files')
+    convert.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+        help='number of worker processes (default: number of CPUs)')
+    convert.add_argument('--resume', action='store_true',
+        help='skip the files already converted')
+    args = parser.parse_args(argv)
+
+    jobs = ((src, os.path.join(args.destination, relpath))
+        for src, relpath in iter_sources(args.sources))
+    compression = {
+        'FIR': args.fir_compression or args.compression,
+        'FAC': args.fac_compression or args.compression,
+    }
+    if args.format is None:
+        for format, name in compression.items():
+            if name and name not in _compressions(format):
+                print("%s is not a %s compression: the .%s files are skipped" % (
+                    name, format, format.lower()), file=sys.stderr)
+    options = dict(
+        compression=compression,
+        format=args.format.upper() if args.format else None,
+        resume=args.resume)
+
+    converted = skipped = failed = size = 0
+    start = time.perf_counter()
+    for src, read, error in convert_all(jobs, args.workers, **options):
+        if error is not None:
+            failed += 1
+            print("%s: %s" % (src, error), file=sys.stderr)
+        elif read is None:
+            skipped += 1
+        else:
+            converted += 1
+            size += read
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    print("%d converted, %d skipped, %d failed in %.1fs: %.1f files/s, %.2f MB/s" % (
+        converted, skipped, failed, elapsed,
+        converted / elapsed, size / elapsed / 1e6))
+    return 1 if failed else 0
@@ -0,0 +1,92 @@
+"""
+Instrumentation of the reading and writing phases.
+
+An observer is a callable receiving an :py:class:`Event` at the end of each
+phase. When reading:
+
+``general_header``
+    parsing of the general header, when the image is opened
+``read_header``
+    parsing of a representation header (the first time a frame is visited)
+``tile``
+    setup of the decoder of a frame, when it becomes the current frame
+``decode``
+    decoding of the image data of the current frame (``load()``)
+
+When writing (in ``save()``):
+
+``encode``
+    encoding of the image data of a frame (not reported when the original image
+    data are copied). With ``encoder_workers`` or ``encoder_executor``, the duration
+    is measured by the thread or process encoding the frame and the event is
+    reported by the saving thread, before the frame is written
+``header``
+    serialization of a representation header
+``write``
+    writing of a frame to the output
+
+Each event is tagged with the format (``FIR`` or ``FAC``), the version, the index
+of the frame and its compression, and gives the duration of the phase in seconds
+and the number of bytes processed. Nothing is measured when no observer is
+registered.
+
+>>> events = []
+>>> add_observer(events.append)
+>>> remove_observer(events.append)
+"""
+
+import time
+import contextlib
+from collections import namedtuple
+
+Event = namedtuple('Event', [
+    'phase',
+    'format',
+    'version',
+    'frame',
+    'compression',
+    'seconds',
+    'size'])
+
+_observers = []
+
+def add_observer(observer):
+    "Register a callable called with an :py:class:`Event` at the end of each phase"
+    _observers.append(observer)
+
+def remove_observer(observer):
+    "Unregister an observer"
+    _observers.remove(observer)
+
+@contextlib.contextmanager
+def observe(observer):
+    "Context manager registering an observer for the duration of a block"
+    add_observer(observer)
+    try:
+        yield observer
+    finally:
+        remove_observer(observer)
+
+def start(always=False):
+    # Return the start time of a phase, None if there is no observer (unless
+    # always is true: the observers of a worker process are not those of the parent)
+    if _observers or always:
+        return time.perf_counter()
+    return None
+
+def event(start, phase, format, version, frame, compression, size):
+    # Return the Event of a phase started with start(), None if not measured
+    if start is None:
+        return None
+    return Event(phase, format, version, frame, compression, time.perf_counter() - start, size)
+
+def emit(event):
+    # Send an Event (or None) to the observers
+    if event is None:
+        return
+    for observer in list(_observers):
+        observer(event)
+
+def report(start, phase, format, version, frame, compression, size):
+    # Report the end of a phase started with start()
+    emit(event(start, phase, format, version, frame, compression, size))
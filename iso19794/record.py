@@ -0,0 +1,297 @@
+"""
+Declarative description of the binary records used by the ISO 19794 formats.
+
+A :py:class:`Layout` describes a fixed size block of fields. The ``struct.Struct``
+object used to decode and encode the block is built once, when the layout is
+declared. An :py:class:`Enum` is a dictionary converting names to codes which
+also maintains the reverse conversion (codes to names). A :py:class:`Header` is
+a compact representation header, storing the codes read from the file. The
+headers returned by ``scan()`` keep the bytes read from the file and are only
+decoded when accessed (:py:class:`LazyHeader` and :py:meth:`Header.lazy`).
+"""
+
+import struct
+import functools
+import collections.abc
+
+class Enum(dict):
+    """Conversion table between the names and the codes of an enumeration
+
+    This is a plain dictionary (name -> code) with an additional ``names``
+    dictionary (code -> name), kept up to date when items are added.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.names = {v: k for k, v in self.items()}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.names[value] = key
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.names = {v: k for k, v in self.items()}
+
+class Layout:
+    """A fixed size block of big endian fields (§6.1)
+
+    Each field is given as a tuple ``(name, format)`` where ``format`` is a
+    ``struct`` format character (with an optional count).
+    """
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self.names = tuple(name for name, fmt in fields)
+        self.struct = struct.Struct(">" + "".join(fmt for name, fmt in fields))
+        self.size = self.struct.size
+
+    def unpack(self, buffer):
+        "Decode the block and return the tuple of values"
+        return self.struct.unpack(buffer)
+
+    def read(self, fp, ns):
+        "Read the block from ``fp``, store the values in the namespace ``ns`` and return the size read"
+        ns.__dict__.update(zip(self.names, self.struct.unpack(fp.read(self.size))))
+        return self.size
+
+    def read_records(self, fp, count, factory):
+        "Read ``count`` consecutive blocks from ``fp`` and return them as a list of ``factory`` (a namedtuple)"
+        if count == 0:
+            return []
+        return [factory._make(values) for values in self.struct.iter_unpack(fp.read(count * self.size))]
+
+    def pack(self, *values):
+        "Encode the values to bytes"
+        return self.struct.pack(*values)
+
+class Field:
+    """Conversion of a field of a :py:class:`Header` between its value and its stored code"""
+
+    def __init__(self, decode, encode):
+        self.decode = decode
+        self.encode = encode
+
+def enum_field(enum):
+    "A field stored as the code of an :py:class:`Enum`"
+    return Field(enum.names.__getitem__, enum.__getitem__)
+
+def bytes_field(size):
+    "A bytes field of ``size`` bytes, stored as an integer"
+    return Field(lambda code: code.to_bytes(size, 'big'), lambda value: int.from_bytes(value, 'big'))
+
+def flags_field(flags):
+    "A list of flag names, stored as a bit mask"
+    return Field(lambda mask: [k for k, v in flags.items() if mask & v],
+        lambda names: functools.reduce(lambda x, y: x | y, [flags[name] for name in names], 0))
+
+#: A list, stored as a tuple
+LIST_FIELD = Field(list, tuple)
+
+_SHARED = {}
+
+def shared(value):
+    "Return an object equal to value shared by all the headers, for the values with few distinct values"
+    if len(_SHARED) < 4096:
+        return _SHARED.setdefault(value, value)
+    return _SHARED.get(value, value)
+
+#: A value with few distinct values (a resolution, an image size), stored as a shared object
+SHARED_FIELD = Field(lambda code: code, shared)
+
+class Header(collections.abc.MutableMapping):
+    """Compact representation header
+
+    A mapping with the same keys and values as the dictionary headers, the
+    values being stored in ``__slots__``. Subclasses declare ``_fields``, a
+    dictionary giving for each field its :py:class:`Field` conversion (or None
+    for the values stored as is), and the matching ``__slots__``. Only the
+    declared fields can be set.
+    """
+
+    __slots__ = ()
+    _fields = {}
+
+    def __init__(self, *args, **kwargs):
+        self.update(*args, **kwargs)
+
+    @classmethod
+    def from_codes(cls, **codes):
+        "Build a header from the codes of its fields (the values read from the file)"
+        header = cls.__new__(cls)
+        for name, code in codes.items():
+            setattr(header, name, code)
+        return header
+
+    def __getitem__(self, key):
+        field = self._fields.get(key, self)
+        if field is self:
+            raise KeyError(key)
+        try:
+            code = getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+        return code if field is None else field.decode(code)
+
+    def __setitem__(self, key, value):
+        field = self._fields.get(key, self)
+        if field is self:
+            raise KeyError("%s has no field %r" % (type(self).__name__, key))
+        setattr(self, key, value if field is None else field.encode(value))
+
+    def __delitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __iter__(self):
+        for name in self._fields:
+            if hasattr(self, name):
+                yield name
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+    def __contains__(self, key):
+        return key in self._fields and hasattr(self, key)
+
+    def copy(self):
+        return self.from_codes(**{name: getattr(self, name) for name in self})
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, dict(self))
+
+    @classmethod
+    def lazy(cls, data, decode):
+        """Return a header of this class decoded on first access
+
+        ``decode(data)`` returns the dictionary of the codes of the fields, set
+        when one of them is first read. The headers which cannot be decoded
+        raise ``ValueError``.
+        """
+        lazy_class = cls.__dict__.get('_lazy_class')
+        if lazy_class is None:
+            lazy_class = type(cls.__name__, (cls,), dict(
+                __slots__=('_data', '_decode'),
+                __module__=cls.__module__,
+                __getattr__=_lazy_getattr,
+                __setitem__=_lazy_setitem,
+                __delitem__=_lazy_delitem,
+                __reduce__=_lazy_reduce))
+            cls._lazy_class = lazy_class
+        header = lazy_class.__new__(lazy_class)
+        header._data = data
+        header._decode = decode
+        return header
+
+def _lazy_load(self):
+    # Decode a lazy header once, copying the fields of the decoded header
+    try:
+        data, decode = self._data, self._decode
+    except AttributeError:
+        return
+    codes = _decode(decode, data)
+    del self._data, self._decode
+    for name, code in codes.items():
+        setattr(self, name, code)
+
+def _decode(decode, data):
+    # Decode the bytes of a lazy header. The errors of the parsers are raised as
+    # ValueError: an AttributeError would look like a missing field.
+    try:
+        return decode(data)
+    except (AttributeError, KeyError, IndexError, struct.error) as e:
+        raise ValueError("invalid representation header: %s" % e) from e
+
+def _lazy_getattr(self, name):
+    # Called for the fields not set yet
+    if name in ('_data', '_decode'):
+        raise AttributeError(name)
+    _lazy_load(self)
+    return object.__getattribute__(self, name)
+
+def _lazy_setitem(self, key, value):
+    _lazy_load(self)
+    Header.__setitem__(self, key, value)
+
+def _lazy_delitem(self, key):
+    _lazy_load(self)
+    Header.__delitem__(self, key)
+
+def _lazy_reduce(self):
+    # Pickled as a plain header of the class
+    base = type(self).__mro__[1]
+    return _from_codes, (base, {name: getattr(self, name) for name in self})
+
+def _from_codes(cls, codes):
+    return cls.from_codes(**codes)
+
+class LazyHeader(collections.abc.MutableMapping):
+    """Dictionary header decoded on first access
+
+    Keeps the bytes of the header and the function decoding them to a
+    dictionary, the mapping operations act on the decoded dictionary. The
+    headers which cannot be decoded raise ``ValueError``.
+    """
+
+    __slots__ = ('_data', '_decode', '_header')
+
+    def __init__(self, data, decode):
+        self._data = data
+        self._decode = decode
+        self._header = None
+
+    def _decoded(self):
+        header = self._header
+        if header is None:
+            header = self._header = _decode(self._decode, self._data)
+            self._data = self._decode = None
+        return header
+
+    def __getitem__(self, key):
+        return self._decoded()[key]
+
+    def __setitem__(self, key, value):
+        self._decoded()[key] = value
+
+    def __delitem__(self, key):
+        del self._decoded()[key]
+
+    def __iter__(self):
+        return iter(self._decoded())
+
+    def __len__(self):
+        return len(self._decoded())
+
+    def __contains__(self, key):
+        return key in self._decoded()
+
+    def keys(self):
+        return self._decoded().keys()
+
+    def items(self):
+        return self._decoded().items()
+
+    def values(self):
+        return self._decoded().values()
+
+    def get(self, key, default=None):
+        return self._decoded().get(key, default)
+
+    def __eq__(self, other):
+        if isinstance(other, LazyHeader):
+            other = other._decoded()
+        return self._decoded() == other
+
+    def copy(self):
+        "Return the decoded header as a new dictionary"
+        return dict(self._decoded())
+
+    def __reduce__(self):
+        return dict, (self._decoded(),)
+
+    def __repr__(self):
+        return repr(self._decoded())
@@ -0,0 +1,316 @@
+"""
+Benchmarks of the main operations on ISO 19794 records.
+
+For each format (FIR and FAC), compression, image size and number of frames, a
+record is built from a synthetic image and the following operations are timed:
+
+``open``
+    ``Image.open`` of the record
+``seek``
+    ``Image.open`` and ``seek`` to every frame
+``scan``
+    ``iso19794.scan`` of the record and reading all the fields of every header
+``decode``
+    ``Image.open``, ``seek`` and ``load`` of every frame
+``read_header``
+    ``read_header`` of every representation header
+``save``
+    ``save`` (one frame) or ``save_all`` of the images
+
+The rates are given in records per second and in MB (of the record) per second.
+With ``--memory``, the memory used by the representation headers kept after a
+``scan()`` (once decoded) is measured, with dictionaries and with compact headers. With
+``--jpeg2000-profiles``, the encoding speed and the size of the image data are
+measured for each JPEG 2000 profile (``jpeg2000_profile`` save option).
+Each measure is the best of several runs of at least ``--min-time`` seconds, so
+that the numbers can be compared from one run to the other::
+
+    python -m iso19794.tests.benchmark --json before.json
+    python -m iso19794.tests.benchmark --compare before.json
+
+With ``--compare``, the exit status is 1 if an operation is slower than in the
+reference by more than ``--tolerance``.
+"""
+
+import io
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import datetime
+import collections
+
+import PIL.Image
+import PIL.ImageDraw
+
+import iso19794
+from iso19794 import FIR, FAC
+from iso19794.base import JPEG2000_PROFILES
+
+#: Image sizes (width, height)
+SIZES = collections.OrderedDict([
+    ('small', (256, 360)),
+    ('medium', (800, 750)),
+    ('palm', (2000, 2000)),
+])
+
+#: Number of frames of the records
+FRAME_COUNTS = (1, 2, 4, 10, 14)
+
+#: Compressions of each format
+COMPRESSIONS = collections.OrderedDict([
+    ('FIR', list(FIR.COMPRESSION)),
+    ('FAC', list(FAC.IMAGE_DATA_TYPE)),
+])
+
+OPERATIONS = ('open', 'seek', 'scan', 'decode', 'read_header', 'save')
+
+# Fixed capture date, for records identical from one run to the other
+_DATETIME = datetime.datetime(2020, 1, 1)
+
+Result = collections.namedtuple('Result', [
+    'operation',
+    'format',
+    'compression',
+    'size',
+    'frames',
+    'records_per_second',
+    'mb_per_second'])
+
+def sample_image(mode, size):
+    "Return a synthetic image, always the same for a given mode and size"
+    im = PIL.Image.new(mode, size, "white")
+    draw = PIL.ImageDraw.Draw(im)
+    width, height = size
+    for i in range(0, min(width, height) // 2, 6):
+        draw.ellipse((i, i, width - i, height - i), outline="black", width=2)
+    return im
+
+def sample_images(format, compression, size, frames):
+    "Return the images (with their header) of a record"
+    if format == 'FIR':
+        im = sample_image("L", size)
+        header = dict(
+            image_compression_algo=compression,
+            capture_datetime=_DATETIME)
+    else:
+        im = sample_image("RGB", size)
+        header = dict(
+            landmark_points=[],
+            gender='M',
+            eye_colour='BLUE',
+            hair_colour='BLACK',
+            property_mask=[],
+            expression='NEUTRAL',
+            pose_yaw=0,
+            pose_pitch=0,
+            pose_roll=0,
+            pose_uncertainty_yaw=0,
+            pose_uncertainty_pitch=0,
+            pose_uncertainty_roll=0,
+            face_image_type='FULL_FRONTAL',
+            image_data_type=compression,
+            source_type='STATIC_CAMERA',
+            device_type=b'\x00\x00',
+            quality=b'\x00\x00')
+    images = []
+    for _ in range(frames):
+        frame = im.copy()
+        frame.header = dict(header)
+        images.append(frame)
+    return images
+
+def save(images, format, **options):
+    "Save the images to a record and return it"
+    buffer = io.BytesIO()
+    if format == 'FAC':
+        options.setdefault('version', '010')
+    if len(images) == 1:
+        images[0].save(buffer, format, **options)
+    else:
+        images[0].save(buffer, format, save_all=True, append_images=images[1:], **options)
+    return buffer.getvalue()
+
+def measure(func, min_time=0.2, repeat=3):
+    "Return the best time of one call of func, each run lasting at least min_time"
+    best = None
+    for _ in range(repeat):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / count < best:
+            best = elapsed / count
+    return best
+
+def _open(data):
+    return PIL.Image.open(io.BytesIO(data))
+
+def _seek(data):
+    im = _open(data)
+    for frame in range(im.n_frames):
+        im.seek(frame)
+
+def _decode(data):
+    im = _open(data)
+    for frame in range(im.n_frames):
+        im.seek(frame)
+        im.load()
+
+def _scan(data):
+    # the headers of scan() are decoded when their fields are read
+    for header in iso19794.scan(data).headers:
+        list(header.values())
+
+def _read_headers(data):
+    # Return a function reading all the representation headers of the record
+    im = _open(data)
+    positions = [im._frame_offset(frame) for frame in range(im.n_frames)]
+    fp = io.BytesIO(data)
+    def read_headers():
+        for pos in positions:
+            fp.seek(pos)
+            im.read_header(fp)
+    return read_headers
+
+def run(formats=COMPRESSIONS, sizes=SIZES, frame_counts=FRAME_COUNTS,
+        operations=OPERATIONS, min_time=0.2, repeat=3, output=None):
+    "Run the benchmarks and return the list of results"
+    results = []
+    for format in formats:
+        for compression in COMPRESSIONS[format]:
+            for size in sizes:
+                for frames in frame_counts:
+                    images = sample_images(format, compression, SIZES[size], frames)
+                    try:
+                        data = save(images, format)
+                    except Exception as e:
+                        if output:
+                            print("%-11s %s %-17s %-6s %2d: not supported (%s)" % (
+                                'save', format, compression, size, frames, e), file=output)
+                        continue
+                    funcs = dict(
+                        open=lambda: _open(data),
+                        seek=lambda: _seek(data),
+                        scan=lambda: _scan(data),
+                        decode=lambda: _decode(data),
+                        read_header=_read_headers(data),
+                        save=lambda: save(images, format))
+                    for operation in operations:
+                        seconds = measure(funcs[operation], min_time, repeat)
+                        result = Result(operation, format, compression, size, frames,
+                            1 / seconds, len(data) / seconds / 1e6)
+                        results.append(result)
+                        if output:
+                            print("%-11s %s %-17s %-6s %2d: %10.1f records/s %8.2f MB/s" % result,
+                                file=output)
+    return results
+
+def header_memory(records, compact=False):
+    "Return the number of bytes per representation header kept after scanning the records"
+    tracemalloc.start()
+    try:
+        headers = [header for data in records for header in iso19794.scan(data, compact).headers]
+        # the headers of scan() are decoded on first access
+        for header in headers:
+            len(header)
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size / len(headers)
+
+def memory(count=1000, output=None):
+    "Measure the memory used per header, return the sizes with dictionaries and with compact headers"
+    from iso19794.tests.build_image import Generator
+    # the size of the images does not matter
+    generator = Generator(seed=0, variants=1,
+        fir_sizes=dict(finger=[(16, 16)], slap=[(16, 16)], palm=[(16, 16)]), fac_sizes=[(16, 16)])
+    records = [data for index, format, data in generator.records(0, count)]
+    sizes = header_memory(records), header_memory(records, compact=True)
+    if output:
+        print("headers: %.0f bytes (dict), %.0f bytes (compact), %.0f%% less" % (
+            sizes + (100 * (1 - sizes[1] / sizes[0]),)), file=output)
+    return sizes
+
+def jpeg2000_profiles(size='medium', min_time=0.2, repeat=3, output=None):
+    """Measure the JPEG 2000 profiles on a single frame record of each format,
+    return the list of (format, profile, records per second, size of the record)"""
+    results = []
+    for format, compression in (('FIR', 'JPEG2000_LOSSY'), ('FIR', 'JPEG2000_LOSSLESS'), ('FAC', 'JPEG2000')):
+        images = sample_images(format, compression, SIZES[size], 1)
+        for profile in [None] + list(JPEG2000_PROFILES):
+            lossless = JPEG2000_PROFILES[profile]['quality_layers'][-1] == 0 if profile else None
+            if profile and format == 'FIR' and lossless != (compression == 'JPEG2000_LOSSLESS'):
+                continue
+            options = dict(jpeg2000_profile=profile) if profile else {}
+            seconds = measure(lambda: save(images, format, **options), min_time, repeat)
+            result = (format, profile or 'default', 1 / seconds, len(save(images, format, **options)))
+            results.append(result)
+            if output:
+                print("%s %-18s %-18s %8.1f records/s %9d bytes" % ((format, compression) + result[1:]),
+                    file=output)
+    return results
+
+def compare(results, reference, tolerance=0.2, output=None):
+    "Return the results slower than in the reference by more than tolerance"
+    reference = {tuple(r[:5]): r for r in reference}
+    slower = []
+    for result in results:
+        ref = reference.get(tuple(result[:5]))
+        if ref is None:
+            continue
+        ratio = result.records_per_second / ref[5]
+        if ratio < 1 - tolerance:
+            slower.append(result)
+        if output:
+            print("%-11s %s %-17s %-6s %2d: %6.2fx%s" % (result[:5] + (ratio,
+                "  SLOWER" if ratio < 1 - tolerance else "")), file=output)
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of the iso19794 package")
+    parser.add_argument('--formats', nargs='+', choices=list(COMPRESSIONS), default=list(COMPRESSIONS))
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=list(SIZES))
+    parser.add_argument('--frames', nargs='+', type=int, default=list(FRAME_COUNTS))
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument('--min-time', type=float, default=0.2,
+        help='minimum duration of a run, in seconds')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of runs of each measure')
+    parser.add_argument('--memory', action='store_true',
+        help='measure the memory used by the headers instead of the timings')
+    parser.add_argument('--jpeg2000-profiles', action='store_true',
+        help='measure the JPEG 2000 profiles instead of the timings')
+    parser.add_argument('--json', help='save the results to a JSON file')
+    parser.add_argument('--compare', help='compare the results to a JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='slowdown reported by --compare (default: 0.2 i.e. 20%%)')
+    args = parser.parse_args(argv)
+
+    print("iso19794 %s, Pillow %s" % (iso19794.__version__, PIL.__version__))
+    if args.memory:
+        memory(output=sys.stdout)
+        return 0
+    if args.jpeg2000_profiles:
+        jpeg2000_profiles(args.sizes[0], args.min_time, args.repeat, output=sys.stdout)
+        return 0
+    results = run(args.formats, args.sizes, args.frames, args.operations,
+        args.min_time, args.repeat, output=sys.stdout)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([r._asdict() for r in results], f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            reference = [Result(**r) for r in json.load(f)]
+        print()
+        if compare(results, reference, args.tolerance, output=sys.stdout):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
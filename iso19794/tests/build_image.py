@@ -1,7 +1,52 @@
+"""
+Synthetic ISO 19794 records for the tests and the load tests.
 
-# Implementation of Annex C1 to give a sample image
+``build_samples()`` writes the sample files of the tests (``annexc.fir``, the
+implementation of Annex C1, and ``twofingers.fir``) byte by byte.
 
-if __name__=='__main__':
+A :py:class:`Generator` produces valid FIR (version 020) and FAC (version 010)
+records, varying the number of frames, the positions, the quality and the
+certification records, the landmark points, the image sizes and the
+compressions. The records are deterministic: record ``i`` of a generator only
+depends on the seed and on ``i``. The image data are encoded once per image
+variant, size and compression, then copied in the records::
+
+    python -m iso19794.tests.build_image samples
+    python -m iso19794.tests.build_image corpus --count 100000 --seed 1 corpus/
+    python -m iso19794.tests.build_image dump --size 4G --seed 1 records.dump
+"""
+
+import io
+import os
+import sys
+import random
+import argparse
+import datetime
+
+import PIL.Image
+import PIL.ImageDraw
+
+from iso19794 import FIR, FAC
+
+#: Image sizes (width, height) of the fingers, slaps and palms
+FIR_SIZES = {
+    'finger': [(256, 360), (400, 500)],
+    'slap': [(800, 750), (1600, 1500)],
+    'palm': [(2000, 2000), (2000, 2500)],
+}
+
+#: Image sizes (width, height) of the faces
+FAC_SIZES = [(240, 320), (480, 640), (600, 800)]
+
+#: Compressions used for the generated frames
+FIR_COMPRESSIONS = ['RAW', 'JPEG', 'JPEG2000_LOSSY', 'JPEG2000_LOSSLESS']
+FAC_COMPRESSIONS = ['JPEG', 'JPEG2000']
+
+# Kind of image of each position
+_PALMS = {k for k, v in FIR.POSITION.items() if 20 <= v <= 36}
+_SLAPS = {'PLAIN_RIGHT_FOUR_FINGERS', 'PLAIN_LEFT_FOUR_FINGERS', 'PLAIN_THUMBS'}
+
+def build_samples():
     with open('annexc.fir','wb') as f:
         f.write(b'\x46\x49\x52\x00')
         f.write(b'\x30\x32\x30\x00')
@@ -33,7 +78,7 @@ if __name__=='__main__':
 
         with open('annexc.data','rb') as g:
             f.write(g.read())
-            
+        
     with open('twofingers.fir','wb') as f:
         f.write(b'\x46\x49\x52\x00')
         f.write(b'\x30\x32\x30\x00')
@@ -63,7 +108,7 @@ if __name__=='__main__':
 
         with open('finger.data','rb') as g:
             f.write(g.read())
-            
+        
         f.write(b'\x00\x00\xF4\x52')
         f.write(b'\x07\xD5\x0C\x0F\x11\x23\x13\x00\x00')
         f.write(b'\x00\xAB\xCD\x12\x35')
@@ -85,4 +130,205 @@ if __name__=='__main__':
 
         with open('finger.data','rb') as g:
             f.write(g.read())
-            
+
+class Generator:
+    """Deterministic generator of FIR and FAC records
+
+    ``formats`` are the formats of the records (``FIR`` and/or ``FAC``), drawn
+    at random. The records have from 1 to ``max_frames`` frames. ``variants`` is
+    the number of different images for each size and compression.
+    """
+
+    def __init__(self, seed=0, formats=('FIR', 'FAC'), max_frames=14, variants=4,
+            fir_sizes=FIR_SIZES, fac_sizes=FAC_SIZES,
+            fir_compressions=FIR_COMPRESSIONS, fac_compressions=FAC_COMPRESSIONS):
+        self.seed = seed
+        self.formats = list(formats)
+        self.max_frames = max_frames
+        self.variants = variants
+        self.fir_sizes = fir_sizes
+        self.fac_sizes = fac_sizes
+        self.fir_compressions = fir_compressions
+        self.fac_compressions = fac_compressions
+        # encoded images: (format, variant, size, compression) -> one frame record
+        self._templates = {}
+
+    def record(self, index):
+        "Return the format and the content of the record ``index``"
+        rand = random.Random("%s-%d" % (self.seed, index))
+        format = rand.choice(self.formats)
+        if format == 'FIR':
+            images = self._fir_images(rand)
+            options = {}
+        else:
+            images = self._fac_images(rand)
+            options = dict(version='010')
+        buffer = io.BytesIO()
+        images[0].save(buffer, format, save_all=True, append_images=images[1:], **options)
+        return format, buffer.getvalue()
+
+    def records(self, start=0, count=None):
+        "Yield ``(index, format, content)`` for the records from ``start``"
+        index = start
+        while count is None or index < start + count:
+            yield (index,) + self.record(index)
+            index += 1
+
+    def _frame(self, rand, format, size, compression, mode):
+        # Return a frame decoded from a template, its image data are copied when saved
+        key = (format, rand.randrange(self.variants), size, compression)
+        if key not in self._templates:
+            im = _sample_image(random.Random("%s-%s" % (self.seed, key)), mode, size)
+            if format == 'FIR':
+                im.header = dict(image_compression_algo=compression)
+                options = {}
+            else:
+                im.header = dict(image_data_type=compression)
+                options = dict(version='010')
+            buffer = io.BytesIO()
+            im.save(buffer, format, **options)
+            self._templates[key] = buffer.getvalue()
+        return PIL.Image.open(io.BytesIO(self._templates[key]))
+
+    def _fir_images(self, rand):
+        positions = rand.sample(sorted(FIR.POSITION), rand.randint(1, self.max_frames))
+        certification = rand.random() < 0.2
+        capture = _datetime(rand)
+        images = []
+        for number, position in enumerate(positions):
+            if position in _PALMS:
+                kind, impression = 'palm', 'LIVESCAN_PALM'
+            elif position in _SLAPS:
+                kind, impression = 'slap', 'LIVESCAN_PLAIN'
+            else:
+                kind, impression = 'finger', rand.choice(['LIVESCAN_PLAIN', 'LIVESCAN_ROLLED'])
+            compression = rand.choice(self.fir_compressions)
+            im = self._frame(rand, 'FIR', rand.choice(self.fir_sizes[kind]), compression, "L")
+            resolution = rand.choice([500, 1000])
+            im.header = dict(
+                capture_datetime=capture,
+                capture_device_technology_id=bytes([rand.randrange(20)]),
+                capture_device_vendor_id=rand.randrange(65536).to_bytes(2, 'big'),
+                capture_device_type_id=rand.randrange(65536).to_bytes(2, 'big'),
+                quality_records=[_quality(rand, FIR.FIRQualityRecord) for _ in range(rand.randint(0, 3))],
+                certification_records=[
+                    FIR.FIRCertificationRecord(rand.randrange(65536).to_bytes(2, 'big'), bytes([rand.randrange(256)]))
+                    for _ in range(rand.randint(1, 2) if certification else 0)],
+                position=position,
+                number=number,
+                scale_units='PPI',
+                horizontal_scan_sampling_rate=resolution,
+                vertical_scan_sampling_rate=resolution,
+                horizontal_image_sampling_rate=resolution,
+                vertical_image_sampling_rate=resolution,
+                image_compression_algo=compression,
+                impression_type=impression)
+            images.append(im)
+        return images
+
+    def _fac_images(self, rand):
+        images = []
+        for _ in range(rand.randint(1, self.max_frames)):
+            compression = rand.choice(self.fac_compressions)
+            size = rand.choice(self.fac_sizes)
+            im = self._frame(rand, 'FAC', size, compression, "RGB")
+            im.header = dict(
+                landmark_points=[
+                    FAC.FACLandmarkPoint(1, rand.randrange(1, 16), rand.randrange(size[0]), rand.randrange(size[1]), 0)
+                    for _ in range(rand.randint(0, 8))],
+                gender=rand.choice(sorted(FAC.GENDER)),
+                eye_colour=rand.choice(sorted(FAC.EYE_COLOUR)),
+                hair_colour=rand.choice(sorted(FAC.HAIR_COLOUR)),
+                property_mask=rand.sample(sorted(FAC.PROPERTY_FLAGS), rand.randint(0, 3)),
+                expression=rand.choice(sorted(FAC.EXPRESSION)),
+                pose_yaw=rand.randint(-90, 90),
+                pose_pitch=rand.randint(-90, 90),
+                pose_roll=rand.randint(-90, 90),
+                pose_uncertainty_yaw=rand.randint(0, 90),
+                pose_uncertainty_pitch=rand.randint(0, 90),
+                pose_uncertainty_roll=rand.randint(0, 90),
+                face_image_type=rand.choice(sorted(FAC.FACE_IMAGE_TYPE)),
+                image_data_type=compression,
+                source_type=rand.choice(sorted(FAC.SOURCE_TYPE)),
+                device_type=rand.randrange(65536).to_bytes(2, 'big'),
+                quality=rand.randrange(65536).to_bytes(2, 'big'))
+            images.append(im)
+        return images
+
+def _sample_image(rand, mode, size):
+    # Concentric ellipses around a random center, looking like a finger or a face
+    im = PIL.Image.new(mode, size, "white")
+    draw = PIL.ImageDraw.Draw(im)
+    width, height = size
+    cx, cy = rand.uniform(0.3, 0.7) * width, rand.uniform(0.3, 0.7) * height
+    step = rand.randint(5, 9)
+    for r in range(step, max(width, height), step):
+        draw.ellipse((cx - r, cy - r * 1.3, cx + r, cy + r * 1.3), outline="black", width=2)
+    return im
+
+def _datetime(rand):
+    return datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=rand.randrange(20 * 365 * 86400))
+
+def _quality(rand, factory):
+    return factory(rand.randint(0, 100), rand.randrange(65536).to_bytes(2, 'big'), rand.randrange(65536).to_bytes(2, 'big'))
+
+def _parse_size(text):
+    # Parse a size like 500M or 4G
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1:].upper()])
+    return int(text)
+
+def write_corpus(generator, directory, count, start=0):
+    "Write ``count`` records to ``directory``, one file per record"
+    os.makedirs(directory, exist_ok=True)
+    for index, format, data in generator.records(start, count):
+        with open(os.path.join(directory, "%08d.%s" % (index, format.lower())), 'wb') as f:
+            f.write(data)
+
+def write_dump(generator, fp, size, start=0):
+    """Write records one after the other to ``fp`` until ``size`` bytes are written
+
+    Return the number of records written.
+    """
+    written = count = 0
+    for index, format, data in generator.records(start):
+        if written >= size:
+            break
+        fp.write(data)
+        written += len(data)
+        count += 1
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build synthetic ISO 19794 records")
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    commands.required = True
+    commands.add_parser('samples', help='write the sample files of the tests in the current directory')
+    corpus = commands.add_parser('corpus', help='write records to a directory, one file per record')
+    corpus.add_argument('directory')
+    corpus.add_argument('--count', type=int, default=1000)
+    dump = commands.add_parser('dump', help='write concatenated records to a file')
+    dump.add_argument('file')
+    dump.add_argument('--size', type=_parse_size, default='1G', help='size of the file, like 500M or 4G')
+    for command in (corpus, dump):
+        command.add_argument('--seed', type=int, default=0)
+        command.add_argument('--start', type=int, default=0, help='index of the first record')
+        command.add_argument('--formats', nargs='+', choices=['FIR', 'FAC'], default=['FIR', 'FAC'])
+        command.add_argument('--max-frames', type=int, default=14)
+        command.add_argument('--variants', type=int, default=4, help='number of images per size and compression')
+    args = parser.parse_args(argv)
+
+    if args.command == 'samples':
+        build_samples()
+        return 0
+    generator = Generator(args.seed, args.formats, args.max_frames, args.variants)
+    if args.command == 'corpus':
+        write_corpus(generator, args.directory, args.count, args.start)
+    else:
+        with open(args.file, 'wb') as f:
+            write_dump(generator, f, args.size, args.start)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,13 @@
 
 import unittest
+import unittest.mock
 import io
 import os
 import datetime
 
 import PIL.Image
 import PIL.ImageDraw
+import PIL.ImageStat
 import iso19794
 from iso19794.FIR import *
 
@@ -45,6 +47,191 @@ class TestFIR(unittest.TestCase):
         with self.assertRaises(EOFError):
             i.seek(2)
 
+    def test_frame_index(self):
+        i = PIL.Image.open(os.path.join(os.path.dirname(__file__),'twofingers.fir'))
+        # Only the first header is parsed when opening
+        self.assertIsNone(i._frame_headers[1])
+        self.assertEqual(i.find_frames(position='LEFT_MIDDLE_FINGER'),[1])
+        self.assertEqual(i.find_frames(impression_type='LIVESCAN_ROLLED'),[0,1])
+        self.assertEqual(i.find_frames(position='LEFT_MIDDLE_FINGER',impression_type='LIVESCAN_PLAIN'),[])
+        self.assertEqual(i._frame_pos,[16,16+0xF452])
+
+        # Modified headers are kept when moving between frames
+        i.seek(1)
+        i.header['position'] = 'RIGHT_THUMB'
+        i.seek(0)
+        self.assertEqual(i.find_frames(position='RIGHT_THUMB'),[1])
+        i.seek(1)
+        self.assertEqual(i.header['position'],'RIGHT_THUMB')
+        self.assertEqual(i.tile[0][2],16+0xF452+46)
+
+    def test_mmap(self):
+        filename = os.path.join(os.path.dirname(__file__),'twofingers.fir')
+        ref = PIL.Image.open(filename)
+        ref.seek(1)
+        self.assertIsInstance(ref.image_data(),bytes)
+        FIRImageFile.use_mmap = True
+        try:
+            i = PIL.Image.open(filename)
+            self.assertIsInstance(i.image_data(),memoryview)
+            self.assertEqual(len(i.image_data(1)),250*250)
+            self.assertEqual(i.find_frames(position='LEFT_MIDDLE_FINGER'),[1])
+            i.seek(1)
+            self.assertEqual(i.header,ref.header)
+            self.assertEqual(i.image_data(),ref.image_data())
+            self.assertEqual(i.tobytes(),ref.tobytes())
+            i.close()
+
+            # Not a file on disk
+            with open(filename,'rb') as f:
+                i = PIL.Image.open(io.BytesIO(f.read()))
+            self.assertIsInstance(i.image_data(),bytes)
+            i.seek(1)
+            self.assertEqual(i.tobytes(),ref.tobytes())
+        finally:
+            FIRImageFile.use_mmap = False
+
+    def test_keep_image_data(self):
+        i = PIL.Image.open(os.path.join(os.path.dirname(__file__),'twofingers.fir'))
+        sample = PIL.Image.new("L",(200,300),255)
+        sample.header = dict(image_compression_algo='JPEG2000_LOSSY')
+        buffer = io.BytesIO()
+        sample.save(buffer,"FIR",save_all=True,append_images=[i])
+        lossy = PIL.Image.open(buffer)
+        data = [bytes(d) for h,c,d in lossy.iter_payloads()]
+
+        # Only the header is modified: the image data are copied
+        lossy.header['position'] = 'RIGHT_THUMB'
+        # loading does not copy the pixels
+        with unittest.mock.patch.object(lossy,'tobytes',side_effect=AssertionError):
+            lossy.load()
+        buffer = io.BytesIO()
+        lossy.save(buffer,"FIR",save_all=True)
+        copy = PIL.Image.open(buffer)
+        self.assertEqual([bytes(d) for h,c,d in copy.iter_payloads()],data)
+        self.assertEqual(copy.header['position'],'RIGHT_THUMB')
+        self.assertEqual(copy.n_frames,3)
+
+        # The pixels are modified: the image is encoded again
+        lossy.putpixel((0,0),0)
+        buffer = io.BytesIO()
+        lossy.save(buffer,"FIR")
+        copy = PIL.Image.open(buffer)
+        self.assertNotEqual(bytes(copy.image_data()),data[0])
+        self.assertEqual(copy.getpixel((0,0)),0)
+
+        # The compression is modified
+        i.seek(1)
+        i.header['image_compression_algo'] = 'JPEG'
+        buffer = io.BytesIO()
+        i.save(buffer,"FIR")
+        copy = PIL.Image.open(buffer)
+        self.assertEqual(copy.header['image_compression_algo'],'JPEG')
+        self.assertNotEqual(bytes(copy.image_data()),data[2])
+
+        # Encoding can be forced
+        i.header['image_compression_algo'] = 'RAW'
+        buffer = io.BytesIO()
+        i.save(buffer,"FIR",reencode=True)
+        self.assertEqual(bytes(PIL.Image.open(buffer).image_data()),data[2])
+
+    def test_keep_image_data_same_file(self):
+        import shutil
+        import tempfile
+        from iso19794.base import ISO19794ImageFile
+        tests = os.path.dirname(__file__)
+        ref = PIL.Image.open(os.path.join(tests,'twofingers.fir'))
+        ref.seek(1)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp,'twofingers.fir')
+            for use_mmap in (False, True):
+                ISO19794ImageFile.use_mmap = use_mmap
+                try:
+                    # the header of a loaded frame is fixed in place
+                    shutil.copy(os.path.join(tests,'twofingers.fir'),filename)
+                    i = PIL.Image.open(filename)
+                    i.seek(1)
+                    i.load()
+                    i.header['position'] = 'LEFT_THUMB'
+                    i.save(i.filename,"FIR")
+                    with PIL.Image.open(filename) as copy:
+                        self.assertEqual(copy.header['position'],'LEFT_THUMB')
+                        self.assertEqual(bytes(copy.image_data()),bytes(ref.image_data()))
+                    # the image still reads the original record
+                    i.seek(0)
+                    self.assertEqual(i.header['position'],'LEFT_INDEX_FINGER')
+                    i.close()
+
+                    # all the frames
+                    shutil.copy(os.path.join(tests,'twofingers.fir'),filename)
+                    i = PIL.Image.open(filename)
+                    i.load()
+                    i.save(filename,"FIR",save_all=True)
+                    i.close()
+                    with PIL.Image.open(filename) as copy:
+                        self.assertEqual(copy.n_frames,2)
+                        copy.seek(1)
+                        self.assertEqual(copy.tobytes(),ref.tobytes())
+                finally:
+                    ISO19794ImageFile.use_mmap = False
+
+    def test_keep_image_data_options(self):
+        sample = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir')).convert("L")
+        cases = [
+            ('PNG', dict(png_preset='compact')),
+            ('PNG', dict(compress_level=9)),
+            ('RAW_PACKED', dict(bit_depth=1)),
+            ('JPEG2000_LOSSY', dict(jpeg2000_profile='transmission-15:1')),
+            ('JPEG2000_LOSSY', dict(quality_layers=(40,))),
+            ]
+        try:
+            import numpy
+            cases.append(('WSQ', dict(wsq_bitrate=2)))
+        except ImportError:
+            pass
+        for compression, options in cases:
+            sample.header = dict(image_compression_algo=compression)
+            buffer = io.BytesIO()
+            sample.save(buffer,"FIR")
+            i = PIL.Image.open(buffer)
+            data = bytes(i.image_data())
+            for save_all in (False, True):
+                with self.subTest(compression=compression, options=options, save_all=save_all):
+                    # without option the image data are copied, not with an option of the encoder
+                    copy = io.BytesIO()
+                    i.save(copy,"FIR",save_all=save_all)
+                    self.assertEqual(bytes(PIL.Image.open(copy).image_data()),data)
+                    copy = io.BytesIO()
+                    i.save(copy,"FIR",save_all=save_all,**options)
+                    self.assertNotEqual(bytes(PIL.Image.open(copy).image_data()),data)
+
+    def test_keep_image_data_modified(self):
+        ref = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir'))
+        data = bytes(ref.image_data())
+        def saved(i):
+            buffer = io.BytesIO()
+            i.save(buffer,"FIR")
+            return PIL.Image.open(buffer)
+
+        # saving twice keeps the image data
+        i = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir'))
+        self.assertEqual(bytes(saved(i).image_data()),data)
+        self.assertEqual(bytes(saved(i).image_data()),data)
+
+        # the pixels are changed through the pixel access, paste or ImageDraw
+        for modify in (lambda i: i.load().__setitem__((0,0),0),
+                lambda i: i.paste(0,(0,0,1,1)),
+                lambda i: PIL.ImageDraw.Draw(i).point((0,0),0)):
+            for load in (False, True):
+                i = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir'))
+                if load:
+                    i.load()
+                self.assertNotEqual(i.getpixel((0,0)),0)
+                modify(i)
+                copy = saved(i)
+                self.assertNotEqual(bytes(copy.image_data()),data)
+                self.assertEqual(copy.getpixel((0,0)),0)
+
     def test_multi(self):
         i1 = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir'))
         i2 = PIL.Image.open(os.path.join(os.path.dirname(__file__),'twofingers.fir'))
@@ -55,6 +242,330 @@ class TestFIR(unittest.TestCase):
         self.assertEqual(i.info['nb_representation'],3)
         self.assertEqual(i.info['nb_position'],2)
 
+    def test_streaming(self):
+        i1 = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir'))
+        i2 = PIL.Image.open(os.path.join(os.path.dirname(__file__),'twofingers.fir'))
+        ref = io.BytesIO()
+        i1.save(ref,"FIR",save_all=True,append_images=[i2])
+        self.assertEqual(int.from_bytes(ref.getvalue()[8:12],'big'),len(ref.getvalue()))
+
+        # Seekable file not at the beginning
+        buf = io.BytesIO()
+        buf.write(b"prefix")
+        i1.save(buf,"FIR",save_all=True,append_images=[i2])
+        self.assertEqual(buf.getvalue()[6:],ref.getvalue())
+
+        # Non seekable file
+        class Stream(io.RawIOBase):
+            def __init__(self):
+                self.data = b""
+            def writable(self):
+                return True
+            def write(self, b):
+                self.data += bytes(b)
+                return len(b)
+        import iso19794.base
+        size = iso19794.base.SPOOL_SIZE
+        try:
+            for spool in (1000, size):
+                iso19794.base.SPOOL_SIZE = spool
+                stream = Stream()
+                i1.save(stream,"FIR",save_all=True,append_images=[i2])
+                self.assertEqual(stream.data,ref.getvalue())
+        finally:
+            iso19794.base.SPOOL_SIZE = size
+
+    def test_parallel_encoding(self):
+        import concurrent.futures
+        i = PIL.Image.open(os.path.join(os.path.dirname(__file__),'twofingers.fir'))
+        i.header['image_compression_algo'] = 'JPEG2000_LOSSLESS'
+        i.seek(1)
+        i.header['image_compression_algo'] = 'JPEG'
+        sample = PIL.Image.new("L",(200,300),128)
+        sample.header = dict(image_compression_algo='JPEG2000_LOSSY',capture_datetime=datetime.datetime(2020,1,1))
+        extra = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir'))
+
+        ref = io.BytesIO()
+        i.save(ref,"FIR",save_all=True,append_images=[sample,extra])
+
+        buf = io.BytesIO()
+        i.save(buf,"FIR",save_all=True,append_images=[sample,extra],encoder_workers=3)
+        self.assertEqual(buf.getvalue(),ref.getvalue())
+
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            buf = io.BytesIO()
+            i.save(buf,"FIR",save_all=True,append_images=[sample,extra],encoder_executor=executor)
+        self.assertEqual(buf.getvalue(),ref.getvalue())
+
+        result = iso19794.scan(buf.getvalue())
+        self.assertEqual([h['number'] for h in result.headers],[h['number'] for h in iso19794.scan(ref.getvalue()).headers])
+        self.assertEqual([h['image_compression_algo'] for h in result.headers],['JPEG2000_LOSSLESS','JPEG','JPEG2000_LOSSY','RAW'])
+
+    def test_decode_all(self):
+        import concurrent.futures
+        filename = os.path.join(os.path.dirname(__file__),'twofingers.fir')
+        i = PIL.Image.open(filename)
+        ref = []
+        for frame in range(i.n_frames):
+            i.seek(frame)
+            ref.append((i.mode,i.size,i.tobytes(),i.header))
+        i.seek(0)
+
+        frames = i.decode_all()
+        self.assertEqual([(im.mode,im.size,im.tobytes(),header) for im,header in frames],ref)
+        frames = i.decode_all(workers=2)
+        self.assertEqual([(im.mode,im.size,im.tobytes(),im.header) for im,header in frames],ref)
+        self.assertEqual(i.tell(),0)
+
+        with open(filename,'rb') as f:
+            i = PIL.Image.open(io.BytesIO(f.read()))
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            frames = i.decode_all(executor=executor)
+        self.assertEqual([(im.mode,im.size,im.tobytes(),header) for im,header in frames],ref)
+
+    def test_decode_all_spawn(self):
+        # the decoders of the plugins are available in spawned processes
+        import concurrent.futures, multiprocessing
+        try:
+            import numpy
+            compressions = ['RAW_PACKED','PNG','WSQ']
+        except ImportError:
+            compressions = ['PNG']
+        sample = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir')).convert("L")
+        images = []
+        for compression in compressions:
+            im = sample.copy()
+            im.header = dict(image_compression_algo=compression)
+            images.append(im)
+        buffer = io.BytesIO()
+        images[0].save(buffer,"FIR",save_all=True,append_images=images[1:],bit_depth=4)
+        i = PIL.Image.open(buffer)
+        ref = [(im.mode,im.size,im.tobytes()) for im,header in i.decode_all()]
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(2,mp_context=context) as executor:
+            frames = i.decode_all(executor=executor)
+        self.assertEqual([(im.mode,im.size,im.tobytes()) for im,header in frames],ref)
+
+    def test_frame_array(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        filename = os.path.join(os.path.dirname(__file__),'twofingers.fir')
+        ref = PIL.Image.open(filename)
+        ref.seek(1)
+        ref.load()
+        for use_mmap in (False, True):
+            FIRImageFile.use_mmap = use_mmap
+            try:
+                i = PIL.Image.open(filename)
+                a = i.frame_array(1)
+                self.assertEqual(a.shape,(250,250))
+                self.assertFalse(a.flags.writeable)
+                self.assertEqual(a.tobytes(),ref.tobytes())
+                self.assertEqual(i.tell(),0)
+                del a
+                i.close()
+            finally:
+                FIRImageFile.use_mmap = False
+
+        # decoded
+        buffer = io.BytesIO()
+        ref.header['image_compression_algo'] = 'JPEG'
+        ref.save(buffer,"FIR")
+        i = PIL.Image.open(buffer)
+        i.load()
+        a = i.frame_array()
+        self.assertEqual(a.shape,(250,250))
+        self.assertEqual(a.tobytes(),i.tobytes())
+
+    def test_raw_packed(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        sample = PIL.Image.linear_gradient("L").resize((101,37))
+        sample.header = dict(image_compression_algo='RAW_PACKED')
+        for bit_depth in (1,3,4,7,8):
+            buffer = io.BytesIO()
+            sample.save(buffer,"FIR",bit_depth=bit_depth)
+            self.assertEqual(len(buffer.getvalue()),57+(101*37*bit_depth+7)//8)
+            i = PIL.Image.open(buffer)
+            i.load()
+            self.assertEqual((i.mode,i.size),("L",(101,37)))
+            self.assertEqual(iso19794.scan(buffer.getvalue()).headers[0]['bit_depth'],bit_depth)
+            shift = 8-bit_depth
+            self.assertEqual(i.point(lambda v: v>>shift).tobytes(),sample.point(lambda v: v>>shift).tobytes())
+            # lossless when saved again
+            other = io.BytesIO()
+            i.save(other,"FIR",bit_depth=bit_depth,reencode=True)
+            self.assertEqual(other.getvalue()[57:],buffer.getvalue()[57:])
+
+        # lines starting on a byte boundary
+        from iso19794.FIR import _pack_bits, _unpack
+        pixels = numpy.asarray(sample)>>4
+        data = _pack_bits(pixels,4)
+        self.assertEqual(data.shape,(37,51))
+        self.assertEqual(_unpack(data.tobytes(),4,101,37),(pixels*17).astype(numpy.uint8).tobytes())
+        with self.assertRaises(ValueError):
+            sample.save(io.BytesIO(),"FIR",bit_depth=12)
+
+    def test_png(self):
+        sample = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir')).convert("L")
+        sample.header = dict(image_compression_algo='PNG')
+        sizes = {}
+        for preset in ('fast','default','compact'):
+            buffer = io.BytesIO()
+            sample.save(buffer,"FIR",png_preset=preset)
+            sizes[preset] = len(buffer.getvalue())
+            self.assertEqual(buffer.getvalue()[57:65],b"\x89PNG\r\n\x1a\n")
+            i = PIL.Image.open(buffer)
+            self.assertEqual((i.mode,i.size,i.header['image_compression_algo']),("L",sample.size,'PNG'))
+            self.assertEqual(i.tobytes(),sample.tobytes())
+        self.assertLessEqual(sizes['compact'],sizes['fast'])
+        with self.assertRaises(ValueError):
+            sample.save(io.BytesIO(),"FIR",png_preset='smallest')
+        # the explicit options win over the preset
+        for options in (dict(png_preset='compact',optimize=False,compress_level=1),dict(compress_level=1)):
+            buffer = io.BytesIO()
+            sample.save(buffer,"FIR",**options)
+            self.assertEqual(len(buffer.getvalue()),sizes['fast'])
+
+    def test_draft(self):
+        sample = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir')).convert("L")
+        width, height = sample.size
+        reduced = lambda scale: ((width+scale-1)//scale, (height+scale-1)//scale)
+        records = {}
+        for compression in ('RAW','JPEG','JPEG2000_LOSSLESS','PNG'):
+            sample.header = dict(image_compression_algo=compression)
+            records[compression] = io.BytesIO()
+            sample.save(records[compression],"FIR",save_all=True,append_images=[sample])
+
+        # RAW: one pixel every 4 pixels
+        i = PIL.Image.open(records['RAW'])
+        self.assertEqual(i.draft(None,(80,120)),("L",(0,0,width/4,height/4)))
+        self.assertEqual(i.size,reduced(4))
+        data = sample.tobytes()
+        self.assertEqual(i.tobytes(),b"".join(data[y*width:(y+1)*width:4] for y in range(0,height,4)))
+        self.assertIsNone(i.draft(None,(10,10)))
+        i.seek(1)
+        self.assertEqual(i.draft(None,(0,height//4))[1],(0,0,width/4,height/4))
+        i.seek(0)
+        self.assertEqual(i.draft(None,(-1,0))[1],(0,0,1.0,height/width))
+        # seeking cancels the draft, the reduced frame is encoded when saved
+        i.seek(1)
+        self.assertEqual(i.size,sample.size)
+        i.seek(0)
+        self.assertEqual(i.draft(None,(80,120))[1],(0,0,width/4,height/4))
+        i.load()
+        buffer = io.BytesIO()
+        i.save(buffer,"FIR")
+        self.assertEqual(PIL.Image.open(buffer).size,reduced(4))
+
+        # JPEG: DCT scaling by 1/2, 1/4 or 1/8
+        i = PIL.Image.open(records['JPEG'])
+        self.assertEqual(i.draft(None,(80,120))[1],(0,0,width/4,height/4))
+        i.load()
+        self.assertEqual((i.mode,i.size),("L",reduced(4)))
+        i = PIL.Image.open(records['JPEG'])
+        i.draft(None,(30,50))
+        self.assertEqual(i.size,reduced(8))
+
+        # JPEG 2000: resolution level, up to the number of decomposition levels
+        i = PIL.Image.open(records['JPEG2000_LOSSLESS'])
+        self.assertEqual(i.draft(None,(80,120))[1],(0,0,width/4,height/4))
+        i.load()
+        self.assertEqual(i.size,reduced(4))
+        self.assertLess(abs(PIL.ImageStat.Stat(i).mean[0]-PIL.ImageStat.Stat(sample).mean[0]),5)
+        i = PIL.Image.open(records['JPEG2000_LOSSLESS'])
+        i.draft(None,(1,1))
+        self.assertEqual(i.size,reduced(32))
+        i.load()
+
+        # other compressions are not reduced
+        i = PIL.Image.open(records['PNG'])
+        self.assertIsNone(i.draft(None,(80,120)))
+        i.thumbnail((80,120))
+        self.assertEqual(max(i.size),120)
+
+        # JP2 file format
+        jp2 = io.BytesIO()
+        sample.save(jp2,"JPEG2000",num_resolutions=3)
+        im = PIL.Image.new("L",sample.size)
+        im.header = dict(image_compression_algo='JPEG2000_LOSSY', number=0)
+        buffer = io.BytesIO()
+        buffer.seek(16)
+        length = iso19794.FIR._save_frame(im,buffer,False,encoded=(jp2.getvalue(),8))
+        buffer.seek(0)
+        buffer.write(iso19794.FIR._GENERAL_HEADER.pack(b"FIR\x00",b"020\x00",16+length,1,False,1))
+        i = PIL.Image.open(buffer)
+        i.draft(None,(10,10))
+        self.assertEqual(i.size,reduced(4))
+        i.load()
+
+    def test_save_all_options(self):
+        # the options given to save() apply to the appended images too
+        sample = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir')).convert("L")
+        def record(compression, **options):
+            images = []
+            for _ in range(3):
+                im = sample.copy()
+                im.header = dict(image_compression_algo=compression)
+                images.append(im)
+            buffer = io.BytesIO()
+            images[0].save(buffer,"FIR",save_all=True,append_images=images[1:],**options)
+            return [bytes(d) for h,c,d in PIL.Image.open(buffer).iter_payloads()]
+        def same_frames(data):
+            self.assertEqual(len(data),3)
+            self.assertEqual(data[1:],data[:2])
+        for workers in (None,2):
+            data = record('PNG',png_preset='fast',encoder_workers=workers)
+            same_frames(data)
+            self.assertNotEqual(data,record('PNG',png_preset='compact',encoder_workers=workers))
+            data = record('JPEG2000_LOSSLESS',jpeg2000_profile='archival',encoder_workers=workers)
+            same_frames(data)
+            self.assertEqual(data[0],record('JPEG2000_LOSSLESS',jpeg2000_profile='archival')[0])
+        try:
+            import numpy
+        except ImportError:
+            return
+        data = record('RAW_PACKED',bit_depth=4)
+        same_frames(data)
+        self.assertEqual(len(data[0]),(375*625*4+7)//8)
+        data = record('WSQ',wsq_bitrate=2)
+        same_frames(data)
+        self.assertGreater(len(data[2]),len(record('WSQ')[2])*2)
+
+    def test_jpeg2000_profile(self):
+        def coding_style(data):
+            # progression order, number of layers and decomposition levels (COD segment)
+            i = data.index(b"\xff\x52")
+            return data[i+5], int.from_bytes(data[i+6:i+8],'big'), data[i+9]
+        sample = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir')).convert("L")
+        sample.header = dict(image_compression_algo='JPEG2000_LOSSLESS')
+        buffer = io.BytesIO()
+        sample.save(buffer,"FIR")
+        self.assertEqual(coding_style(buffer.getvalue()),(0,1,5))
+        buffer = io.BytesIO()
+        sample.save(buffer,"FIR",jpeg2000_profile='archival')
+        self.assertEqual(coding_style(buffer.getvalue()),(2,3,5))    # RPCL
+        i = PIL.Image.open(buffer)
+        self.assertEqual(i.tobytes(),sample.tobytes())
+        # explicit options override the profile
+        buffer = io.BytesIO()
+        sample.save(buffer,"FIR",jpeg2000_profile='fast-lossless',num_resolutions=2)
+        self.assertEqual(coding_style(buffer.getvalue()),(0,1,1))
+        # the number of resolutions is limited by the image size
+        small = sample.resize((24,40))
+        small.header = dict(image_compression_algo='JPEG2000_LOSSY')
+        buffer = io.BytesIO()
+        small.save(buffer,"FIR",jpeg2000_profile='transmission-15:1')
+        self.assertEqual(coding_style(buffer.getvalue()),(2,1,4))
+        with self.assertRaises(ValueError):
+            sample.save(io.BytesIO(),"FIR",jpeg2000_profile='transmission-15:1')
+        with self.assertRaises(ValueError):
+            sample.save(io.BytesIO(),"FIR",jpeg2000_profile='unknown')
+
     def test_v20(self):
         sample = PIL.Image.new("L",(200,300),255)
         draw = PIL.ImageDraw.Draw(sample)
@@ -108,7 +619,7 @@ class TestFIR(unittest.TestCase):
             sample.seek(1)
 
         # Read the multi frame image
-        nsample = Image.open(buffer)
+        nsample = PIL.Image.open(buffer)
         self.assertEqual(nsample.mode,'L')
         self.assertEqual(nsample.size, (200, 300))
         self.assertEqual(nsample.header['certification_records'][0].authority_id, b'x\xab')
@@ -119,7 +630,7 @@ class TestFIR(unittest.TestCase):
         sample.save(buffer,"FIR")
         self.assertLess(len(buffer.getvalue()), 200*300 + 42 + 3 + 16 - 1)
 
-        nsample = Image.open(buffer_multi)
+        nsample = PIL.Image.open(buffer_multi)
         buffer = io.BytesIO()
         nsample.header['image_compression_algo'] ='JPEG'
         nsample.seek(1)
@@ -225,12 +736,53 @@ class TestFAC(unittest.TestCase):
         nsample2.seek(1)
         data = nsample2.load()
 
+        # reduced size
+        nsample2 = PIL.Image.open(buffer)
+        self.assertEqual(nsample2.draft(None,(50,75)),("RGB",(0,0,50,75)))
+        nsample2.load()
+        self.assertEqual(nsample2.size,(50,75))
+        nsample2 = PIL.Image.open(buffer_multi)
+        nsample2.seek(1)
+        self.assertEqual(nsample2.draft(None,(100,150)),("RGB",(0,0,100,150)))
+        nsample2.load()
+        self.assertEqual(nsample2.size,(100,150))
+
+        # JPEG2000 profile, for all the frames
+        other = io.BytesIO()
+        nsample.save(other,"FAC",version='010',save_all=True,jpeg2000_profile='transmission-15:1')
+        self.assertGreater(len(other.getvalue()),len(buffer.getvalue()))
+        appended = io.BytesIO()
+        sample.header['image_data_type'] = 'JPEG2000'
+        copy = sample.copy()
+        copy.header = dict(sample.header)
+        sample.save(appended,"FAC",version='010',save_all=True,append_images=[copy],jpeg2000_profile='transmission-15:1')
+        data = [bytes(d) for h,c,d in PIL.Image.open(appended).iter_payloads()]
+        self.assertEqual(data[0],data[1])
+
         # Invalid image data type
         buffer = io.BytesIO()
         sample.header['image_data_type'] = 'UNKNOWN'
         with self.assertRaises(SyntaxError,msg="Unknown compression algo UNKNOWN"):
             sample.save(buffer,"FAC",version='010')
 
+    def test_iter_payloads(self):
+        sample = PIL.Image.new("RGB",(200,300),255)
+        sample.header = dict(image_data_type='JPEG2000')
+        buffer_multi = io.BytesIO()
+        sample.save(buffer_multi,"FAC",save_all=True,append_images=[sample],version='010')
+
+        nsample = PIL.Image.open(buffer_multi)
+        nsample.header['image_data_type'] = 'JPEG'
+        payloads = list(nsample.iter_payloads())
+        self.assertEqual(nsample.tell(),0)
+        self.assertEqual(len(payloads),2)
+        header,codec,data = payloads[1]
+        self.assertEqual(codec,'JPEG2000')
+        self.assertEqual(header['image_data_type'],'JPEG2000')
+        self.assertEqual(payloads[0][0]['image_data_type'],'JPEG')
+        self.assertEqual(data[:4],b"\xff\x4f\xff\x51")
+        self.assertEqual(PIL.Image.open(io.BytesIO(data)).tobytes(),sample.tobytes())
+
     def test_v010_property_mask(self):
         # Builid a sample image
         sample = PIL.Image.new("RGB",(200,300),255)
@@ -259,9 +811,645 @@ class TestFAC(unittest.TestCase):
         self.assertEqual(buffer1.getvalue()[23:26],b"\x00\x00\x02")
         self.assertEqual(buffer2.getvalue()[23:26],b"\x00\x02\x8a")
 
+#_______________________________________________________________________________
+class TestRecord(unittest.TestCase):
+
+    def test_enum(self):
+        self.assertEqual(POSITION.names[7],'LEFT_INDEX_FINGER')
+        self.assertEqual(COMPRESSION.names[COMPRESSION['JPEG']],'JPEG')
+        enum = iso19794.record.Enum(A=1)
+        enum['B'] = 2
+        self.assertEqual(enum.names,{1:'A',2:'B'})
+
+    def test_layout(self):
+        layout = iso19794.record.Layout(('a','H'),('b','2s'))
+        self.assertEqual(layout.size,4)
+        self.assertEqual(layout.pack(258,b'xy'),b'\x01\x02xy')
+        records = layout.read_records(io.BytesIO(b'\x00\x01ab\x00\x02cd'),2,FIRCertificationRecord)
+        self.assertEqual(records[1],FIRCertificationRecord(2,b'cd'))
+
+    def test_header(self):
+        header = FIRHeader(position='LEFT_THUMB',capture_device_vendor_id=b'\x01\x02',quality_records=[])
+        self.assertEqual(header.position,6)
+        self.assertEqual(header.capture_device_vendor_id,258)
+        self.assertEqual(header,dict(position='LEFT_THUMB',capture_device_vendor_id=b'\x01\x02',quality_records=[]))
+        self.assertEqual(header.get('number'),None)
+        self.assertEqual(header.setdefault('number',3),3)
+        self.assertEqual(list(header),['capture_device_vendor_id','quality_records','position','number'])
+        del header['number']
+        self.assertNotIn('number',header)
+        with self.assertRaises(KeyError):
+            header['unknown'] = 1
+        copy = header.copy()
+        copy['position'] = 'RIGHT_THUMB'
+        self.assertEqual(header['position'],'LEFT_THUMB')
+
+#_______________________________________________________________________________
+class TestScan(unittest.TestCase):
+
+    def test_scan_fir(self):
+        result = iso19794.scan(os.path.join(os.path.dirname(__file__),'twofingers.fir'))
+        self.assertEqual(result.format,'FIR')
+        self.assertEqual(result.info['nb_representation'],2)
+        self.assertEqual(len(result.headers),2)
+        self.assertEqual(result.headers[0]['position'],'LEFT_INDEX_FINGER')
+        self.assertEqual(result.headers[1]['position'],'LEFT_MIDDLE_FINGER')
+        self.assertEqual(result.headers[1]['impression_type'],'LIVESCAN_ROLLED')
+        self.assertEqual(result.headers[1]['image_compression_algo'],'RAW')
+        self.assertEqual(result.headers[1]['horizontal_line_length'],250)
+        self.assertEqual(result.headers[1]['image_data_length'],250*250)
+
+        # Same headers as the reader
+        i = PIL.Image.open(os.path.join(os.path.dirname(__file__),'annexc.fir'))
+        result = iso19794.scan(os.path.join(os.path.dirname(__file__),'annexc.fir'))
+        self.assertEqual(result.headers[0]['certification_records'],i.header['certification_records'])
+        self.assertEqual((result.headers[0]['horizontal_line_length'],result.headers[0]['vertical_line_length']),i.size)
+
+    def test_scan_fac(self):
+        sample = PIL.Image.new("RGB",(200,300),255)
+        sample.header = dict(gender='F')
+        buffer = io.BytesIO()
+        sample.save(buffer,"FAC",save_all=True,append_images=[sample],version='010')
+
+        result = iso19794.scan(buffer.getvalue())
+        self.assertEqual(result.format,'FAC')
+        self.assertEqual(len(result.headers),2)
+        self.assertEqual(result.headers[1]['gender'],'F')
+        self.assertEqual((result.headers[1]['width'],result.headers[1]['height']),(200,300))
+        self.assertEqual(result.headers[1]['image_data_type'],'JPEG')
+
+    def test_scan_compact(self):
+        from iso19794.tests.build_image import Generator
+        generator = Generator(seed=1,max_frames=3,variants=1,fir_sizes=dict(finger=[(16,16)],slap=[(16,16)],palm=[(16,16)]),fac_sizes=[(16,16)])
+        for index,format,data in generator.records(0,6):
+            result = iso19794.scan(data,compact=True)
+            self.assertEqual(result,iso19794.scan(data))
+            self.assertTrue(all(isinstance(h,iso19794.record.Header) for h in result.headers))
+
+        # images with compact headers
+        from iso19794.base import ISO19794ImageFile
+        ISO19794ImageFile.compact_headers = True
+        try:
+            i = PIL.Image.open(os.path.join(os.path.dirname(__file__),'twofingers.fir'))
+            self.assertIsInstance(i.header,FIRHeader)
+            i.header['position'] = 'LEFT_THUMB'
+            buf = io.BytesIO()
+            i.save(buf,"FIR",save_all=True)
+            self.assertEqual([h['position'] for h in iso19794.scan(buf.getvalue()).headers],['LEFT_THUMB','LEFT_MIDDLE_FINGER'])
+        finally:
+            ISO19794ImageFile.compact_headers = False
+
+    def test_scan_lazy(self):
+        import pickle
+        from iso19794.FIR import FIRHeader
+        filename = os.path.join(os.path.dirname(__file__),'annexc.fir')
+        i = PIL.Image.open(filename)
+        for compact in (False, True):
+            result = iso19794.scan(filename,compact)
+            header = result.headers[0]
+            self.assertIsInstance(header,FIRHeader if compact else iso19794.record.LazyHeader)
+            self.assertEqual(header['certification_records'],i.header['certification_records'])
+            self.assertEqual({k: v for k, v in header.items() if k in i.header},dict(i.header))
+            self.assertEqual(pickle.loads(pickle.dumps(header)),header)
+            self.assertIs(type(pickle.loads(pickle.dumps(header))),FIRHeader if compact else dict)
+
+            # a field set before any other is read is kept
+            header = iso19794.scan(filename,compact).headers[0]
+            header['position'] = 'LEFT_THUMB'
+            self.assertEqual(header['position'],'LEFT_THUMB')
+            self.assertEqual(header['horizontal_line_length'],i.size[0])
+            copy = header.copy()
+            self.assertEqual(copy['position'],'LEFT_THUMB')
+
+        # truncated header
+        with open(filename,'rb') as f:
+            data = f.read()
+        with self.assertRaises(EOFError):
+            iso19794.scan(data[:40])
+
+    def test_scan_invalid(self):
+        with self.assertRaises(SyntaxError):
+            iso19794.scan(b"PNG\x00"+b"\x00"*16)
+
 # ______________________________________________________________________________
 if __name__=='__main__':
     unittest.main()
     
 
 	
+
+class TestConvert(unittest.TestCase):
+
+    def test_convert(self):
+        import tempfile
+        import contextlib
+        from iso19794.convert import main
+        tests = os.path.dirname(__file__)
+        with tempfile.TemporaryDirectory() as tmp:
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertEqual(main(['convert','-j','2','-c','JPEG2000_LOSSLESS',
+                    os.path.join(tests,'twofingers.fir'),os.path.join(tests,'annexc.fir'),tmp]),0)
+            self.assertTrue(out.getvalue().startswith("2 converted, 0 skipped, 0 failed"))
+            result = iso19794.scan(os.path.join(tmp,'twofingers.fir'))
+            self.assertEqual([h['image_compression_algo'] for h in result.headers],['JPEG2000_LOSSLESS','JPEG2000_LOSSLESS'])
+
+            # converted files are skipped
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertEqual(main(['convert','-j','1','--resume',tmp,tmp]),0)
+            self.assertTrue(out.getvalue().startswith("0 converted, 2 skipped, 0 failed"))
+
+            # export of the frames
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(main(['convert','-j','1','-f','png',tmp,os.path.join(tmp,'png')]),0)
+            self.assertEqual(sorted(os.listdir(os.path.join(tmp,'png'))),['annexc.0.png','twofingers.0.png','twofingers.1.png'])
+            with PIL.Image.open(os.path.join(tests,'twofingers.fir')) as i, PIL.Image.open(os.path.join(tmp,'png','twofingers.1.png')) as png:
+                i.seek(1)
+                self.assertEqual(png.tobytes(),i.tobytes())
+
+    def test_convert_mixed(self):
+        import shutil
+        import tempfile
+        import contextlib
+        from iso19794.convert import main
+        tests = os.path.dirname(__file__)
+        with tempfile.TemporaryDirectory() as tmp:
+            src = os.path.join(tmp,'src')
+            os.mkdir(src)
+            shutil.copy(os.path.join(tests,'twofingers.fir'),src)
+            sample = PIL.Image.new("RGB",(60,80),255)
+            sample.header = dict(landmark_points=[], gender='M', eye_colour='BLUE', hair_colour='BLACK',
+                property_mask=['GLASSES'], expression='NEUTRAL', pose_yaw=0, pose_pitch=0, pose_roll=0,
+                pose_uncertainty_yaw=0, pose_uncertainty_pitch=0, pose_uncertainty_roll=0,
+                face_image_type='FULL_FRONTAL', image_data_type='JPEG', source_type='STATIC_CAMERA',
+                device_type=b'\\x00\\x00', quality=b'\\x00\\x00')
+            sample.save(os.path.join(src,'face.fac'),"FAC",version='010')
+
+            # a compression of one format only: the files of the other format are skipped
+            out, err = io.StringIO(), io.StringIO()
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                self.assertEqual(main(['convert','-j','1','-c','PNG',src,os.path.join(tmp,'png')]),0)
+            self.assertTrue(out.getvalue().startswith("1 converted, 1 skipped, 0 failed"))
+            self.assertIn("PNG is not a FAC compression",err.getvalue())
+            self.assertEqual(os.listdir(os.path.join(tmp,'png')),['twofingers.fir'])
+
+            # a compression per format
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                self.assertEqual(main(['convert','-j','1','--fir-compression','PNG','--fac-compression','JPEG2000',
+                    src,os.path.join(tmp,'both')]),0)
+            self.assertTrue(out.getvalue().startswith("2 converted, 0 skipped, 0 failed"))
+            self.assertEqual([h['image_compression_algo'] for h in iso19794.scan(os.path.join(tmp,'both','twofingers.fir')).headers],['PNG','PNG'])
+            self.assertEqual([h['image_data_type'] for h in iso19794.scan(os.path.join(tmp,'both','face.fac')).headers],['JPEG2000'])
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run(self):
+        from iso19794.tests import benchmark
+        results = benchmark.run(sizes=['small'],frame_counts=[2],min_time=0,repeat=1)
+        self.assertEqual({(r.format,r.compression) for r in results},
+            {('FIR','RAW'),('FIR','RAW_PACKED'),('FIR','WSQ'),('FIR','JPEG'),('FIR','JPEG2000_LOSSY'),('FIR','JPEG2000_LOSSLESS'),('FIR','PNG'),('FAC','JPEG'),('FAC','JPEG2000')})
+        self.assertEqual(len(results),9*len(benchmark.OPERATIONS))
+        self.assertEqual(benchmark.compare(results,results),[])
+
+    def test_jpeg2000_profiles(self):
+        from iso19794.tests import benchmark
+        results = benchmark.jpeg2000_profiles('small',min_time=0,repeat=1)
+        self.assertEqual([r[:2] for r in results],[
+            ('FIR','default'),('FIR','transmission-15:1'),
+            ('FIR','default'),('FIR','fast-lossless'),('FIR','archival'),
+            ('FAC','default'),('FAC','fast-lossless'),('FAC','archival'),('FAC','transmission-15:1')])
+
+class TestBuildImage(unittest.TestCase):
+
+    def test_generator(self):
+        from iso19794.tests.build_image import Generator, write_dump
+        sizes = dict(finger=[(64,80)],slap=[(96,80)],palm=[(128,128)])
+        generator = Generator(seed=3,max_frames=4,variants=2,fir_sizes=sizes,fac_sizes=[(48,64)])
+        records = list(generator.records(0,8))
+        self.assertEqual({format for index,format,data in records},{'FIR','FAC'})
+        for index,format,data in records:
+            result = iso19794.scan(data)
+            self.assertEqual(result.format,format)
+            self.assertTrue(1 <= len(result.headers) <= 4)
+            i = PIL.Image.open(io.BytesIO(data))
+            i.seek(i.n_frames-1)
+            i.load()
+
+        # same seed, same records
+        other = Generator(seed=3,max_frames=4,variants=2,fir_sizes=sizes,fac_sizes=[(48,64)])
+        self.assertEqual(other.record(5),records[5][1:])
+
+        buf = io.BytesIO()
+        count = write_dump(other,buf,sum(len(data) for index,format,data in records[:3]))
+        self.assertEqual(count,3)
+        self.assertEqual(buf.getvalue(),b"".join(data for index,format,data in records[:3]))
+
+class TestHooks(unittest.TestCase):
+
+    def test_observe(self):
+        from iso19794 import hooks
+        events = []
+        with hooks.observe(events.append):
+            i = PIL.Image.open(os.path.join(os.path.dirname(__file__),'twofingers.fir'))
+            i.seek(1)
+            i.load()
+        self.assertEqual([(e.phase,e.format,e.version,e.frame,e.compression) for e in events],[
+            ('general_header','FIR','020',None,None),
+            ('read_header','FIR','020',0,'RAW'),
+            ('tile','FIR','020',0,'RAW'),
+            ('read_header','FIR','020',1,'RAW'),
+            ('tile','FIR','020',1,'RAW'),
+            ('decode','FIR','020',1,'RAW'),
+            ])
+        self.assertEqual(events[0].size,16)
+        self.assertEqual(events[-1].size,250*250)
+        self.assertTrue(all(e.seconds>=0 for e in events))
+
+        # reencoded frames only, reported by the saving thread, also from a process pool
+        import concurrent.futures
+        i.header['image_compression_algo'] = 'JPEG'
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            for options in (dict(), dict(encoder_workers=2), dict(encoder_executor=executor)):
+                events = []
+                with hooks.observe(events.append):
+                    i.save(io.BytesIO(),"FIR",save_all=True,**options)
+                self.assertEqual([(e.phase,e.frame,e.compression) for e in events if e.phase in ('encode','header','write')],[
+                    ('header',0,'RAW'),
+                    ('write',0,'RAW'),
+                    ('encode',1,'JPEG'),
+                    ('header',1,'JPEG'),
+                    ('write',1,'JPEG'),
+                    ])
+                encode = events[[e.phase for e in events].index('encode')]
+                self.assertGreater(encode.seconds,0)
+                self.assertGreater(encode.size,0)
+
+        # no observer
+        events = []
+        i.save(io.BytesIO(),"FIR",save_all=True)
+        self.assertEqual(events,[])
+
+class TestImport(unittest.TestCase):
+
+    def test_lazy_import(self):
+        import sys
+        import subprocess
+        code = ("import sys, io, iso19794, PIL.Image\n"
+            "print(sorted(m for m in sys.modules if m.startswith('iso19794.')))\n"
+            "PIL.Image.open(%r)\n"
+            "print(sorted(m for m in sys.modules if m.startswith('iso19794.')))\n"
+            "print('PIL.Jpeg2KImagePlugin' in sys.modules)\n") % os.path.join(os.path.dirname(__file__),'twofingers.fir')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        out = subprocess.check_output([sys.executable,'-c',code],cwd=root,universal_newlines=True)
+        self.assertEqual(out.splitlines(),[
+            "[]",
+            "['iso19794.FIR', 'iso19794.base', 'iso19794.hooks', 'iso19794.record']",
+            "False"])
+
+        # the convert command imports the format modules when needed
+        code = ("import sys, iso19794.convert\n"
+            "print(sorted(m for m in sys.modules if m.startswith('iso19794.')))\n")
+        out = subprocess.check_output([sys.executable,'-c',code],cwd=root,universal_newlines=True)
+        self.assertEqual(out.splitlines(),["['iso19794.convert']"])
+
+class TestAsyncio(unittest.TestCase):
+
+    def test_aio(self):
+        import asyncio
+        from iso19794 import aio
+        filename = os.path.join(os.path.dirname(__file__),'twofingers.fir')
+        with open(filename,'rb') as f:
+            data = f.read()
+        ref = iso19794.scan(data)
+
+        async def main():
+            result = await aio.scan(filename)
+            self.assertEqual(result,ref)
+            self.assertEqual(await aio.scan(data),ref)
+
+            # concatenated records in a stream
+            reader = asyncio.StreamReader()
+            reader.feed_data(data*3)
+            reader.feed_eof()
+            self.assertEqual(await aio.scan(reader),ref)
+            i = await aio.open(reader)
+            self.assertEqual(i.n_frames,2)
+            await aio.load(i)
+            self.assertEqual(i.tobytes(),PIL.Image.open(filename).tobytes())
+            self.assertEqual([len(r) async for r in aio.iter_records(reader)],[len(data)])
+
+            reader = asyncio.StreamReader()
+            reader.feed_data(data[:100])
+            reader.feed_eof()
+            with self.assertRaises(asyncio.IncompleteReadError):
+                await aio.read_record(reader)
+
+            reader = asyncio.StreamReader()
+            reader.feed_data(data[:8]+(4).to_bytes(4,'big')+data[12:])
+            reader.feed_eof()
+            with self.assertRaises(SyntaxError):
+                await aio.read_record(reader)
+
+            frames = await aio.decode_all(await aio.open(filename))
+            self.assertEqual(len(frames),2)
+
+            # bounded concurrency
+            running = []
+            async def job(item):
+                running.append(item)
+                self.assertLessEqual(len(running),3)
+                await asyncio.sleep(0.001*(item%4))
+                running.remove(item)
+                return item*2
+            self.assertEqual(await aio.bounded_map(job,range(20),limit=3),list(range(0,40,2)))
+
+        asyncio.run(main())
+
+class TestCache(unittest.TestCase):
+
+    def test_cache(self):
+        import shutil
+        import tempfile
+        from iso19794 import hooks
+        from iso19794.base import ISO19794ImageFile
+        from iso19794.cache import HeaderCache
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp,'twofingers.fir')
+            shutil.copy(os.path.join(os.path.dirname(__file__),'twofingers.fir'),filename)
+            ref = PIL.Image.open(filename)
+            ref.seek(1)
+
+            db = os.path.join(tmp,'headers.db')
+            ISO19794ImageFile.header_cache = HeaderCache(size=10,path=db)
+            try:
+                i = PIL.Image.open(filename)
+                self.assertEqual(len(ISO19794ImageFile.header_cache),1)
+                i.header['position'] = 'LEFT_THUMB'
+
+                # from the cache (memory, then database)
+                for cache in (ISO19794ImageFile.header_cache, HeaderCache(size=10,path=db)):
+                    ISO19794ImageFile.header_cache = cache
+                    events = []
+                    with hooks.observe(events.append):
+                        i = PIL.Image.open(filename)
+                        i.seek(1)
+                        i.load()
+                    self.assertEqual([e.phase for e in events],['tile','tile','decode'])
+                    self.assertEqual(i.info,ref.info)
+                    self.assertEqual(i.header,ref.header)
+                    self.assertEqual(i.tobytes(),ref.tobytes())
+                    i.seek(0)
+                    self.assertEqual(i.header['position'],'LEFT_INDEX_FINGER')
+
+                # modified file
+                with open(filename,'ab') as f:
+                    f.write(b'\x00')
+                events = []
+                with hooks.observe(events.append):
+                    PIL.Image.open(filename)
+                self.assertEqual(events[0].phase,'general_header')
+                ISO19794ImageFile.header_cache.close()
+            finally:
+                ISO19794ImageFile.header_cache = None
+
+    def test_cache_compact(self):
+        import shutil
+        import tempfile
+        from iso19794.base import ISO19794ImageFile
+        from iso19794.cache import HeaderCache
+        from iso19794.FIR import FIRHeader
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp,'twofingers.fir')
+            shutil.copy(os.path.join(os.path.dirname(__file__),'twofingers.fir'),filename)
+            db = os.path.join(tmp,'headers.db')
+            ISO19794ImageFile.header_cache = HeaderCache(size=10,path=db)
+            try:
+                # each kind of headers is cached separately (memory, then database)
+                for cache in (ISO19794ImageFile.header_cache, HeaderCache(size=10,path=db)):
+                    ISO19794ImageFile.header_cache = cache
+                    for compact in (False, True, False, True):
+                        ISO19794ImageFile.compact_headers = compact
+                        i = PIL.Image.open(filename)
+                        i.seek(1)
+                        self.assertIsInstance(i.header,FIRHeader if compact else dict)
+                        self.assertEqual(i.header['position'],'LEFT_MIDDLE_FINGER')
+                    self.assertEqual(len(cache),2)
+                ISO19794ImageFile.header_cache.close()
+            finally:
+                ISO19794ImageFile.header_cache = None
+                ISO19794ImageFile.compact_headers = False
+
+class TestArrays(unittest.TestCase):
+
+    def test_headers_to_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        from iso19794.tests.build_image import Generator
+        generator = Generator(seed=1,max_frames=3,variants=1,
+            fir_sizes=dict(finger=[(16,16)],slap=[(16,16)],palm=[(16,16)]),fac_sizes=[(16,16)])
+        records = [data for index,format,data in generator.records(0,6)]
+        sources = [os.path.join(os.path.dirname(__file__),'twofingers.fir'),b'not a record'] + records
+        with self.assertRaises(SyntaxError):
+            iso19794.headers_to_numpy(sources)
+        table = iso19794.headers_to_numpy(sources,errors='ignore')
+
+        self.assertEqual(len(table),sum(len(iso19794.scan(data).headers) for data in records)+2)
+        self.assertEqual(list(table[:2]['frame']),[0,1])
+        self.assertEqual(list(table[:2]['position']),[POSITION['LEFT_INDEX_FINGER'],POSITION['LEFT_MIDDLE_FINGER']])
+        self.assertEqual(list(table[:2]['width']),[250,250])
+        self.assertNotIn(1,table['file'])
+        for row in table[table['file'] >= 2]:
+            header = iso19794.scan(records[row['file']-2]).headers[row['frame']]
+            if row['format'] == b'FIR':
+                self.assertEqual(COMPRESSION.names[row['compression']],header['image_compression_algo'])
+                self.assertEqual(row['height'],header['vertical_line_length'])
+            else:
+                self.assertEqual(iso19794.FAC.GENDER.names[row['gender']],header['gender'])
+                self.assertEqual(row['pose_yaw'],header['pose_yaw'])
+                self.assertEqual(row['landmark_count'],len(header['landmark_points']))
+        self.assertEqual(set(table['format']),{b'FIR',b'FAC'})
+
+        # a FAC 030 record has no image information: its header cannot be decoded
+        from iso19794 import FAC
+        general, facial = FAC._GENERAL_HEADER['030'], FAC._FACIAL_INFORMATION['030']
+        representation = FAC._REPRESENTATION.struct.pack(FAC._REPRESENTATION.size+facial.size,
+            2020,1,1,0,0,0,0,b'\0',b'\0\0',b'\0\0',0) + facial.struct.pack(0,0,0,0,0,b'\0\0\0',b'\0\0',0,0,0,0,0,0)
+        record = general.struct.pack(b'FAC\0',b'030\0',general.size+len(representation),1,False,0) + representation
+        with self.assertRaises(ValueError):
+            iso19794.scan(record,compact=True).headers[0].width
+        with self.assertRaises(ValueError):
+            iso19794.headers_to_numpy([record])
+        self.assertEqual(list(iso19794.headers_to_numpy([record]+sources[:1],errors='ignore')['file']),[1,1])
+
+def _wsq_stream(width, height, blocks):
+    # WSQ data with a Huffman table coding each symbol on 8 bits (the symbol - 1),
+    # a bin width of 1 and a zero bin of 2 for all the subbands
+    import struct
+    def segment(marker, data):
+        return struct.pack(">HH", marker, len(data) + 2) + data
+    bins = struct.pack(">BHBH", 0, 1, 0, 2) * 60 + bytes(5 * 4)
+    table = bytes([0]) + bytes(7) + bytes([254]) + bytes(8) + bytes(range(1, 255))
+    data = b"\xff\xa0" + segment(0xffa4, bytes([9, 7]))
+    data += segment(0xffa5, struct.pack(">BH", 2, 44) + bins) + segment(0xffa6, table)
+    data += segment(0xffa2, struct.pack(">BBHHBHBHBH", 0, 255, height, width, 0, 128, 0, 1, 2, 0))
+    for block in blocks:
+        # the symbols are given as integers, the additional bits as bytes
+        coded = b"".join(bytes([b - 1]) if isinstance(b, int) else b for b in block)
+        data += segment(0xffa3, bytes([0])) + coded.replace(b"\xff", b"\xff\x00")
+    return data + b"\xff\xa1"
+
+class TestWSQ(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+
+    def test_transform(self):
+        import numpy
+        from iso19794 import wsq
+        nodes, subbands = wsq.decomposition(417, 389)
+        self.assertEqual(len(subbands), 64)
+        cover = numpy.zeros((389, 417), int)
+        for x, y, width, height in subbands:
+            cover[y:y+height, x:x+width] += 1
+        self.assertTrue((cover == 1).all())
+        pixels = numpy.random.RandomState(0).uniform(-128, 128, (389, 417))
+        a = pixels.copy()
+        wsq._transform(a, nodes)
+        self.assertGreater(abs(a - pixels).max(), 1)
+        wsq._transform(a, nodes, inverse=True)
+        self.assertLess(abs(a - pixels).max(), 1e-3)
+
+    def test_decode(self):
+        import numpy
+        from iso19794 import wsq
+        nodes, subbands = wsq.decomposition(256, 192)
+        counts = [sum(subbands[k][2] * subbands[k][3] for k in block) for block in wsq.BLOCKS]
+        # values, escaped values and zero runs
+        block = [181, 101, b"\xc8", 104, b"\x01\x2c", 105, b"\x96", 3, 107, 254, 106, b"\x00\xff", 102, b"\xff"]
+        expected = [1, 200, -300] + [0] * 153 + [-73, 74] + [0] * 255 + [-255]
+        block += [106, (counts[0] - len(expected)).to_bytes(2, 'big')]
+        expected += [0] * (counts[0] - len(expected))
+        runs = [[106, n.to_bytes(2, 'big')] for n in counts[1:]]
+        data = _wsq_stream(256, 192, [block] + runs)
+        frame, quantization, blocks = wsq._read(data)
+        self.assertEqual((frame.width, frame.height, frame.m_shift, frame.r_scale), (256, 192, 128, 1))
+        self.assertEqual(quantization[0], 0.44)
+        self.assertEqual(blocks[0].tolist(), expected)
+        self.assertEqual([len(b) for b in blocks], counts)
+
+        pixels = wsq.decode(data)
+        self.assertEqual(pixels.shape, (192, 256))
+        self.assertEqual(pixels.dtype, numpy.uint8)
+        flat = wsq.decode(_wsq_stream(256, 192, [[106, n.to_bytes(2, 'big')] for n in counts]))
+        self.assertTrue((flat == 128).all())
+        with self.assertRaises(OSError):
+            wsq.decode(data[:200] + b"\xff\xa1")
+
+        # WSQ frame of a FIR image
+        im = PIL.Image.new("L", (256, 192))
+        im.header = dict(image_compression_algo='WSQ', number=0)
+        buffer = io.BytesIO()
+        buffer.seek(16)
+        length = iso19794.FIR._save_frame(im, buffer, False, encoded=(data, 8))
+        buffer.seek(0)
+        buffer.write(iso19794.FIR._GENERAL_HEADER.pack(b"FIR\x00", b"020\x00", 16+length, 1, False, 1))
+        buffer.seek(0)
+        i = PIL.Image.open(buffer)
+        self.assertEqual((i.mode, i.size), ("L", (256, 192)))
+        self.assertEqual(i.tobytes(), pixels.tobytes())
+
+    def test_nbis(self):
+        # finger-nbis.wsq: finger.data encoded by the NBIS reference encoder (0.75 bpp),
+        # finger-nbis.data: its pixels decoded by the NBIS reference decoder
+        import numpy
+        from iso19794 import wsq
+        tests = os.path.dirname(__file__)
+        with open(os.path.join(tests,'finger-nbis.wsq'),'rb') as f:
+            data = f.read()
+        with open(os.path.join(tests,'finger-nbis.data'),'rb') as f:
+            expected = numpy.frombuffer(f.read(),numpy.uint8).reshape(250,250).astype(int)
+        pixels = wsq.decode(data)
+        self.assertEqual(pixels.shape,(250,250))
+        self.assertLessEqual(abs(pixels.astype(int)-expected).max(),1)
+
+        # WSQ frame of a FIR image
+        im = PIL.Image.new("L",(250,250))
+        im.header = dict(image_compression_algo='WSQ', number=0)
+        buffer = io.BytesIO()
+        buffer.seek(16)
+        length = iso19794.FIR._save_frame(im,buffer,False,encoded=(data,8))
+        buffer.seek(0)
+        buffer.write(iso19794.FIR._GENERAL_HEADER.pack(b"FIR\x00",b"020\x00",16+length,1,False,1))
+        buffer.seek(0)
+        self.assertEqual(PIL.Image.open(buffer).tobytes(),pixels.tobytes())
+
+    def test_encode_nbis(self):
+        # the encoder output compared to the NBIS encoder output for the same image
+        import numpy, struct
+        from iso19794 import wsq
+        tests = os.path.dirname(__file__)
+        with open(os.path.join(tests,'finger-nbis.wsq'),'rb') as f:
+            reference = f.read()
+        with open(os.path.join(tests,'finger.data'),'rb') as f:
+            pixels = numpy.frombuffer(f.read(),numpy.uint8).reshape(250,250)
+        data = wsq.encode(pixels,0.75)
+        def segment(data, marker):
+            i = data.index(marker)
+            return data[i+4:i+2+int.from_bytes(data[i+2:i+4],'big')]
+        # frame header (normalization)
+        self.assertEqual(segment(data,b"\xff\xa2"),segment(reference,b"\xff\xa2"))
+        # transform table: filter lengths then the coefficients
+        table, expected = segment(data,b"\xff\xa4"), segment(reference,b"\xff\xa4")
+        self.assertEqual(table[:2],b"\x09\x07")
+        self.assertEqual(table[:2],expected[:2])
+        def coefficients(table):
+            return [(-1)**sign*value/10**scale for sign,scale,value in struct.iter_unpack(">BBI",table[2:])]
+        for c, e in zip(coefficients(table),coefficients(expected)):
+            self.assertAlmostEqual(c,e,places=6)
+        # quantization bins
+        def bins(table):
+            return [q/10**scale for scale,q,zscale,z in struct.iter_unpack(">BHBH",table[3:])]
+        for q, e in zip(bins(segment(data,b"\xff\xa5")),bins(segment(reference,b"\xff\xa5"))):
+            self.assertLessEqual(abs(q-e),e*1e-3)
+        self.assertLess(abs(len(data)-len(reference)),len(reference)*0.05)
+
+        # decoded by the NBIS reference decoder (wsq package), if installed
+        try:
+            import _wsq
+        except ImportError:
+            return
+        decoded, width, height, ppi = _wsq.decompress(data)
+        decoded = numpy.frombuffer(bytes(decoded),numpy.uint8).reshape(height,width)
+        self.assertLessEqual(abs(decoded.astype(int)-wsq.decode(data)).max(),1)
+        self.assertLess(abs(decoded.astype(int)-pixels).mean(),4)
+
+    def test_encode(self):
+        import numpy
+        from iso19794 import wsq
+        y, x = numpy.mgrid[0:300, 0:280]
+        pixels = (128 + 100 * numpy.sin(numpy.hypot(x - 140, y - 150) / 4)).astype(numpy.uint8)
+        for bitrate in (0.75, 2.25):
+            data = wsq.encode(pixels, bitrate)
+            self.assertEqual(data[:2] + data[-2:], b"\xff\xa0\xff\xa1")
+            self.assertLess(len(data) * 8 / pixels.size, 2 * bitrate)
+            error = wsq.decode(data).astype(float) - pixels
+            self.assertLess(abs(error).mean(), 6 if bitrate < 1 else 2)
+        self.assertGreater(len(wsq.encode(pixels, 2.25)), len(wsq.encode(pixels, 0.75)))
+        self.assertTrue((wsq.decode(wsq.encode(numpy.full((64, 80), 200, numpy.uint8))) == 200).all())
+
+        # FIR save and open
+        im = PIL.Image.fromarray(pixels)
+        im.header = dict(image_compression_algo='WSQ')
+        buffer = io.BytesIO()
+        im.save(buffer, "FIR", wsq_bitrate=1.5)
+        buffer.seek(0)
+        i = PIL.Image.open(buffer)
+        self.assertEqual((i.mode, i.size, i.header['image_compression_algo']), ("L", (280, 300), 'WSQ'))
+        self.assertEqual(i.tobytes(), wsq.decode(wsq.encode(pixels, 1.5)).tobytes())
@@ -0,0 +1,589 @@
+"""
+WSQ (Wavelet Scalar Quantization) codec.
+
+WSQ is the compression of the fingerprint images defined by the FBI (IAFIS-IC-0110).
+The image is normalized, decomposed by a 9/7 wavelet transform into 64 subbands
+(60 of them being coded), quantized and Huffman coded in 3 blocks.
+
+:py:func:`decode` returns the pixels of WSQ data as a NumPy array. The Huffman
+codes are read one symbol at a time with a lookup table, the expansion of the
+coefficients, the dequantization and the inverse wavelet transform are done
+with vectorized NumPy operations. :py:class:`WsqDecoder` is the Pillow decoder
+(``wsq``) of the FIR images whose compression is ``WSQ``.
+
+:py:func:`encode` compresses an image to a target bit rate: the quantization
+bins of the subbands are allocated from their variances (as in the reference
+encoder), the optimal Huffman tables are computed from the symbol counts and
+the codes are packed with vectorized operations. It is used to save the FIR
+images with the ``WSQ`` compression.
+
+NumPy is an optional dependency, only needed to decode and encode WSQ data.
+"""
+
+import io
+import re
+import heapq
+import struct
+import types
+
+from PIL import ImageFile
+
+from .record import Layout
+
+# Markers
+SOI = 0xFFA0
+EOI = 0xFFA1
+SOF = 0xFFA2
+SOB = 0xFFA3
+DTT = 0xFFA4
+DQT = 0xFFA5
+DHT = 0xFFA6
+DRT = 0xFFA7
+COM = 0xFFA8
+
+# Analysis filters of the wavelet transform (9 taps lowpass, 7 taps highpass)
+LO_FILTER = (
+    0.03782845550726404, -0.02384946501955685, -0.11062440441843718, 0.37740285561283066,
+    0.85269867833825666,
+    0.37740285561283066, -0.11062440441843718, -0.02384946501955685, 0.03782845550726404)
+HI_FILTER = (
+    0.06453888262869706, -0.04068941760916406, -0.41809227322161724,
+    0.7884856164055829,
+    -0.41809227322161724, -0.04068941760916406, 0.06453888262869706)
+
+_MARKER = Layout(('marker', 'H'))
+_LENGTH = Layout(('length', 'H'))
+_FRAME = Layout(
+    ('black', 'B'),
+    ('white', 'B'),
+    ('height', 'H'),
+    ('width', 'H'),
+    ('m_shift_scale', 'B'),
+    ('m_shift', 'H'),
+    ('r_scale_scale', 'B'),
+    ('r_scale', 'H'),
+    ('encoder', 'B'),
+    ('software', 'H'),
+    )
+_SCALED = Layout(('scale', 'B'), ('value', 'H'))
+_BIN = Layout(('q_scale', 'B'), ('q', 'H'), ('z_scale', 'B'), ('z', 'H'))
+
+#: Subbands coded in each block
+BLOCKS = (range(0, 19), range(19, 52), range(52, 60))
+
+# End of entropy coded data: a marker (0xFF not followed by a stuffed 0x00)
+_END_OF_DATA = re.compile(b"\xff[^\x00]")
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("WSQ requires NumPy") from None
+    return numpy
+
+#
+# Decomposition
+#
+def _split(node):
+    # Return the 4 quarters (top left, top right, bottom left, bottom right) of a
+    # node (x, y, width, height, inverted x, inverted y). When a direction is
+    # inverted, the highpass half comes first and gets the smaller part of an odd
+    # length. The right and bottom quarters are inverted in x and y.
+    x, y, width, height, inv_x, inv_y = node
+    left = width // 2 if inv_x else (width + 1) // 2
+    top = height // 2 if inv_y else (height + 1) // 2
+    return (
+        (x, y, left, top, False, False),
+        (x + left, y, width - left, top, True, False),
+        (x, y + top, left, height - top, False, True),
+        (x + left, y + top, width - left, height - top, True, True))
+
+def decomposition(width, height):
+    """Return the nodes transformed by the wavelet transform and the 64 subbands
+
+    The 20 nodes are ``(x, y, width, height, inverted x, inverted y)`` in the order
+    of the decomposition, the subbands ``(x, y, width, height)`` in the order of the
+    coded data (subbands 60 to 63 are never coded).
+    """
+    nodes = [None] * 20
+    nodes[0] = (0, 0, width, height, False, False)
+    nodes[1], nodes[2], nodes[3], highpass = _split(nodes[0])
+    nodes[14], nodes[4], nodes[5], subband51 = _split(nodes[1])
+    nodes[6:10] = _split(nodes[4])
+    nodes[10:14] = _split(nodes[5])
+    nodes[15:19] = _split(nodes[14])
+    nodes[19] = _split(nodes[15])[0]
+
+    subbands = list(_split(nodes[19]))
+    subbands += _split(nodes[15])[1:]
+    for node in nodes[16:19] + nodes[6:14]:
+        subbands += _split(node)
+    subbands.append(subband51)
+    # the highest frequencies (60 to 63) are not transformed
+    for node in (nodes[2], nodes[3], highpass):
+        subbands += _split(node)
+    return nodes, [s[:4] for s in subbands]
+
+#
+# Wavelet transform
+#
+def _analysis(a, inverted):
+    # Transform along the last axis, the lowpass half first (highpass if inverted).
+    # The signal is extended by symmetry without repeating the edge samples.
+    numpy = _numpy()
+    n = a.shape[-1]
+    low, high = (n + 1) // 2, n // 2
+    padded = numpy.pad(a, [(0, 0)] * (a.ndim - 1) + [(4, 4)], mode='reflect')
+    out = numpy.empty_like(a)
+    lows = out[..., high:] if inverted else out[..., :low]
+    highs = out[..., :high] if inverted else out[..., low:]
+    # both filters are symmetric
+    lows[...] = LO_FILTER[4] * padded[..., 4:4 + 2 * low:2]
+    for j in range(4):
+        lows += LO_FILTER[j] * (padded[..., j:j + 2 * low:2] + padded[..., 8 - j:8 - j + 2 * low:2])
+    highs[...] = HI_FILTER[3] * padded[..., 5:5 + 2 * high:2]
+    for j in range(3):
+        highs += HI_FILTER[j] * (padded[..., j + 2:j + 2 + 2 * high:2] + padded[..., 8 - j:8 - j + 2 * high:2])
+    return out
+
+def _synthesis(a, inverted):
+    # Reverse of _analysis
+    numpy = _numpy()
+    n = a.shape[-1]
+    low, high = (n + 1) // 2, n // 2
+    lows = numpy.zeros_like(a)
+    highs = numpy.zeros_like(a)
+    lows[..., 0::2] = a[..., high:] if inverted else a[..., :low]
+    highs[..., 1::2] = a[..., :high] if inverted else a[..., low:]
+    pad = [(0, 0)] * (a.ndim - 1) + [(4, 4)]
+    lows = numpy.pad(lows, pad, mode='reflect')
+    highs = numpy.pad(highs, pad, mode='reflect')
+    out = numpy.zeros_like(a)
+    # synthesis filters: the analysis filters modulated by (-1)^k
+    for j, c in enumerate(HI_FILTER):
+        out += (-1) ** (j + 1) * c * lows[..., j + 1:j + 1 + n]
+    for j, c in enumerate(LO_FILTER):
+        out += (-1) ** j * c * highs[..., j:j + n]
+    return out
+
+def _transform(a, nodes, inverse=False):
+    # Apply the (inverse) wavelet transform of all the nodes to a, in place
+    for x, y, width, height, inv_x, inv_y in (reversed(nodes) if inverse else nodes):
+        if width < 2 or height < 2:
+            continue
+        region = a[y:y + height, x:x + width]
+        if inverse:
+            region[...] = _synthesis(region.T, inv_y).T
+            region[...] = _synthesis(region, inv_x)
+        else:
+            region[...] = _analysis(region, inv_x)
+            region[...] = _analysis(region.T, inv_y).T
+
+#
+# Decoding
+#
+def _scaled(scale, value):
+    return value / 10 ** scale
+
+def _huffman_table(counts, values):
+    # Return the lookup tables (symbol, code length) of the 16 bits windows
+    numpy = _numpy()
+    symbols = numpy.zeros(1 << 16, numpy.uint8)
+    lengths = numpy.zeros(1 << 16, numpy.uint8)
+    code = 0
+    index = 0
+    for length, count in enumerate(counts, 1):
+        for _ in range(count):
+            if code >= 1 << length:
+                raise SyntaxError("invalid WSQ Huffman table")
+            start = code << (16 - length)
+            end = (code + 1) << (16 - length)
+            symbols[start:end] = values[index]
+            lengths[start:end] = length
+            code += 1
+            index += 1
+        code <<= 1
+    return symbols.tolist(), lengths.tolist()
+
+def _decode_block(data, table, count):
+    # Return the count quantized coefficients of the entropy coded data of a block
+    numpy = _numpy()
+    symbols, lengths = table
+    nbits = len(data) * 8
+    b = numpy.frombuffer(bytes(data) + bytes(8), numpy.uint8).astype(numpy.uint32)
+    # 32 bits starting at each byte
+    windows = ((b[:-3] << 24) | (b[1:-2] << 16) | (b[2:-1] << 8) | b[3:]).tolist()
+
+    positions = []
+    values = []
+    pos = 0
+    cursor = 0
+    while cursor < count and pos <= nbits:
+        window = (windows[pos >> 3] >> (16 - (pos & 7))) & 0xffff
+        length = lengths[window]
+        if length == 0:
+            raise SyntaxError("invalid WSQ Huffman code")
+        symbol = symbols[window]
+        pos += length
+        if 0 < symbol <= 100:
+            cursor += symbol
+            continue
+        if 106 < symbol < 0xff:
+            value = symbol - 180
+        elif 101 <= symbol <= 106:
+            size = 8 if symbol in (101, 102, 105) else 16
+            extra = (windows[pos >> 3] >> (32 - size - (pos & 7))) & ((1 << size) - 1)
+            pos += size
+            if symbol >= 105:
+                cursor += extra
+                continue
+            value = -extra if symbol in (102, 104) else extra
+        else:
+            raise SyntaxError("invalid WSQ symbol %d" % symbol)
+        positions.append(cursor)
+        values.append(value)
+        cursor += 1
+    if pos > nbits or cursor > count:
+        raise OSError("WSQ data is truncated or corrupted")
+    coefficients = numpy.zeros(count, numpy.int32)
+    coefficients[positions] = values
+    return coefficients
+
+def _read(data):
+    # Parse WSQ data, return the frame header, the quantization table and the
+    # quantized coefficients of each block
+    try:
+        return _parse(data)
+    except (struct.error, IndexError):
+        raise OSError("WSQ data is truncated") from None
+
+def _parse(data):
+    fp = io.BytesIO(data)
+    ns = types.SimpleNamespace()
+    _MARKER.read(fp, ns)
+    if ns.marker != SOI:
+        raise SyntaxError("not a WSQ image")
+    frame = None
+    quantization = None
+    tables = {}
+    blocks = []
+    while True:
+        marker = fp.read(2)
+        if len(marker) < 2:
+            raise OSError("WSQ data is truncated")
+        (marker,) = _MARKER.unpack(marker)
+        if marker == EOI:
+            break
+        _LENGTH.read(fp, ns)
+        end = fp.tell() + ns.length - 2
+        if marker == SOF:
+            frame = types.SimpleNamespace()
+            _FRAME.read(fp, frame)
+            frame.m_shift = _scaled(frame.m_shift_scale, frame.m_shift)
+            frame.r_scale = _scaled(frame.r_scale_scale, frame.r_scale)
+        elif marker == DTT:
+            losz, hisz = fp.read(2)
+            if (losz, hisz) != (len(LO_FILTER), len(HI_FILTER)):
+                raise SyntaxError("unsupported WSQ transform (%d/%d taps)" % (losz, hisz))
+        elif marker == DQT:
+            _SCALED.read(fp, ns)
+            center = _scaled(ns.scale, ns.value)
+            bins = []
+            for _ in range(64):
+                _BIN.read(fp, ns)
+                bins.append((_scaled(ns.q_scale, ns.q), _scaled(ns.z_scale, ns.z)))
+            quantization = (center, bins)
+        elif marker == DHT:
+            while fp.tell() < end:
+                table_id = fp.read(1)[0]
+                counts = fp.read(16)
+                tables[table_id] = _huffman_table(counts, fp.read(sum(counts)))
+        elif marker == SOB:
+            table_id = fp.read(1)[0]
+            if frame is None or quantization is None or table_id not in tables:
+                raise SyntaxError("WSQ block before its tables")
+            if len(blocks) >= len(BLOCKS):
+                raise SyntaxError("too many WSQ blocks")
+            match = _END_OF_DATA.search(data, end)
+            if match is None:
+                raise OSError("WSQ data is truncated")
+            end = match.start()
+            nodes, subbands = decomposition(frame.width, frame.height)
+            count = sum(subbands[k][2] * subbands[k][3]
+                for k in BLOCKS[len(blocks)] if quantization[1][k][0] != 0)
+            blocks.append(_decode_block(data[fp.tell():end].replace(b"\xff\x00", b"\xff"), tables[table_id], count))
+        elif marker == DRT:
+            if fp.read(2) != b"\x00\x00":
+                raise SyntaxError("WSQ restart intervals are not supported")
+        elif marker != COM:
+            raise SyntaxError("invalid WSQ marker %04X" % marker)
+        fp.seek(end)
+    if frame is None:
+        raise SyntaxError("WSQ frame header not found")
+    return frame, quantization, blocks
+
+def decode(data):
+    """Decode WSQ data and return the pixels as a NumPy array of bytes (height, width)"""
+    numpy = _numpy()
+    frame, (center, bins), blocks = _read(bytes(data))
+    nodes, subbands = decomposition(frame.width, frame.height)
+    a = numpy.zeros((frame.height, frame.width), numpy.float32)
+    for block, coefficients in zip(BLOCKS, blocks):
+        start = 0
+        for k in block:
+            q, z = bins[k]
+            if q == 0:
+                continue
+            x, y, width, height = subbands[k]
+            values = coefficients[start:start + width * height].reshape(height, width)
+            start += width * height
+            a[y:y + height, x:x + width] = numpy.where(values > 0, q * (values - center) + z / 2,
+                numpy.where(values < 0, q * (values + center) - z / 2, 0))
+    _transform(a, nodes, inverse=True)
+    a = a * (frame.r_scale or 1) + frame.m_shift + 0.5
+    return numpy.clip(a, 0, 255).astype(numpy.uint8)
+
+#
+# Encoding
+#
+_FILTER = Layout(('sign', 'B'), ('scale', 'B'), ('value', 'I'))
+
+#: Center of the quantization bins, used when dequantizing
+BIN_CENTER = 0.44
+
+# Relative weights of the bin widths of the subbands 52 to 59
+_WEIGHTS = (1.32, 1.08, 1.42, 1.08, 1.32, 1.42, 1.08, 1.08)
+
+def _to_scaled(value, limit=0xffff):
+    # Return (scale, integer) with integer / 10^scale as close as possible to value
+    if value == 0:
+        return 0, 0
+    scale = 0
+    while value * 10 ** (scale + 1) < limit:
+        scale += 1
+    integer = round(value * 10 ** scale)
+    if integer > limit:
+        raise ValueError("WSQ value out of range: %r" % value)
+    return scale, integer
+
+def _area(k):
+    # Fraction of the image covered by a subband
+    return 1 / 1024 if k < 4 else 1 / 256 if k < 51 else 1 / 16
+
+def _variances(a, subbands):
+    # Return the variance of the 60 coded subbands, computed on their center
+    variances = []
+    for x, y, width, height in subbands[:60]:
+        region = a[y + 9 * height // 32:y + 9 * height // 32 + 7 * height // 16,
+                   x + width // 8:x + width // 8 + 3 * width // 4]
+        variances.append(float(region.var(ddof=1)) if region.size > 1 else 0.)
+    if sum(variances[:4]) < 20000:
+        # small variance of the lowest frequencies: use the whole subbands
+        variances = [float(a[y:y + height, x:x + width].var(ddof=1)) if width * height > 1 else 0.
+            for x, y, width, height in subbands[:60]]
+    return variances
+
+def _bin_widths(variances, bitrate):
+    # Return the width of the quantization bins of the 64 subbands (0 for the
+    # subbands not coded), allocating the bit rate from the variances
+    numpy = _numpy()
+    coded = [k for k in range(60) if variances[k] >= 1.01]
+    sigma = {k: variances[k] ** .5 for k in coded}
+    relative = {k: 1. if k < 4 else 10 / ((_WEIGHTS[k - 52] if k >= 52 else 1.) * numpy.log(variances[k]))
+        for k in coded}
+    widths = [0.] * 64
+    if not coded:
+        return widths
+    # the subbands which would have a negative bit rate are left out of the
+    # allocation, but are still coded (as the reference encoder does)
+    allocated = coded
+    while allocated:
+        area = sum(_area(k) for k in allocated)
+        log_m = sum(_area(k) * numpy.log(sigma[k] / relative[k]) for k in allocated)
+        q = 2 ** (bitrate / area - 1) / 2.5 / numpy.exp(log_m / area)
+        negative = [k for k in allocated if relative[k] / q >= 5 * sigma[k]]
+        if not negative:
+            break
+        allocated = [k for k in allocated if k not in negative]
+    for k in coded:
+        widths[k] = relative[k] / q
+    return widths
+
+def _quantize(a, q, z):
+    # Quantize the coefficients of a subband
+    numpy = _numpy()
+    out = numpy.zeros(a.shape, numpy.int32)
+    positive = a > z / 2
+    negative = a < -z / 2
+    out[positive] = numpy.trunc((a[positive] - z / 2) / q + 1)
+    out[negative] = numpy.trunc((a[negative] + z / 2) / q - 1)
+    return out
+
+def _symbols(coefficients):
+    # Return the symbols, the additional bits and their number coding the
+    # quantized coefficients of a block
+    numpy = _numpy()
+    coefficients = numpy.clip(coefficients, -0xffff, 0xffff)
+    positions = numpy.flatnonzero(coefficients)
+    values = coefficients[positions].astype(numpy.int64)
+    runs = numpy.diff(numpy.concatenate(([-1], positions, [len(coefficients)]))) - 1
+
+    # zero runs and values, alternately (starting and ending with a run)
+    is_run = numpy.zeros(2 * len(values) + 1, bool)
+    is_run[0::2] = True
+    amounts = numpy.empty(len(is_run), numpy.int64)
+    amounts[0::2] = runs
+    amounts[1::2] = values
+    # split the runs longer than 65535
+    pieces = numpy.where(is_run, numpy.maximum(1, -(-amounts // 0xffff)), 1)
+    index = numpy.repeat(numpy.arange(len(amounts)), pieces)
+    piece = numpy.arange(len(index)) - numpy.repeat(numpy.cumsum(pieces) - pieces, pieces)
+    is_run = is_run[index]
+    amounts = numpy.where(is_run, numpy.minimum(amounts[index] - piece * 0xffff, 0xffff), amounts[index])
+    keep = ~is_run | (amounts > 0)
+    is_run, amounts = is_run[keep], amounts[keep]
+
+    magnitude = numpy.abs(amounts)
+    symbols = numpy.where(is_run,
+        numpy.select([amounts <= 100, amounts <= 0xff], [amounts, 105], 106),
+        numpy.select([(amounts >= -73) & (amounts <= 74), magnitude <= 0xff], [amounts + 180, 101], 103)
+            + ((amounts < 0) & ((amounts < -73) | (amounts > 74))))
+    nbits = numpy.select([(symbols <= 100) | (symbols > 106), numpy.isin(symbols, (101, 102, 105))], [0, 8], 16)
+    extra = numpy.where(nbits > 0, magnitude, 0)
+    return symbols, extra, nbits
+
+def _huffman_code(symbols):
+    # Return the number of codes of each length (1 to 16) and the symbols sorted
+    # by code length of an optimal Huffman code of the symbols (JPEG, annex K.2)
+    numpy = _numpy()
+    if len(symbols) == 0:
+        return [0] * 16, []
+    frequencies = numpy.bincount(symbols, minlength=257)
+    # a reserved symbol, so that no code is made only of 1 bits
+    frequencies[256] = 1
+    heap = [(int(f), k, [k]) for k, f in enumerate(frequencies) if f]
+    heapq.heapify(heap)
+    sizes = numpy.zeros(257, int)
+    while len(heap) > 1:
+        f1, k1, group1 = heapq.heappop(heap)
+        f2, k2, group2 = heapq.heappop(heap)
+        sizes[group1 + group2] += 1
+        heapq.heappush(heap, (f1 + f2, k1, group1 + group2))
+    bits = numpy.bincount(sizes[sizes > 0], minlength=33)
+    # limit the code lengths to 16 bits
+    for i in range(len(bits) - 1, 16, -1):
+        while bits[i] > 0:
+            j = i - 2
+            while bits[j] == 0:
+                j -= 1
+            bits[i] -= 2
+            bits[i - 1] += 1
+            bits[j + 1] += 2
+            bits[j] -= 1
+    # remove the reserved symbol (the last of the longest codes)
+    bits[numpy.flatnonzero(bits[:17])[-1]] -= 1
+    values = [k for k in numpy.lexsort((numpy.arange(257), sizes)) if sizes[k] > 0 and k != 256]
+    return bits[1:17].tolist(), values
+
+def _entropy_code(symbols, extra, nbits, counts, values):
+    # Return the entropy coded data (bytes stuffed) of the symbols of a block
+    numpy = _numpy()
+    codes = numpy.zeros(256, numpy.uint64)
+    lengths = numpy.zeros(256, numpy.uint64)
+    code = 0
+    index = 0
+    for length, count in enumerate(counts, 1):
+        for _ in range(count):
+            codes[values[index]] = code
+            lengths[values[index]] = length
+            code += 1
+            index += 1
+        code <<= 1
+    nbits = lengths[symbols] + nbits.astype(numpy.uint64)
+    words = (codes[symbols] << (nbits - lengths[symbols])) | extra.astype(numpy.uint64)
+    total = int(nbits.sum())
+    starts = numpy.cumsum(nbits) - nbits
+    # the last byte is padded with 1 bits
+    bits = numpy.ones(-(-total // 8) * 8, numpy.uint8)
+    for k in range(int(nbits.max()) if len(nbits) else 0):
+        selected = nbits > k
+        bits[(starts[selected] + k).astype(numpy.int64)] = (words[selected] >> (nbits[selected] - 1 - k)) & 1
+    return numpy.packbits(bits).tobytes().replace(b"\xff", b"\xff\x00")
+
+def _segment(marker, data):
+    return _MARKER.pack(marker) + _LENGTH.pack(len(data) + 2) + data
+
+def _huffman_segment(table_id, counts, values):
+    return _segment(DHT, bytes([table_id]) + bytes(counts) + bytes(values))
+
+def encode(pixels, bitrate=0.75):
+    """Encode an 8 bits image (a 2D array of bytes or an ``L`` image) to WSQ data
+
+    ``bitrate`` is the target bit rate, in bits per pixel, used to allocate the
+    quantization bins of the subbands (0.75 gives a compression of about 15:1 on
+    a typical fingerprint). The actual bit rate depends on the image.
+    """
+    numpy = _numpy()
+    pixels = numpy.asarray(pixels, numpy.uint8)
+    if pixels.ndim != 2:
+        raise ValueError("WSQ images have one channel")
+    height, width = pixels.shape
+
+    # normalization, with the values stored in the frame header
+    m_shift = _to_scaled(float(pixels.mean()))
+    shift = _scaled(*m_shift)
+    r_scale = _to_scaled(max(shift - int(pixels.min()), int(pixels.max()) - shift) / 128 or 1.)
+    scale = _scaled(*r_scale)
+    a = ((pixels - numpy.float32(shift)) / numpy.float32(scale)).astype(numpy.float32)
+
+    nodes, subbands = decomposition(width, height)
+    _transform(a, nodes)
+
+    bins = []
+    for (x, y, w, h), q in zip(subbands, _bin_widths(_variances(a, subbands), bitrate)):
+        if q:
+            # the quantized values must fit in 16 bits
+            q = _to_scaled(max(q, float(abs(a[y:y + h, x:x + w]).max()) / 0xff00))
+        else:
+            q = (0, 0)
+        bins.append((q, _to_scaled(1.2 * _scaled(*q))))
+    blocks = []
+    for block in BLOCKS:
+        coefficients = [numpy.zeros(0, numpy.int32)]
+        for k in block:
+            q, z = _scaled(*bins[k][0]), _scaled(*bins[k][1])
+            if q == 0:
+                continue
+            x, y, w, h = subbands[k]
+            coefficients.append(_quantize(a[y:y + h, x:x + w], q, z).ravel())
+        blocks.append(_symbols(numpy.concatenate(coefficients)))
+
+    data = _MARKER.pack(SOI)
+    data += _segment(DTT, bytes([len(LO_FILTER), len(HI_FILTER)]) + b"".join(
+        _FILTER.pack(c < 0, *_to_scaled(abs(c), 0xffffffff))
+        for c in LO_FILTER[len(LO_FILTER) // 2:] + HI_FILTER[len(HI_FILTER) // 2:]))
+    data += _segment(DQT, _SCALED.pack(*_to_scaled(BIN_CENTER)) + b"".join(
+        _BIN.pack(*q, *z) for q, z in bins))
+    # a Huffman table for the first block, another one for the 2 other blocks
+    table0 = _huffman_code(blocks[0][0])
+    table1 = _huffman_code(numpy.concatenate([blocks[1][0], blocks[2][0]]))
+    data += _huffman_segment(0, *table0)
+    data += _segment(SOF, _FRAME.pack(0, 255, height, width, *m_shift, *r_scale, 2, 0))
+    data += _segment(SOB, bytes([0])) + _entropy_code(*blocks[0], *table0)
+    data += _huffman_segment(1, *table1)
+    for block in blocks[1:]:
+        data += _segment(SOB, bytes([1])) + _entropy_code(*block, *table1)
+    return data + _MARKER.pack(EOI)
+
+class WsqDecoder(ImageFile.PyDecoder):
+    """Pillow decoder of WSQ data, argument: the length of the data"""
+
+    _pulls_fd = True
+
+    def decode(self, buffer):
+        (length,) = self.args
+        pixels = decode(self.fd.read(length))
+        if pixels.shape != (self.state.ysize, self.state.xsize):
+            raise ValueError("WSQ image size does not match the header")
+        self.set_as_raw(pixels.tobytes(), "L")
+        return -1, 0
@@ -9,7 +9,7 @@ about = {}
 with open('iso19794/__init__.py', 'r') as f:
     try:
         exec(f.read(), about)
-    except KeyError:
+    except (KeyError, ImportError):
         pass
 
 setuptools.setup(
@@ -23,13 +23,16 @@ setuptools.setup(
     url="https://github.com/idemia/python-iso19794",
     packages = ['iso19794'],
     test_suite = 'iso19794.tests',
+    python_requires = '>=3.7',
     install_requires = [
         'setuptools',
         'Pillow>=5.0.0'
         ],
+    extras_require = {
+        'numpy': ['numpy'],
+        },
     classifiers=[
         "Development Status :: 4 - Beta",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "License :: CeCILL-C Free Software License Agreement (CECILL-C)",